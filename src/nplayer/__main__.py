@@ -3,7 +3,7 @@ import logging
 import sys
 import ConfigParser
 
-from . import player, DEF_CFG
+from . import logqueue, player, recorder, zones, DEF_CFG
 
 parser = argparse.ArgumentParser(description='Nativity scene music player')
 
@@ -15,18 +15,23 @@ parser.add_argument('-v', '--verbose', action='store_const',
 
 args = parser.parse_args()
 
-#set up logging
-logging.basicConfig(stream=sys.stdout, level=args.loglev,
-    format='[%(asctime)s] [%(levelname)3s] %(message)s')
-#log = logging.getLogger('nplayer')
-#log.addHandler(logging.StreamHandler())
-#if args.logfile is not None:
-#    log.addHandler(logging.FileHandler(args.logfile))
-
 cfg = ConfigParser.ConfigParser()
 if args.config not in cfg.read(args.config):
     print >>sys.stderr, '!! failed to load config file %s' % args.config
     sys.exit(1)
 
-player_inst = player.NativityPlayer(cfg)
+#set up logging, through a queue so that logging never blocks
+logqueue.setup(args.loglev, use_json=cfg.getboolean('logging', 'json'),
+    queue_size=cfg.getint('logging', 'queue_size'))
+
+#keep a record of recent events, to be dumped when something goes wrong
+recorder.setup(cfg)
+#log = logging.getLogger('nplayer')
+#if args.logfile is not None:
+#    log.addHandler(logging.FileHandler(args.logfile))
+
+if zones.zone_names(cfg):
+    player_inst = zones.ZoneEngine(cfg)
+else:
+    player_inst = player.NativityPlayer(cfg)
 player_inst.start()
@@ -0,0 +1,251 @@
+"""Hardware backends: GPIO, I2C, and audio output. The real backends drive the
+Raspberry Pi hardware (through RPIO and smbus, which are only imported when
+used); the fake ones run in-process anywhere, for benchmarks and testing."""
+
+import logging
+import threading
+import time
+
+import gi
+from gi.repository import Gst
+gi.require_version('Gst', '1.0')
+
+from nplayer.scheduler import monotonic
+
+class RPIOBackend(object):
+    """GPIO through RPIO, on the Raspberry Pi."""
+
+    def __init__(self):
+        import RPIO
+        self._rpio = RPIO
+
+
+    def setup_input(self, pin, pull_up):
+        """Configures a pin as an input with a pull-up (or pull-down)
+        resistor."""
+        self._rpio.setup(pin, self._rpio.IN,
+            pull_up_down=(self._rpio.PUD_UP if pull_up else
+                self._rpio.PUD_DOWN))
+
+
+    def setup_output(self, pin):
+        """Configures a pin as an output."""
+        self._rpio.setup(pin, self._rpio.OUT)
+
+
+    def input(self, pin):
+        """Returns the (bool) level of an input pin."""
+        return bool(self._rpio.input(pin))
+
+
+    def output(self, pin, value):
+        """Sets the level of an output pin."""
+        self._rpio.output(pin, bool(value))
+
+
+    def add_interrupt_callback(self, pin, callback, pull_up, debounce_ms):
+        """Registers callback(pin, level) to be called on both edges of an
+        input pin, once wait_for_interrupts() has been called."""
+        self._rpio.add_interrupt_callback(pin, callback, edge='both',
+            pull_up_down=(self._rpio.PUD_UP if pull_up else
+                self._rpio.PUD_DOWN),
+            debounce_timeout_ms=debounce_ms)
+
+
+    def wait_for_interrupts(self):
+        """Starts calling interrupt callbacks, on a thread of RPIO's own."""
+        self._rpio.wait_for_interrupts(threaded=True)
+
+
+    def pwm_setup(self, pulse_incr_us):
+        """Sets up DMA PWM with the given time resolution."""
+        from RPIO import PWM
+        self._pwm = PWM
+        PWM.setup(pulse_incr_us=pulse_incr_us)
+
+
+    def pwm_init_channel(self, channel, subcycle_us):
+        """Sets up a DMA channel to repeat its pulses every subcycle_us."""
+        self._pwm.init_channel(channel, subcycle_time_us=subcycle_us)
+
+
+    def pwm_add_pulse(self, channel, pin, start, width):
+        """Adds a pulse on a pin to a DMA channel's cycle, starting and lasting
+        the given numbers of PWM increments."""
+        self._pwm.add_channel_pulse(channel, pin, start, width)
+
+
+    def pwm_clear_pin(self, channel, pin):
+        """Removes all of a pin's pulses from a DMA channel, leaving it low."""
+        self._pwm.clear_channel_gpio(channel, pin)
+
+
+class FakeGPIO(object):
+    """In-process GPIO. Input levels are set by injecting edges, which call
+    the interrupt callbacks just as RPIO would; output levels are recorded.
+
+    Context: edges are delivered on whichever thread injects them"""
+
+    def __init__(self, levels=None):
+        """Initializes the fake GPIO.
+
+        Parameters:
+            dict levels: initial (bool) input levels keyed by pin; pins not
+                given read as low"""
+        self.levels = dict(levels or {})
+        self.outputs = {}
+        #(monotonic time, pin, level) for every output change
+        self.output_log = []
+        #PWM pulses as lists of (start, width), keyed by channel and pin
+        self.pwm = {}
+        self.pwm_ops = 0
+        self._callbacks = {}
+        self._live = False
+        self._lock = threading.Lock()
+
+
+    def setup_input(self, pin, pull_up):
+        self.levels.setdefault(pin, False)
+
+
+    def setup_output(self, pin):
+        self.outputs.setdefault(pin, False)
+
+
+    def input(self, pin):
+        return self.levels.get(pin, False)
+
+
+    def output(self, pin, value):
+        self.outputs[pin] = bool(value)
+        self.output_log.append((monotonic(), pin, bool(value)))
+
+
+    def add_interrupt_callback(self, pin, callback, pull_up, debounce_ms):
+        self._callbacks[pin] = callback
+
+
+    def wait_for_interrupts(self):
+        self._live = True
+
+
+    def pwm_setup(self, pulse_incr_us):
+        self.pwm_incr_us = pulse_incr_us
+
+
+    def pwm_init_channel(self, channel, subcycle_us):
+        self.pwm[channel] = {}
+
+
+    def pwm_add_pulse(self, channel, pin, start, width):
+        self.pwm[channel].setdefault(pin, []).append((start, width))
+        self.pwm_ops += 1
+
+
+    def pwm_clear_pin(self, channel, pin):
+        self.pwm[channel].pop(pin, None)
+        self.pwm_ops += 1
+
+
+    def inject(self, pin, level):
+        """Sets the level of an input pin, calling its interrupt callback if
+        the level changed. Returns the monotonic time of the edge."""
+        with self._lock:
+            if self.levels.get(pin, False) == bool(level):
+                return None
+            self.levels[pin] = bool(level)
+            stamp = monotonic()
+            callback = self._callbacks.get(pin)
+            if self._live and callback is not None:
+                callback(pin, int(level))
+            return stamp
+
+
+    def run_script(self, script):
+        """Injects a scripted series of edges, given as (delay in float
+        seconds, pin, level) tuples, each delay being relative to the previous
+        edge. Blocks until done; returns the list of edge times."""
+        stamps = []
+        for (delay, pin, level) in script:
+            if delay:
+                time.sleep(delay)
+            stamps.append(self.inject(pin, level))
+        return stamps
+
+
+def smbus_backend(bus):
+    """Returns an smbus.SMBus for the given I2C bus number."""
+    import smbus
+    return smbus.SMBus(bus)
+
+
+class RecordingI2C(object):
+    """In-process stand-in for smbus.SMBus which records every transaction.
+
+    Context: any thread"""
+
+    def __init__(self):
+        #(monotonic time, address, register/control byte, data bytes)
+        self.transactions = []
+        #bytes sent on the bus, counting the register/control byte but not
+        #the address
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+
+    def write_byte_data(self, addr, cmd, val):
+        self._record(addr, cmd, [val])
+
+
+    def write_i2c_block_data(self, addr, cmd, vals):
+        if len(vals) > 32:
+            raise IOError('SMBus block writes are limited to 32 bytes')
+        self._record(addr, cmd, list(vals))
+
+
+    def _record(self, addr, cmd, data):
+        with self._lock:
+            self.transactions.append((monotonic(), addr, cmd, data))
+            self.bytes += 1 + len(data)
+
+
+    def reset(self):
+        """Forgets all recorded transactions."""
+        with self._lock:
+            self.transactions = []
+            self.bytes = 0
+
+
+def make_audio_sink(spec, device=None, buffer_time=0, latency_time=0):
+    """Returns an audio sink element for the given sink specification, or None
+    to let GStreamer pick one. Specifications are:
+        auto: GStreamer's choice, or ALSA output if a device is given
+        alsa: ALSA output, to the given ALSA device (or the default)
+        fake: discards audio, in real time
+        file:PATH: writes audio to a WAV file at PATH
+    For ALSA output, buffer_time and latency_time are the sink's buffer size
+    and period size (how much it takes from the pipeline at a time), in float
+    seconds; 0 keeps GStreamer's default."""
+
+    if spec == 'auto' and not device:
+        return None
+    if spec in ('auto', 'alsa'):
+        sink = Gst.ElementFactory.make('alsasink', None)
+        if device:
+            sink.set_property('device', device)
+        #the properties are in microseconds
+        if buffer_time:
+            sink.set_property('buffer-time', int(buffer_time * 10**6))
+        if latency_time:
+            sink.set_property('latency-time', int(latency_time * 10**6))
+        return sink
+    if spec == 'fake':
+        sink = Gst.ElementFactory.make('fakesink', None)
+        sink.set_property('sync', True)
+        return sink
+    if spec.startswith('file:'):
+        sink = Gst.parse_bin_from_description(
+            'audioconvert ! wavenc ! filesink name=out', True)
+        sink.get_by_name('out').set_property('location', spec[len('file:'):])
+        return sink
+    raise ValueError('unknown audio sink %r' % spec)
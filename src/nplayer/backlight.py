@@ -0,0 +1,262 @@
+"""LCD backlight colors and effects. An effect is a color, given as red, green,
+and blue levels from 0 to 1, along with how to show it: steadily, blinking,
+pulsing, or fading in from the current color.
+
+Effects are written in the config file as one of:
+    N: old-style 3-bit bitmask (red, green, blue from most- to least-
+        significant bit), shown steadily
+    #rrggbb: color as hex levels, shown steadily
+    blink:COLOR[:PERIOD]: blinks between COLOR and off, every PERIOD seconds
+    pulse:COLOR[:PERIOD]: fades smoothly between COLOR and off and back,
+        every PERIOD seconds
+    fade:COLOR[:TIME]: fades from the current color to COLOR over TIME
+        seconds, then stays there
+where COLOR is either of the steady forms.
+
+PWMBacklight drives the LEDs with RPIO's DMA PWM, so levels and patterns are
+kept up by the hardware with no further work from us; SwitchedBacklight just
+switches them on or off."""
+
+import collections
+import logging
+import math
+import threading
+
+STEADY = 'steady'
+BLINK = 'blink'
+PULSE = 'pulse'
+FADE = 'fade'
+
+#default periods (or fade times) in seconds
+DEF_PERIODS = {BLINK: 1.0, PULSE: 2.0, FADE: 0.5}
+
+Effect = collections.namedtuple('Effect', ('kind', 'color', 'period'))
+
+OFF = Effect(STEADY, (0.0, 0.0, 0.0), 0)
+
+def parse_color(spec):
+    """Parses a color given as a 3-bit bitmask or as #rrggbb, returning an
+    (r, g, b) tuple of levels. Raises ValueError if it's neither."""
+    spec = spec.strip()
+    if spec.startswith('#'):
+        if len(spec) != 7:
+            raise ValueError('bad color %r, expected #rrggbb' % spec)
+        return tuple(int(spec[i:i + 2], 16) / 255.0 for i in (1, 3, 5))
+    bitmask = int(spec)
+    return (
+        float((bitmask >> 2) & 1),
+        float((bitmask >> 1) & 1),
+        float(bitmask & 1)
+    )
+
+
+def parse_effect(spec):
+    """Parses an effect specification (see the module docstring), returning
+    an Effect. Raises ValueError if it's malformed."""
+    parts = spec.strip().split(':')
+    if parts[0] not in DEF_PERIODS:
+        if len(parts) != 1:
+            raise ValueError('unknown backlight effect %r' % parts[0])
+        return Effect(STEADY, parse_color(parts[0]), 0)
+    if len(parts) not in (2, 3):
+        raise ValueError('bad backlight effect %r' % spec)
+    kind = parts[0]
+    period = float(parts[2]) if len(parts) == 3 else DEF_PERIODS[kind]
+    if period <= 0:
+        raise ValueError('bad period in backlight effect %r' % spec)
+    return Effect(kind, parse_color(parts[1]), period)
+
+
+class SwitchedBacklight(object):
+    """Backlight whose LEDs can only be on or off: levels of at least one half
+    are shown as on, and patterns are shown as their steady color.
+
+    Context: apply() may be called from any thread"""
+
+    def __init__(self, gpio, pins):
+        """Parameters:
+            gpio: GPIO backend (see backends.py)
+            tuple pins: red, green, and blue LED pins"""
+        self.gpio = gpio
+        self.pins = pins
+
+
+    def init(self):
+        """Sets up the LED pins."""
+        for pin in self.pins:
+            self.gpio.setup_output(pin)
+
+
+    def apply(self, effect):
+        """Shows the given effect."""
+        for (pin, level) in zip(self.pins, effect.color):
+            self.gpio.output(pin, level >= 0.5)
+
+
+class PWMBacklight(object):
+    """Backlight driven by DMA PWM. Two DMA channels are used: one with a
+    short cycle for steady levels, and one with a long cycle on which blink
+    and pulse patterns are laid out as a series of pulses. Fades step the
+    steady levels from the scheduler.
+
+    Context: apply() may be called from any thread"""
+
+    #DMA channels (ones not used by the GPU)
+    STEADY_CHANNEL = 8
+    PATTERN_CHANNEL = 9
+
+    #PWM time resolution, in microseconds
+    PULSE_INCR_US = 20
+    #cycle time for steady levels, short enough not to flicker
+    STEADY_US = 5000
+    #cycle time for patterns; pattern periods are rounded to divide it
+    PATTERN_US = 2000000
+    #length of each step of a pattern's brightness, in microseconds
+    SLOT_US = 10000
+
+    #time between the steps of a fade, in seconds
+    FADE_STEP = 0.04
+
+    def __init__(self, gpio, pins, sched):
+        """Parameters:
+            gpio: GPIO backend (see backends.py) with PWM support
+            tuple pins: red, green, and blue LED pins
+            scheduler.Scheduler sched: scheduler for stepping fades"""
+
+        self.log = logging.getLogger('nplayer.backlight')
+        self.gpio = gpio
+        self.pins = pins
+        self._sched = sched
+        self._ready = False
+
+        self._lock = threading.Lock()
+        #levels currently being shown steadily (or the color of the pattern
+        #being shown)
+        self._levels = (0.0, 0.0, 0.0)
+        #pulses set for each pin, as (channel, ((start, width), ...)), so that
+        #unchanged pins aren't touched
+        self._pulses = dict((pin, None) for pin in pins)
+        #pulse layouts of patterns, keyed by effect
+        self._patterns = {}
+        #counter so that the steps of superseded fades are ignored
+        self._gen = 0
+        self._fade_timer = None
+
+
+    def init(self):
+        """Sets up PWM (only the first time it's called)."""
+        if self._ready:
+            return
+        self.gpio.pwm_setup(self.PULSE_INCR_US)
+        self.gpio.pwm_init_channel(self.STEADY_CHANNEL, self.STEADY_US)
+        self.gpio.pwm_init_channel(self.PATTERN_CHANNEL, self.PATTERN_US)
+        self._ready = True
+
+
+    def apply(self, effect):
+        """Shows the given effect."""
+        with self._lock:
+            self._gen += 1
+            if self._fade_timer is not None:
+                self._fade_timer.cancel()
+                self._fade_timer = None
+
+            if effect.kind == STEADY:
+                self._set_levels(effect.color)
+            elif effect.kind == FADE:
+                steps = max(1, int(round(effect.period / self.FADE_STEP)))
+                self._fade_step(self._gen, self._levels, effect.color, 1,
+                    steps)
+            else:
+                pattern = self._patterns.get(effect)
+                if pattern is None:
+                    pattern = self._patterns[effect] = self._layout(effect)
+                for (pin, pulses) in zip(self.pins, pattern):
+                    self._set_pulses(pin, self.PATTERN_CHANNEL, pulses)
+                self._levels = effect.color
+
+
+    def _fade_step(self, gen, start, end, step, steps):
+        """Sets the levels for the given step of a fade, and schedules the
+        next. Caller must hold the lock, except when called by the scheduler.
+
+        Context: caller's thread, then the scheduler thread"""
+        if gen != self._gen:
+            return
+        frac = float(step) / steps
+        self._set_levels(tuple(a + (b - a) * frac for (a, b) in zip(start,
+            end)))
+        if step < steps:
+            self._fade_timer = self._sched.call_later(self.FADE_STEP,
+                self._fade_step_locked, gen, start, end, step + 1, steps)
+        else:
+            self._fade_timer = None
+
+
+    def _fade_step_locked(self, *args):
+        with self._lock:
+            self._fade_step(*args)
+
+
+    def _set_levels(self, levels):
+        """Shows the given levels steadily. Caller must hold the lock."""
+        incrs = self.STEADY_US // self.PULSE_INCR_US
+        for (pin, level) in zip(self.pins, levels):
+            width = int(round(max(0.0, min(level, 1.0)) * incrs))
+            self._set_pulses(pin, self.STEADY_CHANNEL,
+                ((0, width),) if width else ())
+        self._levels = levels
+
+
+    def _set_pulses(self, pin, channel, pulses):
+        """Makes the given pin put out the given pulses on the given channel
+        (and nothing on the other). Caller must hold the lock."""
+        if self._pulses[pin] == (channel, pulses):
+            return
+        old = self._pulses[pin]
+        if old is not None and old[1]:
+            self.gpio.pwm_clear_pin(old[0], pin)
+        for (start, width) in pulses:
+            self.gpio.pwm_add_pulse(channel, pin, start, width)
+        self._pulses[pin] = (channel, pulses)
+
+
+    def _layout(self, effect):
+        """Returns the pulses for each pin which make up a blink or pulse
+        pattern over one pattern cycle, as a tuple (per pin) of tuples of
+        (start, width) in PWM increments."""
+
+        cycle = self.PATTERN_US // self.PULSE_INCR_US
+        slot = self.SLOT_US // self.PULSE_INCR_US
+        slots = cycle // slot
+        #repetitions of the pattern per cycle
+        reps = max(1, int(round(self.PATTERN_US / (effect.period * 1e6))))
+        if abs(reps * effect.period * 1e6 - self.PATTERN_US) > 1:
+            self.log.debug('%s period %.3f s rounded to %.3f s', effect.kind,
+                effect.period, self.PATTERN_US / 1e6 / reps)
+
+        #brightness (0 to 1) of each slot
+        shape = []
+        for i in range(slots):
+            phase = (i * reps % slots) / float(slots)
+            if effect.kind == BLINK:
+                shape.append(1.0 if phase < 0.5 else 0.0)
+            else:
+                shape.append(math.sin(math.pi * phase) ** 2)
+
+        layout = []
+        for level in effect.color:
+            pulses = []
+            for (i, bright) in enumerate(shape):
+                width = int(round(bright * max(0.0, min(level, 1.0)) * slot))
+                if not width:
+                    continue
+                start = i * slot
+                if pulses and width == slot\
+                and pulses[-1][0] + pulses[-1][1] == start:
+                    #merge with the fully-on slot before
+                    pulses[-1] = (pulses[-1][0], pulses[-1][1] + width)
+                else:
+                    pulses.append((start, width))
+            layout.append(tuple(pulses))
+        return tuple(layout)
@@ -0,0 +1,612 @@
+"""Benchmarks of the player's responsiveness, run against fake GPIO, I2C, and
+audio output so that they can run on any Linux box with GStreamer. Scripted
+button scenarios are played against a real NativityPlayer, measuring the time
+from the deciding button edge to the pipeline playing, along with the LCD's
+I2C traffic. With --zones, multi-zone players of one zone up to the given
+number are benchmarked instead (each in a process of its own), triggering
+every zone at once to show how trigger latency and CPU use grow with zones.
+With --pipelines, playbin and manual pipelines are compared instead (each in a
+process of its own): the time from creating a pipeline to the first sample
+reaching the sink, the time from starting to play a prerolled pipeline to its
+position advancing, and the process's RSS with a full pool on standby. Give
+--sink alsa (and --device) to measure against real audio output, where the
+sink's buffer and latency times show.
+
+Usage: python -m nplayer.bench [--runs N] [--length SECS] [--zones N]
+    [--pipeline playbin|manual] [--pipelines [--sink SPEC] [--device DEV]
+    [--buffer-time SECS] [--latency-time SECS]]"""
+
+import argparse
+import ConfigParser
+import collections
+import functools
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import gi
+from gi.repository import GObject, Gst
+gi.require_version('Gst', '1.0')
+
+from nplayer import (backends, pipeline, player, transport, volume, zones,
+    DEF_CFG)
+from nplayer.scheduler import monotonic
+
+#number of test files to generate
+NUM_FILES = 3
+
+#time allowed for any one scenario step to finish, in seconds
+STEP_TIMEOUT = 15.0
+
+#time between the press and release of a tap, and between taps, in seconds
+TAP_TIME = 0.05
+TAP_GAP = 0.1
+
+#time to let every zone play after triggering them, in seconds
+ZONE_PLAY_TIME = 1.0
+
+#input pin options, and how far apart each zone's input pins are numbered
+INPUT_PINS = ('pin_play', 'pin_stop', 'pin_rw', 'pin_ff', 'pin_scene',
+    'pin_scene_toggle')
+ZONE_PIN_STEP = 100
+
+#decoder for manual pipelines playing the test files, which are WAV files
+TEST_DECODER = 'wavparse'
+
+#interval at which to poll a pipeline's position while waiting for it to
+#advance, in seconds
+POLL_TIME = 0.001
+
+def make_test_files(dirname, count, length):
+    """Generates count WAV files of the given length (seconds) of test tone in
+    the given directory. Returns their paths."""
+
+    paths = []
+    for i in range(count):
+        path = os.path.join(dirname, 'test%02d.wav' % i)
+        pipe = Gst.parse_launch(
+            'audiotestsrc samplesperbuffer=4410 num-buffers=%d freq=%d '
+            '! audioconvert ! audio/x-raw,rate=44100,channels=2 ! wavenc '
+            '! filesink location=%s' % (length * 10, 220 * (i + 1), path))
+        pipe.set_state(Gst.State.PLAYING)
+        msg = pipe.get_bus().timed_pop_filtered(Gst.CLOCK_TIME_NONE,
+            Gst.MessageType.EOS | Gst.MessageType.ERROR)
+        pipe.set_state(Gst.State.NULL)
+        if msg.type == Gst.MessageType.ERROR:
+            raise RuntimeError('failed generating %s: %s' % (path,
+                msg.parse_error()[0].message))
+        paths.append(path)
+    return paths
+
+
+def make_config(workdir, libdir):
+    """Returns the default configuration, changed to use the given library and
+    to keep all of the player's files in workdir."""
+
+    cfg = ConfigParser.ConfigParser()
+    cfg.read(DEF_CFG)
+    cfg.set('fs', 'libdir', libdir)
+    cfg.remove_option('fs', 'def_file')
+    cfg.set('fs', 'lastf_path', os.path.join(workdir, 'last'))
+    cfg.set('fs', 'index_path', os.path.join(workdir, 'index'))
+    cfg.set('fs', 'watch', 'False')
+    cfg.set('cache', 'enabled', 'False')
+    cfg.set('audio', 'sink', 'fake')
+    cfg.set('audio', 'decoder', TEST_DECODER)
+    cfg.set('metrics', 'http_port', '0')
+    cfg.set('remote', 'http_port', '0')
+    cfg.set('remote', 'socket_path', os.path.join(workdir, 'remote'))
+    return cfg
+
+
+def make_zone_config(workdir, libdir, count):
+    """Returns the default configuration, changed as by make_config(), and to
+    run the given number of zones playing the same library. Only the first
+    zone has the LCD."""
+
+    cfg = make_config(workdir, libdir)
+    names = ['zone%d' % i for i in range(count)]
+    cfg.set(zones.ZONES_SECTION, 'names', ' '.join(names))
+    for (i, name) in enumerate(names):
+        section = zones.ZONE_PREFIX + name
+        cfg.add_section(section)
+        for opt in INPUT_PINS:
+            cfg.set(section, opt,
+                str(cfg.getint('inputs', opt) + ZONE_PIN_STEP * i))
+        cfg.set(section, 'lastf_path', os.path.join(workdir, 'last-' + name))
+        cfg.set(section, 'index_path', os.path.join(workdir, 'index-' + name))
+        if i:
+            cfg.set(section, 'lcd.enabled', 'False')
+    return cfg
+
+
+def rss_mb():
+    """Returns the resident set size of this process, in MiB."""
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024.0
+    return 0.0
+
+
+def percentile(samples, pct):
+    """Returns the given percentile of a list of samples (nearest rank)."""
+    ordered = sorted(samples)
+    rank = int(round(pct / 100.0 * len(ordered) + 0.5)) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+
+class StateWatcher(object):
+    """Records the transport state changes of a player, and lets the bench
+    wait for them."""
+
+    def __init__(self, nplayer):
+        #(monotonic time, new state) for every change
+        self.changes = []
+        self._cond = threading.Condition()
+        nplayer.add_transport_listener(self._changed)
+
+
+    def _changed(self, old, new):
+        """Context: controller thread"""
+        with self._cond:
+            self.changes.append((monotonic(), new))
+            self._cond.notify_all()
+
+
+    def wait_for(self, state, since):
+        """Waits for the transport to enter the given state after the given
+        monotonic time. Returns the time it did so."""
+        deadline = monotonic() + STEP_TIMEOUT
+        with self._cond:
+            while True:
+                for (stamp, new) in self.changes:
+                    if new == state and stamp >= since:
+                        return stamp
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    raise RuntimeError('timed out waiting for %s' % state)
+                self._cond.wait(remaining)
+
+
+class Bench(object):
+    """Runs button scenarios against a player with fake hardware."""
+
+    def __init__(self, cfg):
+        self.invert = cfg.getboolean('inputs', 'invert_logic')
+        self.pin_play = cfg.getint('inputs', 'pin_play')
+        self.pin_stop = cfg.getint('inputs', 'pin_stop')
+        self.pin_ff = cfg.getint('inputs', 'pin_ff')
+        self.pin_scene = cfg.getint('inputs', 'pin_scene')
+        self.scp_hits = cfg.getint('prefs', 'scp_hits')
+        self.hold_time = cfg.getfloat('prefs', 'skip_hold_time')
+        self.remote_path = cfg.get('remote', 'socket_path')
+
+        #all buttons released, with the scene toggle on so that scene taps
+        #count
+        levels = dict((cfg.getint('inputs', opt), self.invert)
+            for opt in ('pin_play', 'pin_stop', 'pin_rw', 'pin_ff',
+                'pin_scene'))
+        levels[cfg.getint('inputs', 'pin_scene_toggle')] = not self.invert
+        self.gpio = backends.FakeGPIO(levels)
+        self.i2c = backends.RecordingI2C()
+
+        self.player = player.NativityPlayer(cfg, gpio=self.gpio, i2c=self.i2c)
+        self.states = StateWatcher(self.player)
+        #latencies in seconds, keyed by scenario name
+        self.latency = collections.OrderedDict()
+
+
+    def _press(self, pin):
+        return self.gpio.inject(pin, not self.invert)
+
+
+    def _release(self, pin):
+        return self.gpio.inject(pin, self.invert)
+
+
+    def _tap(self, pin):
+        """Presses and releases a button. Returns the release edge time."""
+        self._press(pin)
+        time.sleep(TAP_TIME)
+        return self._release(pin)
+
+
+    def _settle(self):
+        """Stops playing (if playing) and waits for the transport to be
+        idle."""
+        if self.player.transport.state != transport.IDLE:
+            stamp = self._tap(self.pin_stop)
+            self.states.wait_for(transport.IDLE, stamp)
+        #let the display catch up
+        time.sleep(TAP_GAP)
+
+
+    def _record(self, name, edge, done):
+        self.latency.setdefault(name, []).append(done - edge)
+
+
+    def scene_taps(self):
+        """Scene button tapped enough times to start playing; measured from
+        the last release."""
+        self._settle()
+        for i in range(self.scp_hits):
+            stamp = self._tap(self.pin_scene)
+            time.sleep(TAP_GAP)
+        self._record('scene taps', stamp,
+            self.states.wait_for(transport.PLAYING, stamp))
+
+
+    def ff_hold(self):
+        """Fast-forward held long enough to start trick play, then released;
+        measured from the release to playing at normal speed again."""
+        self._settle()
+        stamp = self._tap(self.pin_play)
+        self.states.wait_for(transport.PLAYING, stamp)
+        self._press(self.pin_ff)
+        time.sleep(self.hold_time + 0.5)
+        stamp = self._release(self.pin_ff)
+        self.states.wait_for(transport.SEEKING, stamp)
+        self._record('ff hold', stamp,
+            self.states.wait_for(transport.PLAYING, stamp))
+
+
+    def file_switch(self):
+        """Switch to the next file (play held, ff tapped), then play; measured
+        from the play release to playing."""
+        self._settle()
+        self._press(self.pin_play)
+        time.sleep(TAP_TIME)
+        self._tap(self.pin_ff)
+        time.sleep(TAP_TIME)
+        self._release(self.pin_play)
+        time.sleep(TAP_GAP)
+        stamp = self._tap(self.pin_play)
+        self._record('file switch', stamp,
+            self.states.wait_for(transport.PLAYING, stamp))
+
+
+    def remote_play(self):
+        """Play command sent over the remote control socket; measured from
+        sending it to playing."""
+        self._settle()
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(self.remote_path)
+        try:
+            stamp = monotonic()
+            client.sendall(json.dumps({'cmd': 'play'}) + '\n')
+            self._record('remote play', stamp,
+                self.states.wait_for(transport.PLAYING, stamp))
+            client.makefile().readline()
+        finally:
+            client.close()
+
+
+    def run(self, runs):
+        """Runs every scenario the given number of times. Returns the I2C
+        traffic in bytes per second over the whole run."""
+
+        self.player.start(block=False)
+        #wait for the first file to be prerolled
+        if self.player.transport.state != transport.IDLE:
+            self.states.wait_for(transport.IDLE, 0)
+
+        self.i2c.reset()
+        start = monotonic()
+        for i in range(runs):
+            self.scene_taps()
+            self.ff_hold()
+            self.file_switch()
+            self.remote_play()
+        self._settle()
+        return self.i2c.bytes / (monotonic() - start)
+
+
+class ZoneBench(object):
+    """Triggers every zone of a multi-zone player at once with scene taps,
+    measuring each zone's time from its deciding tap to playing, and the CPU
+    time used throughout."""
+
+    def __init__(self, cfg):
+        self.invert = cfg.getboolean('inputs', 'invert_logic')
+        self.scp_hits = cfg.getint('prefs', 'scp_hits')
+
+        #pins of each zone, keyed by zone name, then by option
+        self.pins = collections.OrderedDict()
+        levels = {}
+        for name in zones.zone_names(cfg):
+            zcfg = zones.zone_config(cfg, name)
+            pins = dict((opt, zcfg.getint('inputs', opt))
+                for opt in INPUT_PINS)
+            self.pins[name] = pins
+            #all buttons released, with the scene toggle on
+            for opt in INPUT_PINS:
+                levels[pins[opt]] = self.invert
+            levels[pins['pin_scene_toggle']] = not self.invert
+        self.gpio = backends.FakeGPIO(levels)
+        self.i2c = backends.RecordingI2C()
+
+        self.engine = zones.ZoneEngine(cfg, gpio=self.gpio, i2c=self.i2c)
+        self.states = dict((name, StateWatcher(zone))
+            for (name, zone) in self.engine.zones.items())
+        #trigger latencies of every zone, in seconds
+        self.latency = []
+
+
+    def _level(self, pressed):
+        return pressed != self.invert
+
+
+    def _tap_all(self, opt):
+        """Taps the given button of every zone at once. Returns the release
+        edge times, keyed by zone name."""
+        for pins in self.pins.values():
+            self.gpio.inject(pins[opt], self._level(True))
+        time.sleep(TAP_TIME)
+        return dict((name, self.gpio.inject(pins[opt], self._level(False)))
+            for (name, pins) in self.pins.items())
+
+
+    def _settle(self):
+        """Stops every zone and waits for them all to be idle."""
+        stamps = self._tap_all('pin_stop')
+        for (name, zone) in self.engine.zones.items():
+            if zone.transport.state != transport.IDLE:
+                self.states[name].wait_for(transport.IDLE, stamps[name])
+        time.sleep(TAP_GAP)
+
+
+    def run(self, runs):
+        """Triggers every zone the given number of times. Returns the CPU time
+        used as a percentage of one core."""
+
+        self.engine.start(block=False)
+        for (name, zone) in self.engine.zones.items():
+            if zone.transport.state != transport.IDLE:
+                self.states[name].wait_for(transport.IDLE, 0)
+
+        start_cpu = os.times()
+        start = monotonic()
+        for i in range(runs):
+            self._settle()
+            for hit in range(self.scp_hits):
+                stamps = self._tap_all('pin_scene')
+                time.sleep(TAP_GAP)
+            for (name, stamp) in stamps.items():
+                self.latency.append(self.states[name].wait_for(
+                    transport.PLAYING, stamp) - stamp)
+            time.sleep(ZONE_PLAY_TIME)
+        self._settle()
+        end_cpu = os.times()
+        cpu = (end_cpu[0] + end_cpu[1]) - (start_cpu[0] + start_cpu[1])
+        return 100.0 * cpu / (monotonic() - start)
+
+
+class PipelineBench(object):
+    """Creates and plays pipelines of one kind over and over, measuring the
+    time from creating each to the first sample reaching its sink, and the
+    time from starting to play it (once prerolled) to its position
+    advancing."""
+
+    def __init__(self, mode, sink, device=None, buffer_time=0,
+        latency_time=0):
+        """mode is playbin or manual; the rest are as for
+        backends.make_audio_sink()."""
+        self._make_sink_args = (sink, device, buffer_time, latency_time)
+        self._first = threading.Event()
+        self.pool = pipeline.PipelinePool(NUM_FILES, make_sink=self._make_sink,
+            make_filter=functools.partial(volume.make_volume, 1.0),
+            decoder=TEST_DECODER if mode == 'manual' else None)
+        #times in seconds
+        self.first_sample = []
+        self.play = []
+
+
+    def _make_sink(self):
+        """Returns an audio sink which notes the first sample reaching it."""
+        sink = backends.make_audio_sink(*self._make_sink_args)
+        if sink is None:
+            raise ValueError('the bench needs a sink it can watch')
+        sink.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER,
+            self._buffer)
+        return sink
+
+
+    def _buffer(self, pad, info):
+        """Context: streaming thread"""
+        self._first.set()
+        return Gst.PadProbeReturn.REMOVE
+
+
+    @staticmethod
+    def _wait_paused(pipe):
+        (ret, cur, pending) = pipe.get_state(int(STEP_TIMEOUT * Gst.SECOND))
+        if ret != Gst.StateChangeReturn.SUCCESS or cur != Gst.State.PAUSED:
+            raise RuntimeError('pipeline failed to preroll')
+
+
+    def _play(self, pipe):
+        """Plays the given prerolled pipeline until its position advances,
+        then puts it back on standby. Returns the time taken to advance."""
+        start = monotonic()
+        pipe.set_state(Gst.State.PLAYING)
+        while True:
+            (ok, pos) = pipe.query_position(Gst.Format.TIME)
+            if ok and pos > 0:
+                break
+            if monotonic() - start > STEP_TIMEOUT:
+                raise RuntimeError('pipeline failed to start playing')
+            time.sleep(POLL_TIME)
+        taken = monotonic() - start
+        pipeline.rewind(pipe)
+        self._wait_paused(pipe)
+        return taken
+
+
+    def run(self, paths, runs):
+        """Creates and plays a pipeline for each of the given files the given
+        number of times. Returns the RSS, in MiB, once pipelines for all of
+        the files are on standby."""
+        for i in range(runs):
+            for path in paths:
+                self.pool.discard(path)
+                self._first.clear()
+                start = monotonic()
+                pipe = self.pool.activate(path)
+                if not self._first.wait(STEP_TIMEOUT):
+                    raise RuntimeError('no sample reached the sink')
+                self.first_sample.append(monotonic() - start)
+                self._wait_paused(pipe)
+                self.play.append(self._play(pipe))
+
+        self.pool.prefetch(paths)
+        for pipe in self.pool.pipelines():
+            self._wait_paused(pipe)
+        return rss_mb()
+
+
+def run_pipelines(mode, libdir, runs, args):
+    """Benchmarks pipelines of the given kind playing the files in libdir,
+    printing a row of results."""
+    paths = [os.path.join(libdir, name) for name in sorted(os.listdir(libdir))]
+    bench = PipelineBench(mode, args.sink, args.device, args.buffer_time,
+        args.latency_time)
+    rss = bench.run(paths, runs)
+    print '%-8s %5d %9.1f %9.1f %9.1f %9.1f %7.1f' % (mode,
+        len(bench.first_sample), percentile(bench.first_sample, 50) * 1000,
+        max(bench.first_sample) * 1000, percentile(bench.play, 50) * 1000,
+        max(bench.play) * 1000, rss)
+    sys.stdout.flush()
+
+
+def run_zones(count, runs, length):
+    """Benchmarks a player of the given number of zones, printing a row of
+    results."""
+    workdir = tempfile.mkdtemp(prefix='nplayer-bench-')
+    try:
+        libdir = os.path.join(workdir, 'music')
+        os.mkdir(libdir)
+        make_test_files(libdir, NUM_FILES, length)
+
+        bench = ZoneBench(make_zone_config(workdir, libdir, count))
+        cpu = bench.run(runs)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print '%-6d %7d %9.1f %9.1f %9.1f %7.1f' % (count, len(bench.latency),
+        percentile(bench.latency, 50) * 1000,
+        percentile(bench.latency, 99) * 1000, max(bench.latency) * 1000, cpu)
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Nativity player latency benchmarks')
+    parser.add_argument('-n', '--runs', type=int, default=10,
+        help='number of times to run each scenario')
+    parser.add_argument('-l', '--length', type=int, default=30,
+        help='length of the generated test files, in seconds')
+    parser.add_argument('-z', '--zones', type=int, default=0,
+        help='benchmark multi-zone players of 1 up to this many zones')
+    parser.add_argument('--zone-count', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('-p', '--pipeline', choices=('playbin', 'manual'),
+        default='playbin', help='kind of pipeline for the player to use')
+    parser.add_argument('--pipelines', action='store_true',
+        help='compare playbin and manual pipelines')
+    parser.add_argument('--sink', default='fake',
+        help='audio sink for comparing pipelines (see [audio] sink)')
+    parser.add_argument('--device', default='',
+        help='ALSA device for comparing pipelines')
+    parser.add_argument('--buffer-time', type=float, default=0,
+        help='ALSA sink buffer time for comparing pipelines, in seconds')
+    parser.add_argument('--latency-time', type=float, default=0,
+        help='ALSA sink latency time for comparing pipelines, in seconds')
+    parser.add_argument('--pipeline-mode', help=argparse.SUPPRESS)
+    parser.add_argument('--libdir', help=argparse.SUPPRESS)
+    parser.add_argument('-v', '--verbose', action='store_const',
+        default=logging.WARNING, const=logging.DEBUG, dest='loglev')
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, level=args.loglev,
+        format='[%(asctime)s] [%(levelname)3s] %(message)s')
+
+    if args.zones:
+        #each in a fresh process, so that the players before don't weigh on
+        #the CPU use
+        print '%-6s %7s %9s %9s %9s %7s' % ('zones', 'trigs', 'p50 ms',
+            'p99 ms', 'max ms', 'cpu %')
+        sys.stdout.flush()
+        for count in range(1, args.zones + 1):
+            cmd = [sys.executable, '-m', 'nplayer.bench', '--zone-count',
+                str(count), '--runs', str(args.runs), '--length',
+                str(args.length)]
+            if args.loglev == logging.DEBUG:
+                cmd.append('--verbose')
+            subprocess.check_call(cmd)
+        return
+
+    GObject.threads_init()
+    Gst.init(None)
+
+    if args.zone_count:
+        run_zones(args.zone_count, args.runs, args.length)
+        return
+
+    if args.pipeline_mode:
+        run_pipelines(args.pipeline_mode, args.libdir, args.runs, args)
+        return
+
+    if args.pipelines:
+        #the files are made here, so that the plugins making them don't
+        #weigh on the RSS of the processes under test
+        workdir = tempfile.mkdtemp(prefix='nplayer-bench-')
+        try:
+            make_test_files(workdir, NUM_FILES, args.length)
+            print '%-8s %5s %9s %9s %9s %9s %7s' % ('pipeline', 'runs',
+                'first p50', 'first max', 'play p50', 'play max', 'rss MiB')
+            sys.stdout.flush()
+            for mode in ('playbin', 'manual'):
+                cmd = [sys.executable, '-m', 'nplayer.bench',
+                    '--pipeline-mode', mode, '--libdir', workdir, '--runs',
+                    str(args.runs), '--sink', args.sink, '--device',
+                    args.device, '--buffer-time', str(args.buffer_time),
+                    '--latency-time', str(args.latency_time)]
+                if args.loglev == logging.DEBUG:
+                    cmd.append('--verbose')
+                subprocess.check_call(cmd)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        return
+
+    workdir = tempfile.mkdtemp(prefix='nplayer-bench-')
+    try:
+        libdir = os.path.join(workdir, 'music')
+        os.mkdir(libdir)
+        make_test_files(libdir, NUM_FILES, args.length)
+
+        cfg = make_config(workdir, libdir)
+        cfg.set('audio', 'pipeline', args.pipeline)
+        bench = Bench(cfg)
+        i2c_rate = bench.run(args.runs)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print '%-12s %5s %9s %9s %9s' % ('scenario', 'runs', 'p50 ms', 'p99 ms',
+        'max ms')
+    for (name, samples) in bench.latency.items():
+        print '%-12s %5d %9.1f %9.1f %9.1f' % (name, len(samples),
+            percentile(samples, 50) * 1000, percentile(samples, 99) * 1000,
+            max(samples) * 1000)
+    print 'i2c: %.0f bytes/s (%d transactions)' % (i2c_rate,
+        len(bench.i2c.transactions))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""Command queue and the controller thread which consumes it. Input callbacks
+and other threads submit commands rather than acting on the player directly,
+so that they never block on GStreamer, and so that all player control happens
+on one thread in the order it was asked for."""
+
+import collections
+import logging
+import threading
+
+from nplayer import metrics, recorder
+from nplayer.scheduler import monotonic
+
+class Command(object):
+    """A queued call."""
+
+    __slots__ = ('name', 'func', 'args', 'stamp', 'merge')
+
+    def __init__(self, name, func, args, stamp, merge):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.stamp = stamp
+        self.merge = merge
+
+
+class CommandStats(object):
+    """Latency statistics for one kind of command, measured from when the
+    command was submitted to when it finished running."""
+
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+    def add(self, latency):
+        self.count += 1
+        self.total += latency
+        if latency > self.max:
+            self.max = latency
+
+
+class Controller(object):
+    """Bounded command queue with a single consumer thread.
+
+    Context: commands may be submitted from any thread; they run on the
+    controller thread"""
+
+    def __init__(self, size=64):
+        """Initializes the controller.
+
+        Parameters:
+            int size: maximum number of queued commands; further droppable
+                commands are dropped until there's room again, while others
+                are queued beyond it (see submit())"""
+
+        self.log = logging.getLogger('nplayer.control')
+        self.size = size
+
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._thread = None
+
+        #highest number of commands queued at once
+        self.high_water = 0
+        #number of commands dropped due to the queue being full
+        self.dropped = 0
+        #number of commands queued beyond the size, not being droppable
+        self.overflowed = 0
+        #number of commands merged into queued ones
+        self.merged = 0
+        #CommandStats keyed by command name
+        self.latency = collections.defaultdict(CommandStats)
+        #latency histograms keyed by command name
+        self._latency_hists = {}
+
+        metrics.REGISTRY.gauge_func('nplayer_command_queue_high_water',
+            'Highest number of commands queued at once',
+            lambda: self.high_water)
+        metrics.REGISTRY.counter_func('nplayer_commands_dropped',
+            'Commands dropped due to the queue being full',
+            lambda: self.dropped)
+        metrics.REGISTRY.counter_func('nplayer_commands_merged',
+            'Commands merged into queued ones', lambda: self.merged)
+        metrics.REGISTRY.counter_func('nplayer_commands_overflowed',
+            'Commands queued beyond the queue size, not being droppable',
+            lambda: self.overflowed)
+
+
+    def start(self):
+        """Starts the controller thread."""
+        self._thread = threading.Thread(target=self._run, name='controller')
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def submit(self, name, func, *args, **kwargs):
+        """Queues func(*args) to run on the controller thread. Returns False if
+        the command was dropped because the queue is full.
+
+        Only commands submitted as droppable are ever dropped: ones which
+        adjust something the user can simply adjust again, such as seeks and
+        the volume. Everything else (input edges, bus messages, timeouts, and
+        the like) is queued even beyond the size, since losing it would leave
+        a button held down or the player waiting on a message that's gone.
+
+        Parameters:
+            str name: command name, used for statistics and merging
+            callable func, args: the call to make
+            float stamp (keyword): monotonic time at which the command
+                originated; defaults to now
+            callable merge (keyword): if given, and the last queued command has
+                the same name and function (so is for the same player, where
+                several share the controller), the two are merged into one
+                instead of queuing another; called with the queued and the new
+                argument tuples, returns the argument tuple for the merged
+                command
+            bool droppable (keyword): whether the command may be dropped if
+                the queue is full; defaults to False"""
+
+        stamp = kwargs.get('stamp')
+        if stamp is None:
+            stamp = monotonic()
+        merge = kwargs.get('merge')
+
+        with self._cond:
+            if merge is not None and self._queue\
+            and self._queue[-1].name == name\
+            and self._queue[-1].func == func:
+                last = self._queue[-1]
+                last.args = merge(last.args, args)
+                self.merged += 1
+                return True
+
+            if len(self._queue) >= self.size:
+                if kwargs.get('droppable'):
+                    self.dropped += 1
+                    self.log.warning('command queue full, dropped %s command',
+                        name)
+                    return False
+                self.overflowed += 1
+                self.log.warning('command queue full, queued %s command '
+                    'beyond it', name)
+
+            self._queue.append(Command(name, func, args, stamp, merge))
+            if len(self._queue) > self.high_water:
+                self.high_water = len(self._queue)
+            self._cond.notify()
+        return True
+
+
+    def stats(self):
+        """Returns a dict of queue statistics: high-water mark, dropped,
+        merged, and overflowed command counts, and per-command latency as a
+        dict of (count, mean latency, max latency) tuples keyed by command
+        name."""
+        with self._cond:
+            return {
+                'high_water': self.high_water,
+                'dropped': self.dropped,
+                'merged': self.merged,
+                'overflowed': self.overflowed,
+                'latency': dict((name, (st.count, st.total / st.count, st.max))
+                    for (name, st) in self.latency.items()),
+            }
+
+
+    def _run(self):
+        """Controller thread body.
+
+        Context: controller thread"""
+
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                cmd = self._queue.popleft()
+
+            try:
+                cmd.func(*cmd.args)
+            except Exception:
+                self.log.exception('error running %s command', cmd.name)
+                recorder.RECORDER.exception(cmd.name)
+
+            latency = monotonic() - cmd.stamp
+            with self._cond:
+                self.latency[cmd.name].add(latency)
+            hist = self._latency_hists.get(cmd.name)
+            if hist is None:
+                hist = self._latency_hists[cmd.name] =\
+                    metrics.REGISTRY.histogram('nplayer_command_seconds',
+                        'Time from command submission to completion',
+                        command=cmd.name)
+            hist.observe(latency)
+            self.log.debug('%s command done, %.1f ms after submission',
+                cmd.name, latency * 1000)
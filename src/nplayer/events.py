@@ -0,0 +1,64 @@
+"""Event loop for GStreamer bus messages. Runs a GLib main loop on a dedicated
+thread so that bus messages are handled as soon as they are posted, rather than
+whenever somebody gets around to polling the bus."""
+
+import logging
+import threading
+
+import gi
+from gi.repository import GLib, Gst
+gi.require_version('Gst', '1.0')
+
+from nplayer import recorder
+
+class EventLoop(object):
+    """Dispatches messages from any number of GStreamer buses to handlers.
+
+    Context: handlers run on the event loop thread"""
+
+    def __init__(self):
+        self.log = logging.getLogger('nplayer.events')
+        self._loop = GLib.MainLoop()
+        self._thread = None
+
+
+    def start(self):
+        """Starts the event loop thread."""
+        self._thread = threading.Thread(target=self._loop.run,
+            name='events')
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def watch(self, bus, handlers):
+        """Starts dispatching messages from the given bus.
+
+        Parameters:
+            Gst.Bus bus: bus to watch
+            dict handlers: maps Gst.MessageType values to callables, which are
+                called with the Gst.Message; other message types are dropped"""
+        bus.add_watch(GLib.PRIORITY_DEFAULT, self._dispatch, handlers)
+
+
+    def unwatch(self, bus):
+        """Stops dispatching messages from the given bus."""
+        bus.remove_watch()
+
+
+    def _dispatch(self, bus, msg, handlers):
+        """Bus watch callback.
+
+        Context: event loop thread"""
+
+        handler = handlers.get(msg.type)
+        if handler is not None:
+            try:
+                handler(msg)
+            except Exception:
+                self.log.exception('error handling %s message',
+                    Gst.MessageType.get_name(msg.type))
+                recorder.RECORDER.exception(
+                    Gst.MessageType.get_name(msg.type))
+
+        #keep the watch installed
+        return True
@@ -0,0 +1,271 @@
+"""Table-driven recognizer for button gestures. Gestures are declared as
+specifications tying an action name to a button (or two), and each button
+edge is turned into at most one decision: which action, if any, it completes.
+
+Gesture specifications are:
+    tap BUTTON: BUTTON pressed and released
+    taps BUTTON COUNT WINDOW: BUTTON released COUNT times within WINDOW
+        seconds
+    hold BUTTON TIME [REPEAT]: BUTTON held down for TIME seconds, then (if
+        REPEAT is given) every REPEAT seconds for as long as it stays down;
+        the release ending the hold is reported too
+    chord ANCHOR BUTTON: BUTTON pressed and released while ANCHOR is held
+        down; the release of ANCHOR is then ignored, and releasing ANCHOR
+        first botches the chord
+    press BUTTON: BUTTON pressed
+    release BUTTON: BUTTON released, if nothing else claimed the release
+
+A press which a hold or chord took over never also counts as a tap."""
+
+import collections
+import logging
+
+#gesture kinds
+TAP = 'tap'
+TAPS = 'taps'
+HOLD = 'hold'
+CHORD = 'chord'
+PRESS = 'press'
+RELEASE = 'release'
+
+#phases of an action reported to the dispatcher
+FIRE = 'fire'
+REPEAT = 'repeat'
+END = 'end'
+BOTCHED = 'botched'
+
+Gesture = collections.namedtuple('Gesture', ('action', 'kind', 'button',
+    'other', 'count', 'time', 'repeat'))
+
+def parse_gesture(action, spec, buttons):
+    """Parses a gesture specification (see the module docstring) for the
+    given action. Raises ValueError if it's malformed or names a button not
+    in buttons."""
+
+    words = spec.split()
+    if not words:
+        raise ValueError('empty gesture for %s' % action)
+    kind = words[0]
+    args = words[1:]
+    for button in args[:2 if kind == CHORD else 1]:
+        if button not in buttons:
+            raise ValueError('unknown button %r in gesture for %s' % (button,
+                action))
+
+    try:
+        if kind in (TAP, PRESS, RELEASE) and len(args) == 1:
+            return Gesture(action, kind, args[0], None, 1, None, None)
+        if kind == TAPS and len(args) == 3:
+            count = int(args[1])
+            if count < 1:
+                raise ValueError('tap count must be at least 1')
+            return Gesture(action, kind, args[0], None, count,
+                float(args[2]), None)
+        if kind == HOLD and len(args) in (2, 3):
+            repeat = float(args[2]) if len(args) == 3 else None
+            if repeat is not None and repeat <= 0:
+                raise ValueError('repeat interval must be positive')
+            return Gesture(action, kind, args[0], None, 1, float(args[1]),
+                repeat)
+        if kind == CHORD and len(args) == 2 and args[0] != args[1]:
+            return Gesture(action, kind, args[1], args[0], 1, None, None)
+    except ValueError as e:
+        raise ValueError('bad gesture %r for %s: %s' % (spec, action, e))
+    raise ValueError('bad gesture %r for %s' % (spec, action))
+
+
+class _Button(object):
+    """Gesture state of one button."""
+
+    __slots__ = ('down', 'down_at', 'press_gen', 'held', 'consumed',
+        'timer', 'rings')
+
+    def __init__(self, taps):
+        self.down = False
+        self.down_at = None
+        #counter of presses, so that hold timers of earlier presses are
+        #ignored
+        self.press_gen = 0
+        #whether the button's hold gesture has fired during the current
+        #press
+        self.held = False
+        #whether the current press has been taken over by a chord
+        self.consumed = False
+        self.timer = None
+        #release times for each taps gesture, in rings of the gesture's count
+        self.rings = [(g, collections.deque(maxlen=g.count)) for g in taps]
+
+
+class Recognizer(object):
+    """Turns button edges into actions.
+
+    Context: edge() and the dispatcher run on the controller thread"""
+
+    def __init__(self, gestures, sched, submit, dispatch):
+        """Sets up the recognizer.
+
+        Parameters:
+            list gestures: Gesture instances; where several could complete on
+                the same edge, chords win over holds, holds over taps (with
+                higher counts first), and taps over plain releases. Each
+                button may have only one hold gesture
+            scheduler.Scheduler sched: scheduler for hold timers
+            callable submit: submits a command to the controller, as
+                control.Controller.submit
+            callable dispatch: called with (action, phase, count) for each
+                decision, where phase is one of FIRE, REPEAT, END, or BOTCHED,
+                and count is the number of times a hold has repeated"""
+
+        self.log = logging.getLogger('nplayer.gestures')
+        self._sched = sched
+        self._submit = submit
+        self._dispatch = dispatch
+
+        by_kind = collections.defaultdict(lambda: collections.defaultdict(
+            list))
+        buttons = set()
+        for gesture in gestures:
+            by_kind[gesture.kind][gesture.button].append(gesture)
+            buttons.add(gesture.button)
+            if gesture.other is not None:
+                buttons.add(gesture.other)
+        self._presses = by_kind[PRESS]
+        self._releases = by_kind[RELEASE]
+        self._holds = {}
+        for (button, holds) in by_kind[HOLD].items():
+            if len(holds) > 1:
+                raise ValueError('more than one hold gesture for %s' % button)
+            self._holds[button] = holds[0]
+        #chords keyed by the button completing them
+        self._chords = by_kind[CHORD]
+        #buttons anchoring chords, with the chords they anchor
+        self._anchored = collections.defaultdict(list)
+        for chords in self._chords.values():
+            for chord in chords:
+                self._anchored[chord.other].append(chord)
+
+        self._buttons = {}
+        for button in buttons:
+            taps = by_kind[TAPS][button] + by_kind[TAP][button]
+            taps.sort(key=lambda g: -g.count)
+            self._buttons[button] = _Button(taps)
+
+
+    def edge(self, button, pressed, stamp):
+        """Handles an edge of the given button at the given monotonic time,
+        dispatching and returning the resulting decision as an (action, phase)
+        tuple, or None if the edge completes nothing."""
+
+        state = self._buttons.get(button)
+        if state is None:
+            return None
+        if pressed == state.down:
+            #repeated edge (missed the one in between); nothing to go on
+            return None
+        state.down = pressed
+
+        if pressed:
+            decision = self._pressed(button, state, stamp)
+        else:
+            decision = self._released(button, state, stamp)
+
+        if decision is not None:
+            self.log.debug('%s %s -> %s %s', button,
+                'press' if pressed else 'release', *decision)
+            self._dispatch(decision[0], decision[1], 0)
+        return decision
+
+
+    def reset(self, button):
+        """Forgets the taps made so far on the given button."""
+        state = self._buttons.get(button)
+        if state is not None:
+            for (gesture, ring) in state.rings:
+                ring.clear()
+
+
+    def _pressed(self, button, state, stamp):
+        state.press_gen += 1
+        state.down_at = stamp
+        state.held = False
+        state.consumed = False
+
+        for chord in self._chords.get(button, ()):
+            if self._buttons[chord.other].down:
+                #pressed as part of a chord, so it's not the start of a hold
+                return None
+
+        hold = self._holds.get(button)
+        if hold is not None:
+            state.timer = self._sched.call_at(stamp + hold.time,
+                self._submit, 'gesture', self._hold_fired, button,
+                state.press_gen, 0)
+
+        presses = self._presses.get(button)
+        if presses:
+            return (presses[0].action, FIRE)
+        return None
+
+
+    def _released(self, button, state, stamp):
+        if state.timer is not None:
+            state.timer.cancel()
+            state.timer = None
+
+        for chord in self._chords.get(button, ()):
+            anchor = self._buttons[chord.other]
+            if anchor.down:
+                anchor.consumed = True
+                return (chord.action, FIRE)
+
+        for chord in self._anchored.get(button, ()):
+            if self._buttons[chord.button].down:
+                #anchor let go before the chord was completed
+                self._buttons[chord.button].consumed = True
+                return (chord.action, BOTCHED)
+
+        if state.held:
+            return (self._holds[button].action, END)
+        if state.consumed:
+            return None
+
+        for (gesture, ring) in state.rings:
+            ring.append(stamp)
+            if len(ring) == gesture.count and (gesture.time is None or
+            stamp - ring[0] <= gesture.time):
+                #completed; start counting afresh, for this and the other
+                #taps gestures on the button
+                for (other, other_ring) in state.rings:
+                    other_ring.clear()
+                return (gesture.action, FIRE)
+
+        releases = self._releases.get(button)
+        if releases:
+            return (releases[0].action, FIRE)
+        return None
+
+
+    def _hold_fired(self, button, press_gen, count):
+        """Handles a hold timer going off.
+
+        Context: controller thread"""
+
+        state = self._buttons[button]
+        if not state.down or state.press_gen != press_gen:
+            #released (or released and pressed again) since
+            return
+
+        hold = self._holds[button]
+        state.held = True
+        self.log.debug('%s held -> %s %s', button, hold.action,
+            FIRE if count == 0 else REPEAT)
+        self._dispatch(hold.action, FIRE if count == 0 else REPEAT, count)
+
+        if hold.repeat is None:
+            state.timer = None
+        else:
+            #timed from the press, so that repeats don't drift
+            state.timer = self._sched.call_at(
+                state.down_at + hold.time + hold.repeat * (count + 1),
+                self._submit, 'gesture', self._hold_fired, button, press_gen,
+                count + 1)
@@ -0,0 +1,137 @@
+"""Watches the music library directory for files being added, replaced,
+renamed, or deleted, using the Linux inotify API through ctypes."""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+import threading
+
+#inotify event masks, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+#header of each event read from an inotify descriptor: wd, mask, cookie, len
+_EVENT_HDR = struct.Struct('iIII')
+
+#changes reported to the callback
+ADDED = 'added'
+CHANGED = 'changed'
+REMOVED = 'removed'
+RENAMED = 'renamed'
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+class LibraryWatcher(object):
+    """Reports changes to the files in a directory. Dot files (which is what
+    editors and copying tools tend to use for files still being written) and
+    subdirectories are ignored.
+
+    Context: callback runs on the watcher thread"""
+
+    def __init__(self, libdir, callback):
+        """Starts watching the given directory (without reporting anything
+        until start() is called).
+
+        Parameters:
+            str libdir: directory to watch
+            callable callback: called for each change with (change, path,
+                new_path), where change is one of ADDED, CHANGED, REMOVED, or
+                RENAMED, and new_path is only set for RENAMED"""
+
+        self.log = logging.getLogger('nplayer.inotify')
+        self.libdir = libdir
+        self._callback = callback
+
+        self._fd = _libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, 'inotify_init1: %s' % os.strerror(err))
+        wd = _libc.inotify_add_watch(self._fd, libdir,
+            IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE |
+            IN_DELETE_SELF)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, 'inotify_add_watch %s: %s' % (libdir,
+                os.strerror(err)))
+
+        self._thread = None
+
+
+    def start(self):
+        """Starts the watcher thread."""
+        self._thread = threading.Thread(target=self._run, name='inotify')
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def _run(self):
+        """Watcher thread body.
+
+        Context: watcher thread"""
+
+        while True:
+            try:
+                buf = os.read(self._fd, 64 * 1024)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            for change in self._parse(buf):
+                try:
+                    self._callback(*change)
+                except Exception:
+                    self.log.exception('error handling library change %r',
+                        change)
+
+
+    def _parse(self, buf):
+        """Turns a buffer of raw inotify events into a list of (change, path,
+        new_path) tuples, pairing up the two halves of renames."""
+
+        changes = []
+        #pending halves of renames, keyed by cookie
+        moved_from = {}
+        offset = 0
+        while offset < len(buf):
+            (wd, mask, cookie, length) = _EVENT_HDR.unpack_from(buf, offset)
+            offset += _EVENT_HDR.size
+            name = buf[offset:offset + length].rstrip('\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                self.log.warning('inotify queue overflowed, changes were lost')
+                continue
+            if mask & IN_DELETE_SELF:
+                self.log.error('library directory %s was deleted',
+                    self.libdir)
+                continue
+            if mask & IN_ISDIR or not name or name.startswith('.'):
+                continue
+
+            path = os.path.join(self.libdir, name)
+            if mask & IN_MOVED_FROM:
+                moved_from[cookie] = len(changes)
+                changes.append((REMOVED, path, None))
+            elif mask & IN_MOVED_TO:
+                idx = moved_from.pop(cookie, None)
+                if idx is None:
+                    changes.append((ADDED, path, None))
+                else:
+                    #both halves of a rename within the directory
+                    changes[idx] = (RENAMED, changes[idx][1], path)
+            elif mask & IN_DELETE:
+                changes.append((REMOVED, path, None))
+            elif mask & IN_CLOSE_WRITE:
+                changes.append((CHANGED, path, None))
+
+        return changes
@@ -0,0 +1,244 @@
+"""Index of the music library: the list of files along with their durations
+and tags. The index is saved to disk so that files only need to be probed by
+GStreamer the first time they're seen (or after they change)."""
+
+import bisect
+import json
+import logging
+import os
+import threading
+
+import gi
+from gi.repository import Gst, GstPbutils
+gi.require_version('Gst', '1.0')
+gi.require_version('GstPbutils', '1.0')
+
+class Library(object):
+    """The files of the music library, in alphabetical order.
+
+    Context: any thread"""
+
+    #version of the on-disk index format
+    INDEX_VERSION = 1
+
+    #maximum time to spend probing any one file, in nanoseconds
+    PROBE_TIMEOUT = 10 * 10**9
+
+    #tags to keep for each file
+    TAGS = (Gst.TAG_TITLE, Gst.TAG_ARTIST, Gst.TAG_ALBUM)
+
+    def __init__(self, libdir, index_path):
+        """Initializes the library (without reading anything yet).
+
+        Parameters:
+            str libdir: directory holding the music files
+            str index_path: path of the on-disk index"""
+
+        self.log = logging.getLogger('nplayer.library')
+        self.libdir = libdir
+        self.index_path = index_path
+
+        #full paths of the files, sorted
+        self.files = []
+        #positions in self.files keyed by file name
+        self._positions = {}
+        #info about each file (size, mtime, duration in ns, tags), keyed by
+        #file name
+        self._info = {}
+
+        #held while changing the file list; self.files is only ever changed in
+        #place, so references to it stay valid
+        self._lock = threading.RLock()
+        #held while probing, so that only one probe thread runs at a time
+        self._probe_lock = threading.Lock()
+
+
+    def scan(self):
+        """Lists the library directory and loads whatever the on-disk index
+        knows about the files. Returns the number of files which need to be
+        probed."""
+
+        names = sorted(os.listdir(self.libdir))
+        saved = self._load()
+
+        with self._lock:
+            self.files[:] = [os.path.join(self.libdir, name) for name in names]
+            self._reindex()
+            self._info = {}
+            stale = 0
+            for name in names:
+                st = os.stat(os.path.join(self.libdir, name))
+                info = saved.get(name)
+                if info is None or info['size'] != st.st_size\
+                or info['mtime'] != st.st_mtime:
+                    #new or changed file
+                    info = self._new_info(st)
+                    stale += 1
+                self._info[name] = info
+
+        self.log.info('%d files in library, %d to probe', len(names), stale)
+        return stale
+
+
+    def probe_async(self, on_probed=None):
+        """Starts probing the files whose durations aren't known yet on a
+        background thread, saving the index when done.
+
+        Parameters:
+            callable on_probed: called with (path, duration in ns) for each
+                file as it is probed
+
+        Context: on_probed is called on the probe thread"""
+
+        worker = threading.Thread(target=self._probe_all, args=(on_probed,),
+            name='library-probe')
+        worker.daemon = True
+        worker.start()
+
+
+    def update(self, path):
+        """Adds the given file to the library, or if it's already there, notes
+        that it has changed. Its duration is unknown until it is probed again.
+        Returns True if the file is new to the library."""
+        name = os.path.basename(path)
+        st = os.stat(path)
+        with self._lock:
+            self._info[name] = self._new_info(st)
+            if name in self._positions:
+                return False
+            bisect.insort(self.files, os.path.join(self.libdir, name))
+            self._reindex()
+            return True
+
+
+    def remove(self, path):
+        """Removes the given file from the library. Returns True if it was in
+        the library."""
+        name = os.path.basename(path)
+        with self._lock:
+            pos = self._positions.get(name)
+            if pos is None:
+                return False
+            del self.files[pos]
+            del self._info[name]
+            self._reindex()
+            return True
+
+
+    def insertion_point(self, path):
+        """Returns the position at which the given file is or would be in
+        self.files."""
+        return bisect.bisect_left(self.files,
+            os.path.join(self.libdir, os.path.basename(path)))
+
+
+    def index_of(self, path):
+        """Returns the position of the given file (full path or just the file
+        name) in self.files, or None if it isn't in the library."""
+        return self._positions.get(os.path.basename(path))
+
+
+    def duration(self, path):
+        """Returns the duration of the given file in nanoseconds, or 0 if it
+        isn't known (yet)."""
+        info = self._info.get(os.path.basename(path))
+        if info is None or info['duration'] is None:
+            return 0
+        return info['duration']
+
+
+    def tags(self, path):
+        """Returns a dict of the tags of the given file."""
+        info = self._info.get(os.path.basename(path))
+        return {} if info is None else info['tags']
+
+
+    def _reindex(self):
+        """Rebuilds the file name to position map. Caller must hold the
+        lock."""
+        self._positions = dict((os.path.basename(path), i)
+            for (i, path) in enumerate(self.files))
+
+
+    @staticmethod
+    def _new_info(st):
+        """Returns the info for a file which hasn't been probed yet, given the
+        result of stat()ing it."""
+        return {'size': st.st_size, 'mtime': st.st_mtime, 'duration': None,
+            'tags': {}}
+
+
+    def _load(self):
+        """Returns the file info from the on-disk index, or an empty dict if
+        there's no usable index."""
+        try:
+            with open(self.index_path) as fh:
+                index = json.load(fh)
+        except (IOError, ValueError) as e:
+            self.log.info('no usable library index at %s (%s)',
+                self.index_path, e)
+            return {}
+        if index.get('version') != self.INDEX_VERSION:
+            return {}
+        return index['files']
+
+
+    def save(self):
+        """Writes the index to disk, replacing the old one atomically."""
+        tmp_path = self.index_path + '.tmp'
+        with self._lock:
+            index = {'version': self.INDEX_VERSION, 'files': dict(self._info)}
+        with open(tmp_path, 'w') as fh:
+            json.dump(index, fh)
+        os.rename(tmp_path, self.index_path)
+
+
+    def _probe_all(self, on_probed):
+        """Probes every file whose duration is unknown.
+
+        Context: probe thread"""
+
+        with self._probe_lock:
+            self._probe_stale(on_probed)
+
+
+    def _probe_stale(self, on_probed):
+        """Probes every file whose duration is unknown. Caller must hold the
+        probe lock.
+
+        Context: probe thread"""
+
+        disc = GstPbutils.Discoverer.new(self.PROBE_TIMEOUT)
+        probed = 0
+        for path in list(self.files):
+            info = self._info.get(os.path.basename(path))
+            if info is None or info['duration'] is not None:
+                continue
+
+            try:
+                dinfo = disc.discover_uri('file://%s' % path)
+            except Exception as e:
+                self.log.warning('failed probing %s: %s', path, e)
+                continue
+
+            info['duration'] = dinfo.get_duration()
+            taglist = dinfo.get_tags()
+            if taglist is not None:
+                for tag in self.TAGS:
+                    (ok, value) = taglist.get_string(tag)
+                    if ok:
+                        info['tags'][tag] = value
+            probed += 1
+
+            self.log.debug('probed %s: duration %d ns', path,
+                info['duration'])
+            if on_probed is not None:
+                on_probed(path, info['duration'])
+
+        if probed:
+            try:
+                self.save()
+            except (IOError, OSError) as e:
+                self.log.error('failed saving library index: %s', e)
+            else:
+                self.log.info('probed %d files, library index saved', probed)
@@ -0,0 +1,216 @@
+"""Non-blocking logging: log records are put on a bounded queue and written
+out by a listener thread, so that logging never blocks the thread doing it on
+the console, journald, or the SD card. When the queue is full, records are
+dropped (and counted) rather than waited on. Also has a JSON formatter, and
+StatusLine for rate limiting the player's periodic status output."""
+
+import atexit
+import json
+import logging
+import Queue
+import sys
+import threading
+
+from nplayer import metrics
+from nplayer.scheduler import monotonic
+
+_DROPPED = metrics.REGISTRY.counter('nplayer_log_dropped',
+    'Log records dropped due to the log queue being full')
+
+#record put on the queue to stop the listener
+_STOP = object()
+
+class QueueHandler(logging.Handler):
+    """Handler which puts records on a bounded queue for a QueueListener,
+    dropping them if it's full.
+
+    Context: any thread"""
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        #records dropped since the listener last reported drops
+        self.dropped = 0
+
+
+    def prepare(self, record):
+        """Renders the record's message and exception text, so that it no
+        longer refers to arguments which may change before it's written."""
+        record.message = record.getMessage()
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+            record.exc_info = None
+        record.msg = record.message
+        record.args = None
+        return record
+
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+            _DROPPED.inc()
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """Thread which writes queued records out to handlers, reporting any
+    records which were dropped in the meantime.
+
+    Context: handlers run on the listener thread"""
+
+    def __init__(self, queue, source, *handlers):
+        """Parameters:
+            Queue.Queue queue: queue to take records from
+            QueueHandler source: handler putting records on the queue, whose
+                drop count is reported
+            handlers: handlers to write records out to"""
+        self.queue = queue
+        self.source = source
+        self.handlers = handlers
+        self._thread = None
+
+
+    def start(self):
+        """Starts the listener thread."""
+        self._thread = threading.Thread(target=self._run, name='log')
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def stop(self, timeout=1.0):
+        """Writes out what's queued (waiting up to timeout seconds), then
+        stops the listener thread."""
+        if self._thread is None:
+            return
+        try:
+            self.queue.put(_STOP, timeout=timeout)
+        except Queue.Full:
+            return
+        self._thread.join(timeout)
+        self._thread = None
+
+
+    def _handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+    def _run(self):
+        """Listener thread body.
+
+        Context: listener thread"""
+
+        while True:
+            record = self.queue.get()
+            if record is _STOP:
+                return
+
+            self._handle(record)
+
+            #report drops once caught up, after the records which were queued
+            #before them
+            dropped = self.source.dropped
+            if dropped and self.queue.empty():
+                self.source.dropped -= dropped
+                self._handle(logging.LogRecord('nplayer.log', logging.WARNING,
+                    __file__, 0, 'dropped %d log messages (queue full)',
+                    (dropped,), None))
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats records as single-line JSON objects."""
+
+    def format(self, record):
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, sort_keys=True)
+
+
+def setup(level, use_json=False, queue_size=1000, stream=sys.stdout):
+    """Sets up the root logger to log through a queue to the given stream,
+    and starts the listener. Returns the listener, which is also stopped at
+    exit.
+
+    Parameters:
+        int level: minimum level to log
+        bool use_json: whether to write JSON lines rather than text
+        int queue_size: most records to hold before dropping them
+        file stream: where to write records"""
+
+    queue = Queue.Queue(queue_size)
+    source = QueueHandler(queue)
+
+    sink = logging.StreamHandler(stream)
+    if use_json:
+        sink.setFormatter(JSONFormatter())
+    else:
+        sink.setFormatter(logging.Formatter(
+            '[%(asctime)s] [%(levelname)3s] %(message)s'))
+
+    root = logging.getLogger()
+    root.addHandler(source)
+    root.setLevel(level)
+
+    listener = QueueListener(queue, source, sink)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+class StatusLine(object):
+    """Rate limiter for a periodically updated status line: it's logged when
+    its key (the part worth knowing about right away, such as the file and
+    whether it's playing) changes, and otherwise at most every interval
+    seconds.
+
+    Context: any one thread at a time"""
+
+    def __init__(self, log, interval):
+        """Parameters:
+            logging.Logger log: logger to log the status line to, at INFO
+            float interval: minimum time between logging the line when its
+                key hasn't changed, in seconds; 0 means only log changes"""
+        self.log = log
+        self.interval = interval
+        self._key = None
+        self._last = None
+
+
+    def update(self, key, text):
+        """Logs the status line text if its key has changed, or if it's due.
+        Returns whether it was logged."""
+        now = monotonic()
+        if key == self._key and (not self.interval or
+        now - self._last < self.interval):
+            return False
+        self._key = key
+        self._last = now
+        self.log.info('%s', text)
+        return True
+
+
+class PrefixAdapter(logging.LoggerAdapter):
+    """Logger adapter which puts a prefix (such as a zone name) in front of
+    every message."""
+
+    def __init__(self, logger, prefix):
+        logging.LoggerAdapter.__init__(self, logger, {'prefix': prefix})
+
+
+    def process(self, msg, kwargs):
+        return ('[%s] %s' % (self.extra['prefix'], msg), kwargs)
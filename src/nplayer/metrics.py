@@ -0,0 +1,261 @@
+"""Counters and latency histograms for watching the player while it runs,
+along with servers which expose a snapshot of them in the Prometheus text
+format, over local HTTP (GET /metrics) and/or a UNIX domain socket (connect
+and read).
+
+Recording is cheap enough for the hot paths: a histogram observation is a
+bisect over a fixed list of bucket bounds and a couple of increments."""
+
+import BaseHTTPServer
+import bisect
+import logging
+import os
+import SocketServer
+import threading
+
+#default histogram bucket upper bounds, in seconds; spans the sub-millisecond
+#work of input callbacks up to multi-second pipeline transitions
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+class Counter(object):
+    """Count of events."""
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+    def samples(self, name, labels):
+        return [(name + '_total', labels, self.value)]
+
+
+class Histogram(object):
+    """Distribution of observed values over fixed buckets."""
+
+    __slots__ = ('bounds', 'counts', 'sum', '_lock')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        #one count per bucket, plus one for values above the last bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[idx] += 1
+            self.sum += value
+
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        result = []
+        cumulative = 0
+        for (bound, count) in zip(self.bounds + ('+Inf',), counts):
+            cumulative += count
+            le = bound if isinstance(bound, str) else repr(bound)
+            result.append((name + '_bucket', labels + (('le', le),),
+                cumulative))
+        result.append((name + '_sum', labels, total))
+        result.append((name + '_count', labels, cumulative))
+        return result
+
+
+class FuncMetric(object):
+    """Metric whose value is read from a callable when rendered, for values
+    which are already kept elsewhere."""
+
+    __slots__ = ('func', 'suffix')
+
+    def __init__(self, func, suffix):
+        self.func = func
+        self.suffix = suffix
+
+
+    def samples(self, name, labels):
+        return [(name + self.suffix, labels, self.func())]
+
+
+class Registry(object):
+    """Set of named metrics, each of which may have several series told apart
+    by labels.
+
+    Context: any thread"""
+
+    def __init__(self):
+        #(kind, help, {labels tuple: metric}) keyed by metric name
+        self._families = {}
+        self._lock = threading.Lock()
+
+
+    def _get(self, name, kind, help, labels, factory):
+        labels = tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = (kind, help, {})
+            elif family[0] != kind:
+                raise ValueError('metric %s is already a %s' % (name,
+                    family[0]))
+            series = family[2]
+            if labels not in series:
+                series[labels] = factory()
+            return series[labels]
+
+
+    def counter(self, name, help, **labels):
+        """Returns the Counter with the given name (without the _total suffix)
+        and labels, creating it if need be."""
+        return self._get(name, COUNTER, help, labels, Counter)
+
+
+    def histogram(self, name, help, bounds=LATENCY_BUCKETS, **labels):
+        """Returns the Histogram with the given name and labels, creating it
+        if need be."""
+        return self._get(name, HISTOGRAM, help, labels,
+            lambda: Histogram(bounds))
+
+
+    def gauge_func(self, name, help, func, **labels):
+        """Registers a gauge whose value is func()."""
+        self._get(name, GAUGE, help, labels, lambda: FuncMetric(func, ''))
+
+
+    def counter_func(self, name, help, func, **labels):
+        """Registers a counter (name without the _total suffix) whose value is
+        func()."""
+        self._get(name, COUNTER, help, labels,
+            lambda: FuncMetric(func, '_total'))
+
+
+    def render(self):
+        """Returns a snapshot of every metric in the Prometheus text exposition
+        format."""
+        with self._lock:
+            families = sorted((name, kind, help, list(series.items()))
+                for (name, (kind, help, series)) in self._families.items())
+
+        lines = []
+        for (name, kind, help, series) in families:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for (labels, metric) in sorted(series):
+                try:
+                    samples = metric.samples(name, labels)
+                except Exception:
+                    logging.getLogger('nplayer.metrics').exception(
+                        'error reading metric %s', name)
+                    continue
+                for (sname, slabels, value) in samples:
+                    lines.append('%s%s %s' % (sname, _format_labels(slabels),
+                        _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\',
+        '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for (key, value) in labels)
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
+
+
+#registry used by the player's modules
+REGISTRY = Registry()
+
+
+class _HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves GET /metrics."""
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, fmt, *args):
+        logging.getLogger('nplayer.metrics').debug('http: ' + fmt, *args)
+
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _SocketHandler(SocketServer.StreamRequestHandler):
+    """Writes a snapshot to each connecting client."""
+
+    def handle(self):
+        self.wfile.write(self.server.registry.render())
+
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class MetricsServer(object):
+    """Serves snapshots of a registry over HTTP and/or a UNIX socket.
+
+    Context: each server runs on its own thread"""
+
+    def __init__(self, registry=REGISTRY, http_addr=None, socket_path=None):
+        """Sets up the servers (without serving anything until start() is
+        called).
+
+        Parameters:
+            Registry registry: the metrics to serve
+            tuple http_addr: (host, port) to serve HTTP on, or None
+            str socket_path: path of the UNIX socket to serve on, or None"""
+
+        self.log = logging.getLogger('nplayer.metrics')
+        self._servers = []
+
+        if http_addr is not None:
+            server = _HTTPServer(http_addr, _HTTPHandler)
+            server.registry = registry
+            self._servers.append(server)
+            self.log.info('serving metrics at http://%s:%d/metrics',
+                *http_addr)
+
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                #left over from a previous run
+                os.unlink(socket_path)
+            server = _UnixServer(socket_path, _SocketHandler)
+            server.registry = registry
+            self._servers.append(server)
+            self.log.info('serving metrics on socket %s', socket_path)
+
+
+    def start(self):
+        """Starts the server threads."""
+        for server in self._servers:
+            thread = threading.Thread(target=server.serve_forever,
+                name='metrics')
+            thread.daemon = True
+            thread.start()
@@ -1,12 +1,24 @@
 """Implements support for the NewHaven Display LCD, controlled via the native
-I2C pins on the Raspberry Pi. Uses RPIO to control the colored backlight LEDs.
+I2C pins on the Raspberry Pi. Uses a GPIO backend (RPIO by default) to control
+the colored backlight LEDs. LCDWriter drives the display from a thread of its
+own, so that nothing else ever waits on the bus.
 """
 
 import time
-import smbus
 import logging
+import threading
 
-import RPIO
+from nplayer import backends, backlight, metrics
+from nplayer.scheduler import monotonic
+
+_OVERWRITE_TIME = metrics.REGISTRY.histogram('nplayer_lcd_overwrite_seconds',
+    'Time taken by full LCD overwrites')
+_RENDER_TIME = metrics.REGISTRY.histogram('nplayer_lcd_render_seconds',
+    'Time taken by LCD renders (diffed updates)')
+_FRAMES_SUPERSEDED = metrics.REGISTRY.counter('nplayer_lcd_frames_superseded',
+    'LCD frames replaced by newer ones before being drawn')
+_I2C_ERRORS = metrics.REGISTRY.counter('nplayer_i2c_errors',
+    'I2C errors talking to the LCD')
 
 class NHD_LCD(object):
     """Controls the NewHaven Display LCD via Raspberry Pi's native I2C support.
@@ -20,6 +32,13 @@ class NHD_LCD(object):
     #used to indicate whether bytes being sent are commands or data
     SEND_CMD = 0x00
     SEND_DATA = 0x40
+    #control byte flag meaning that only one byte follows before the next
+    #control byte (rather than a stream of bytes up to the end of the
+    #transaction), so that commands and data can share a transaction
+    CTRL_CONTINUE = 0x80
+
+    #most bytes an SMBus block write can carry after its first (control) byte
+    BLOCK_MAX = 32
 
     #commands
     CMD_CLEAR_DISP = 0x01 # Clear display
@@ -29,19 +48,58 @@ class NHD_LCD(object):
     CMD_SET_DDRAM  = 0x80 # Set DDRAM address
     CMD_CONTRAST   = 0x70 # Set LCD contrast
 
-    def __init__(self, pin_red, pin_green, pin_blue):
+    #display geometry
+    ROWS = 2
+    COLS = 20
+
+    #runs of changed characters separated by no more than this many unchanged
+    #characters are merged into one write, since repositioning the cursor costs
+    #a transaction of its own
+    MERGE_GAP = 2
+
+    def __init__(self, pin_red, pin_green, pin_blue, bus=None, gpio=None,
+        light=None):
         """Initializes the LCD controller class.
 
         Parameters:
             int pin_{red,green,blue}: pins which control the red, green, and
-                blue backlight LEDs, respectively"""
+                blue backlight LEDs, respectively
+            bus: I2C backend (smbus.SMBus interface); defaults to the Pi's I2C
+                bus
+            gpio: GPIO backend (see backends.py); defaults to RPIO
+            light: backlight driver (see backlight.py); defaults to switching
+                the LEDs on and off"""
 
         self.log = logging.getLogger('nplayer.nhd_lcd')
-        self.bus = smbus.SMBus(self.I2C_BUS)
+        if bus is None:
+            bus = backends.smbus_backend(self.I2C_BUS)
+        if gpio is None:
+            gpio = backends.RPIOBackend()
+        self.bus = bus
+        self.gpio = gpio
 
         self.pin_red = pin_red
         self.pin_green = pin_green
         self.pin_blue = pin_blue
+        if light is None:
+            light = backlight.SwitchedBacklight(gpio,
+                (pin_red, pin_green, pin_blue))
+        self.light = light
+
+        #in-memory copy of the display contents, one list of characters per
+        #row; None when the display contents are unknown (before init)
+        self._shadow = None
+
+        #current position of the cursor, as tracked by our own writes
+        self._cur_row = 0
+        self._cur_col = 0
+
+        #I2C traffic counters; "saved" counts are relative to what a full
+        #overwrite() of the same frame would have cost
+        self.stat_bytes = 0
+        self.stat_trans = 0
+        self.stat_bytes_saved = 0
+        self.stat_trans_saved = 0
 
 
     def init(self):
@@ -58,25 +116,40 @@ class NHD_LCD(object):
             lcd_init_values)
         time.sleep(0.001)
 
+        #init sequence ends with a clear
+        self._reset_shadow()
+
         #set up the LED control pins
         self.log.debug('setting up LED control pins')
-        for pin in (self.pin_red, self.pin_green, self.pin_blue):
-            RPIO.setup(pin, RPIO.OUT)
+        self.light.init()
 
 
     def _send_cmd(self, cmd):
         """Sends the given command (given as hex code) to the LCD."""
         self.bus.write_byte_data(self.DEV_ADDR, self.SEND_CMD, cmd)
+        self.stat_bytes += 2
+        self.stat_trans += 1
+
+
+    def _reset_shadow(self):
+        """Marks the shadow copy as blank with the cursor at home, matching the
+        state of the display after a clear."""
+        self._shadow = [[' '] * self.COLS for _ in range(self.ROWS)]
+        self._cur_row = 0
+        self._cur_col = 0
 
 
     def clear(self):
         """Clears the LCD screen."""
         self._send_cmd(self.CMD_CLEAR_DISP)
+        self._reset_shadow()
 
 
     def home(self):
         """Returns the cursor to the home position (0,0)."""
         self._send_cmd(self.CMD_HOME)
+        self._cur_row = 0
+        self._cur_col = 0
 
 
     def set_cur_pos(self, row, col):
@@ -86,10 +159,60 @@ class NHD_LCD(object):
             int row: zero-indexed row (zero is top); valid range: 0-1
             int col: zero-indexed column (zero is left); valid range: 0-19"""
 
+        self._send_cmd(self._ddram_cmd(row, col))
+        self._cur_row = row
+        self._cur_col = col
+
+
+    def _ddram_cmd(self, row, col):
+        """Returns the command which sets the cursor position."""
         base = self.CMD_SET_DDRAM + col
         if row > 0:
             base += 0x40
-        self._send_cmd(base)
+        return base
+
+
+    def _send_packed(self, items):
+        """Sends a series of commands and data bytes, given as (is data, byte)
+        tuples, in as few transactions as possible."""
+        txn = []
+        for item in items:
+            if txn and len(self._encode(txn + [item])) > 1 + self.BLOCK_MAX:
+                self._send_block(self._encode(txn))
+                txn = []
+            txn.append(item)
+        if txn:
+            self._send_block(self._encode(txn))
+
+
+    def _encode(self, items):
+        """Encodes (is data, byte) tuples as one transaction's bytes: each byte
+        gets a control byte of its own, except for the trailing run of bytes of
+        the same kind, which are streamed after a single control byte."""
+        tail = len(items) - 1
+        while tail > 0 and items[tail - 1][0] == items[-1][0]:
+            tail -= 1
+        encoded = []
+        for (is_data, byte) in items[:tail]:
+            encoded.append(self.CTRL_CONTINUE |
+                (self.SEND_DATA if is_data else self.SEND_CMD))
+            encoded.append(byte)
+        encoded.append(self.SEND_DATA if items[-1][0] else self.SEND_CMD)
+        encoded.extend(byte for (is_data, byte) in items[tail:])
+        return encoded
+
+
+    def _send_block(self, encoded):
+        """Sends one encoded transaction."""
+        self.bus.write_i2c_block_data(self.DEV_ADDR, encoded[0], encoded[1:])
+        self.stat_bytes += len(encoded)
+        self.stat_trans += 1
+
+
+    def invalidate(self):
+        """Forgets what the display shows (as after a bus error), so that the
+        next render() redraws it in full."""
+        self._shadow = None
 
 
     def write(self, text):
@@ -97,24 +220,223 @@ class NHD_LCD(object):
         and is limited to ASCII characters."""
         ordtext = [ord(letter) for letter in text]
         self.bus.write_i2c_block_data(self.DEV_ADDR, self.SEND_DATA, ordtext)
+        self.stat_bytes += 1 + len(ordtext)
+        self.stat_trans += 1
+
+        #keep the shadow copy in step with what landed in DDRAM
+        if self._shadow is not None:
+            row = self._shadow[self._cur_row]
+            for letter in text:
+                if self._cur_col < self.COLS:
+                    row[self._cur_col] = letter
+                self._cur_col += 1
 
 
     def overwrite(self, line1, line2):
         """Clears the LCD, goes to home, and writes two lines of text."""
+        start = monotonic()
         self.clear()
         self.home()
         self.write(line1)
         self.set_cur_pos(1, 0)
         self.write(line2)
+        _OVERWRITE_TIME.observe(monotonic() - start)
+
+
+    def render(self, line1, line2):
+        """Brings the display to show the given two lines of text, sending only
+        the runs of characters which differ from what is already displayed,
+        packed together with the cursor moves between them into as few
+        transactions as possible.
+
+        Lines longer than the display are truncated, shorter ones are padded
+        with spaces."""
+
+        lines = (line1, line2)
+        if self._shadow is None:
+            #contents unknown, so there's nothing to diff against
+            self.overwrite(*[line[:self.COLS] for line in lines])
+            return
+
+        began = monotonic()
+        bytes_before = self.stat_bytes
+        trans_before = self.stat_trans
+
+        items = []
+        cursor = (self._cur_row, self._cur_col)
+        for row, line in enumerate(lines):
+            want = line[:self.COLS].ljust(self.COLS)
+            for (start, end) in self._diff_runs(self._shadow[row], want):
+                if cursor != (row, start):
+                    items.append((False, self._ddram_cmd(row, start)))
+                items.extend((True, ord(letter))
+                    for letter in want[start:end])
+                self._shadow[row][start:end] = want[start:end]
+                cursor = (row, end)
+
+        #should sending fail part way through, the caller must invalidate()
+        self._send_packed(items)
+        (self._cur_row, self._cur_col) = cursor
+
+        #what overwrite() would have sent: clear, home, line 1, cursor move,
+        #line 2 (as 2-byte commands and block writes with a control byte), with
+        #the lines truncated to the display's width
+        full_bytes = 2 + 2 + sum(1 + min(len(line), self.COLS)
+            for line in lines) + 2
+        self.stat_bytes_saved += full_bytes - (self.stat_bytes - bytes_before)
+        self.stat_trans_saved += 5 - (self.stat_trans - trans_before)
+        _RENDER_TIME.observe(monotonic() - began)
+
+
+    def _diff_runs(self, have, want):
+        """Returns a list of (start, end) column ranges in which the displayed
+        characters (have) differ from the desired ones (want), with runs closer
+        than MERGE_GAP merged together."""
+
+        runs = []
+        start = None
+        last = None
+        for col in range(self.COLS):
+            if have[col] == want[col]:
+                continue
+            if start is not None and col - last - 1 <= self.MERGE_GAP:
+                last = col
+            else:
+                if start is not None:
+                    runs.append((start, last + 1))
+                start = last = col
+        if start is not None:
+            runs.append((start, last + 1))
+        return runs
 
 
     def set_backlight(self, r, g, b):
         """Sets the state of the backlight LEDs.
 
         Parameters:
-            bool r, g, b: enables or disables each colored backlight LED;
+            float r, g, b: level (0 to 1) of each colored backlight LED;
                 combine the three primary colors to make other colors."""
 
-        RPIO.output(self.pin_red, bool(r))
-        RPIO.output(self.pin_green, bool(g))
-        RPIO.output(self.pin_blue, bool(b))
+        self.light.apply(backlight.Effect(backlight.STEADY,
+            (float(r), float(g), float(b)), 0))
+
+
+    def set_backlight_effect(self, effect):
+        """Shows the given backlight.Effect."""
+        self.light.apply(effect)
+
+
+class LCDWriter(object):
+    """Thread which owns the LCD and brings it to show the latest requested
+    screen and backlight. Requests never wait on the bus; frames requested
+    faster than they can be drawn are skipped, only the latest being drawn.
+    Bus errors are retried with exponential backoff, reinitializing the
+    display first.
+
+    Context: show() may be called from any thread"""
+
+    #delays between retries after bus errors, in float seconds
+    RETRY_MIN = 0.05
+    RETRY_MAX = 5.0
+
+    def __init__(self, lcd):
+        """Sets up the writer for the given NHD_LCD (without touching it until
+        start() is called)."""
+
+        self.log = logging.getLogger('nplayer.nhd_lcd')
+        self.lcd = lcd
+
+        self._cond = threading.Condition()
+        #requested screen lines and backlight effect
+        self._want_lines = None
+        self._want_backlight = None
+        #what was last successfully put on the display
+        self._shown_lines = None
+        self._shown_backlight = None
+        self._dirty = True
+        self._need_init = True
+
+
+    def start(self):
+        """Starts the writer thread, which initializes the display."""
+        thread = threading.Thread(target=self._run, name='lcd')
+        thread.daemon = True
+        thread.start()
+
+
+    def show(self, lines=None, backlight=None):
+        """Requests the display show the given lines (a (line1, line2) tuple)
+        and backlight.Effect. Either may be None to leave it as last
+        requested."""
+        with self._cond:
+            if lines is not None:
+                if self._dirty and self._want_lines is not None\
+                and self._want_lines != self._shown_lines\
+                and lines != self._want_lines:
+                    _FRAMES_SUPERSEDED.inc()
+                self._want_lines = tuple(lines)
+            if backlight is not None:
+                self._want_backlight = backlight
+            self._dirty = True
+            self._cond.notify()
+
+
+    def _run(self):
+        """Writer thread body.
+
+        Context: LCD writer thread"""
+
+        delay = self.RETRY_MIN
+        while True:
+            with self._cond:
+                while not self._dirty:
+                    self._cond.wait()
+                self._dirty = False
+                lines = self._want_lines
+                backlight = self._want_backlight
+
+            try:
+                self._apply(lines, backlight)
+            except IOError as e:
+                _I2C_ERRORS.inc()
+                self.log.warning('LCD I2C error, retrying in %.2f s: %s',
+                    delay, e)
+                self.lcd.invalidate()
+                self._shown_lines = None
+                self._need_init = True
+                time.sleep(delay)
+                delay = min(delay * 2, self.RETRY_MAX)
+                with self._cond:
+                    self._dirty = True
+            else:
+                delay = self.RETRY_MIN
+
+
+    def _apply(self, lines, backlight):
+        """Brings the display in line with the given request.
+
+        Context: LCD writer thread"""
+
+        if self._need_init:
+            self.lcd.init()
+            self._need_init = False
+            self._shown_backlight = None
+        #the backlight is the quicker, and the more noticeable, so goes first
+        if backlight is not None and backlight != self._shown_backlight:
+            self.lcd.set_backlight_effect(backlight)
+            self._shown_backlight = backlight
+        if lines is not None and lines != self._shown_lines:
+            self.lcd.render(*lines)
+            self._shown_lines = lines
+
+
+class NullWriter(object):
+    """Stands in for LCDWriter where there's no LCD, discarding everything
+    shown."""
+
+    def start(self):
+        pass
+
+
+    def show(self, lines=None, backlight=None):
+        pass
@@ -0,0 +1,285 @@
+"""Cache of music files decoded to raw PCM. Files are decoded once, in the
+background, into WAV files (raw PCM with a header, so they can be played and
+seeked without any decoding). Cached files in use are memory-mapped so that
+their pages are kept in RAM instead of being re-read from the SD card."""
+
+import collections
+import ctypes
+import ctypes.util
+import hashlib
+import logging
+import mmap
+import os
+import Queue
+import threading
+
+import gi
+from gi.repository import Gst
+gi.require_version('Gst', '1.0')
+
+#posix_fadvise(2) advice asking the kernel to start reading a file in
+POSIX_FADV_WILLNEED = 3
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _fadvise = _libc.posix_fadvise
+    _fadvise.argtypes = [ctypes.c_int, ctypes.c_long, ctypes.c_long,
+        ctypes.c_int]
+except (OSError, AttributeError, TypeError):
+    _fadvise = None
+
+class PCMCache(object):
+    """Size-capped, least recently used cache of decoded music files.
+
+    Context: any thread; decoding happens on the cache's worker threads"""
+
+    #decoding pipeline; the output format is fixed so that every cached file
+    #can be played the same way
+    DECODE_PIPELINE = ('filesrc name=src ! decodebin ! audioconvert ! '
+        'audioresample ! audio/x-raw,format=S16LE,rate=44100,channels=2 ! '
+        'wavenc ! filesink name=sink')
+
+    #suffix for cache files, and for files being decoded
+    SUFFIX = '.wav'
+    TMP_SUFFIX = '.part'
+
+    def __init__(self, cache_dir, max_bytes, workers=1, max_maps=3,
+        on_ready=None):
+        """Initializes the cache, picking up any files cached by earlier runs.
+
+        Parameters:
+            str cache_dir: directory to keep decoded files in
+            int max_bytes: maximum total size of decoded files
+            int workers: number of decoding threads
+            int max_maps: maximum number of cached files to keep mapped
+            callable on_ready: called with the original path whenever a file
+                has finished decoding
+
+        Context: any thread"""
+
+        self.log = logging.getLogger('nplayer.pcmcache')
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_maps = max_maps
+        self._on_ready = on_ready
+
+        #cached files keyed by cache key, in order from least to most recently
+        #used, each value being the size of the cached file
+        self._entries = collections.OrderedDict()
+        self._total = 0
+        #memory maps of recently used cache files, keyed by cache key
+        self._maps = collections.OrderedDict()
+        #cache keys which are queued or being decoded
+        self._pending = set()
+        #cache keys of files which failed to decode or don't fit in the cache,
+        #which aren't tried again
+        self._skip = set()
+        self._lock = threading.Lock()
+
+        self.stat_hits = 0
+        self.stat_misses = 0
+        self.stat_evictions = 0
+        self.stat_decoded = 0
+        self.stat_failed = 0
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self._load()
+
+        self._queue = Queue.Queue()
+        for i in range(max(1, workers)):
+            worker = threading.Thread(target=self._work,
+                name='pcmcache-%d' % i)
+            worker.daemon = True
+            worker.start()
+
+
+    def lookup(self, path):
+        """Returns the path of the decoded copy of the given file, or None if
+        it hasn't been decoded yet (in which case decoding is queued, unless
+        the file has gone away)."""
+        try:
+            key = self._key(path)
+        except OSError:
+            #removed or renamed since; there is no copy to be had
+            return None
+        with self._lock:
+            if key in self._entries:
+                self.stat_hits += 1
+                self._entries[key] = self._entries.pop(key)
+                cpath = self._cache_path(key)
+                self._map(key, cpath)
+                return cpath
+
+            self.stat_misses += 1
+            self._queue_decode(key, path)
+            return None
+
+
+    def warm(self, paths):
+        """Queues decoding of any of the given files which aren't cached yet,
+        in the given order, skipping any which have gone away."""
+        with self._lock:
+            for path in paths:
+                try:
+                    key = self._key(path)
+                except OSError:
+                    continue
+                if key not in self._entries:
+                    self._queue_decode(key, path)
+
+
+    def stats(self):
+        """Returns a dict of cache statistics."""
+        with self._lock:
+            return {
+                'hits': self.stat_hits,
+                'misses': self.stat_misses,
+                'evictions': self.stat_evictions,
+                'decoded': self.stat_decoded,
+                'failed': self.stat_failed,
+                'entries': len(self._entries),
+                'bytes': self._total,
+            }
+
+
+    @staticmethod
+    def _key(path):
+        """Returns the cache key for a file: a hash of its path, modification
+        time, and size, so that a changed file is decoded again."""
+        st = os.stat(path)
+        return hashlib.sha1('%s\0%r\0%d' % (os.path.abspath(path),
+            st.st_mtime, st.st_size)).hexdigest()
+
+
+    def _cache_path(self, key):
+        """Returns the path of the cache file for the given key."""
+        return os.path.join(self.cache_dir, key + self.SUFFIX)
+
+
+    def _load(self):
+        """Picks up files cached by earlier runs, in order of last use, and
+        cleans up any partial decodes."""
+        found = []
+        for name in os.listdir(self.cache_dir):
+            fpath = os.path.join(self.cache_dir, name)
+            if name.endswith(self.TMP_SUFFIX):
+                os.unlink(fpath)
+            elif name.endswith(self.SUFFIX):
+                st = os.stat(fpath)
+                found.append((st.st_mtime, name[:-len(self.SUFFIX)],
+                    st.st_size))
+
+        #the modification time of cache files is bumped whenever they're used
+        for (mtime, key, size) in sorted(found):
+            self._entries[key] = size
+            self._total += size
+        self.log.info('%d decoded files (%d MiB) in cache', len(self._entries),
+            self._total / 2**20)
+        self._trim()
+
+
+    def _map(self, key, cpath):
+        """Maps the given cache file into memory and asks the kernel to read it
+        in, unmapping the least recently used files beyond max_maps. Caller
+        must hold the lock."""
+
+        if key in self._maps:
+            self._maps[key] = self._maps.pop(key)
+            return
+
+        with open(cpath, 'rb') as fh:
+            self._maps[key] = mmap.mmap(fh.fileno(), 0,
+                access=mmap.ACCESS_READ)
+            if _fadvise is not None:
+                _fadvise(fh.fileno(), 0, 0, POSIX_FADV_WILLNEED)
+        #record the use, so that the LRU order survives restarts
+        os.utime(cpath, None)
+
+        while len(self._maps) > self.max_maps:
+            self._maps.popitem(last=False)[1].close()
+
+
+    def _queue_decode(self, key, path):
+        """Queues decoding of the given file unless it's already queued. Caller
+        must hold the lock."""
+        if key not in self._pending and key not in self._skip:
+            self._pending.add(key)
+            self._queue.put((key, path))
+
+
+    def _work(self):
+        """Decoding worker thread body.
+
+        Context: cache worker thread"""
+
+        while True:
+            (key, path) = self._queue.get()
+            try:
+                size = self._decode(path, self._cache_path(key))
+            except Exception:
+                self.log.exception('error decoding %s', path)
+                size = None
+
+            with self._lock:
+                self._pending.discard(key)
+                if size is None:
+                    self.stat_failed += 1
+                    self._skip.add(key)
+                    continue
+                if size > self.max_bytes:
+                    self.log.warning('decoded %s is larger than the whole '
+                        'cache, not caching it', path)
+                    self._skip.add(key)
+                    os.unlink(self._cache_path(key))
+                    continue
+                self.stat_decoded += 1
+                self._entries[key] = size
+                self._total += size
+                self._trim()
+
+            self.log.info('decoded %s into cache (%d MiB)', path,
+                size / 2**20)
+            if self._on_ready is not None:
+                self._on_ready(path)
+
+
+    def _decode(self, path, cpath):
+        """Decodes the given file to the given cache path. Returns the size of
+        the decoded file, or None on failure."""
+
+        tmp_path = cpath + self.TMP_SUFFIX
+        pipe = Gst.parse_launch(self.DECODE_PIPELINE)
+        pipe.get_by_name('src').set_property('location', path)
+        pipe.get_by_name('sink').set_property('location', tmp_path)
+
+        pipe.set_state(Gst.State.PLAYING)
+        msg = pipe.get_bus().timed_pop_filtered(Gst.CLOCK_TIME_NONE,
+            Gst.MessageType.EOS | Gst.MessageType.ERROR)
+        pipe.set_state(Gst.State.NULL)
+
+        if msg.type == Gst.MessageType.ERROR:
+            (err, debug) = msg.parse_error()
+            self.log.error('failed decoding %s: %s (%s)', path, err.message,
+                debug)
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            return None
+
+        os.rename(tmp_path, cpath)
+        return os.path.getsize(cpath)
+
+
+    def _trim(self):
+        """Evicts least recently used files until the cache is within its size
+        limit. Caller must hold the lock."""
+        while self._total > self.max_bytes and self._entries:
+            (key, size) = self._entries.popitem(last=False)
+            self._total -= size
+            self.stat_evictions += 1
+            mapping = self._maps.pop(key, None)
+            if mapping is not None:
+                mapping.close()
+            #a pipeline still playing the file keeps its open handle
+            os.unlink(self._cache_path(key))
+            self.log.debug('evicted %s from cache', key)
@@ -0,0 +1,266 @@
+"""Pool of GStreamer playback pipelines kept prerolled on standby, so that
+starting to play or switching files doesn't have to wait on opening the file,
+setting up decoders, and opening the audio sink.
+
+Pipelines are either playbins, which pick the elements to play each file with
+by probing it, or manual pipelines, a fixed chain of elements given up front:
+    filesrc ! DECODER ! audioconvert ! audioresample ! FILTER ! SINK
+which start up faster and take less memory, but only play the kind of file
+their decoder is for."""
+
+import collections
+import logging
+import threading
+
+import gi
+from gi.repository import Gst
+gi.require_version('Gst', '1.0')
+
+#decoder for manual pipelines playing a decoded (WAV) copy of their file
+PCM_DECODER = 'wavparse'
+
+def is_playbin(pipe):
+    """Returns whether the given pipeline is a playbin, rather than a manual
+    pipeline."""
+    factory = pipe.get_factory()
+    return factory is not None and factory.get_name() == 'playbin'
+
+
+def rewind(pipe):
+    """Stops the given pipeline and returns it to standby: paused and prerolled
+    at the start of its file. Doesn't wait for the pipeline to get there."""
+    pipe.set_state(Gst.State.PAUSED)
+    pipe.seek_simple(Gst.Format.TIME,
+        Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE, 0)
+
+
+class PipelinePool(object):
+    """Keeps up to a fixed number of pipelines, one per file, paused at the
+    start of their file. The active pipeline is never evicted, nor are pinned
+    ones; otherwise the least recently used pipelines are evicted first.
+
+    Context: any thread"""
+
+    def __init__(self, size, resolve=None, make_sink=None, make_filter=None,
+        on_add=None, on_remove=None, decoder=None):
+        """Initializes the pool.
+
+        Parameters:
+            int size: maximum number of pipelines to keep (at least 1)
+            callable resolve: called with a file path when creating its
+                pipeline; may return the path of another file to actually play
+                in its place (such as a decoded copy), or None to play the file
+                itself; for manual pipelines, the other file must be a WAV
+                file
+            callable make_sink: called to create the audio sink for each
+                pipeline; may return None to let GStreamer pick one
+            callable make_filter: called to create the audio filter (such as a
+                volume element) for each pipeline; may return None for none
+            callable on_add: called with (path, pipeline) when a pipeline is
+                created, before it starts prerolling
+            callable on_remove: called with (path, pipeline) when a pipeline is
+                evicted, after it has been shut down
+            str decoder: decoding elements for manual pipelines, in
+                gst-launch syntax (such as "mpegaudioparse ! mpg123audiodec"),
+                or None to use playbins"""
+
+        self.log = logging.getLogger('nplayer.pipeline')
+        self.size = max(1, size)
+        self._resolve = resolve
+        self._make_sink = make_sink
+        self._make_filter = make_filter
+        self._on_add = on_add
+        self._on_remove = on_remove
+        self._decoder = decoder
+
+        #pipelines keyed by file path, in order from least to most recently
+        #used
+        self._pipes = collections.OrderedDict()
+        #path of the active pipeline
+        self._active = None
+        #pipelines kept from being evicted to make room
+        self._pinned = set()
+        self._lock = threading.RLock()
+
+
+    def activate(self, path):
+        """Makes the pipeline for the given file the active one, creating it if
+        it isn't already on standby, and returns it."""
+        with self._lock:
+            self._active = path
+            pipe = self._get(path)
+            self._trim()
+            return pipe
+
+
+    def prefetch(self, paths):
+        """Makes sure that pipelines for the given files are prerolled on
+        standby, as far as the pool size allows. Earlier paths take priority
+        over later ones."""
+        with self._lock:
+            #the active and pinned pipelines always take a slot
+            room = self.size - len([path for (path, pipe) in
+                self._pipes.items()
+                if path == self._active or pipe in self._pinned])
+            for path in paths:
+                if room <= 0:
+                    break
+                if path == self._active:
+                    continue
+                room -= 1
+                self._get(path)
+
+            #touch the requested files again in reverse order so that the
+            #most important ones end up most recently used
+            for path in reversed(paths[:self.size]):
+                if path in self._pipes:
+                    self._pipes[path] = self._pipes.pop(path)
+            self._trim()
+
+
+    def discard(self, path):
+        """Evicts the pipeline for the given file, if there is one (even if it
+        is the active one; activate() will create a fresh one)."""
+        with self._lock:
+            if path in self._pipes:
+                self._evict(path)
+
+
+    def rename(self, old_path, new_path):
+        """Notes that a file has been renamed, so that its pipeline (which
+        keeps the file open) is found under the new name. Any pipeline for a
+        file it replaced is evicted (even if it is the active one)."""
+        with self._lock:
+            if new_path != old_path and new_path in self._pipes:
+                self._evict(new_path)
+            if old_path in self._pipes:
+                self._pipes[new_path] = self._pipes.pop(old_path)
+            if self._active == old_path:
+                self._active = new_path
+
+
+    def pin(self, pipe):
+        """Keeps the given pipeline from being evicted to make room (as while
+        it fades out once another file's pipeline is the active one), until
+        it's unpinned. It can still be discarded."""
+        with self._lock:
+            self._pinned.add(pipe)
+
+
+    def unpin(self, pipe):
+        """Lets the given pipeline be evicted to make room again, evicting
+        pipelines beyond the pool size."""
+        with self._lock:
+            self._pinned.discard(pipe)
+            self._trim()
+
+
+    def pipelines(self):
+        """Returns a list of the pipelines in the pool."""
+        with self._lock:
+            return self._pipes.values()
+
+
+    def uri(self, path):
+        """Returns the URI a pipeline plays the given file from, which may be
+        that of another file in its place (see resolve)."""
+        src_path = None
+        if self._resolve is not None:
+            src_path = self._resolve(path)
+        if src_path is None:
+            src_path = path
+        return 'file://%s' % src_path
+
+
+    def _get(self, path):
+        """Returns the pipeline for the given file, creating it if needed, and
+        marks it most recently used. Caller must hold the lock."""
+        pipe = self._pipes.pop(path, None)
+        if pipe is None:
+            pipe = self._create(path)
+        self._pipes[path] = pipe
+        return pipe
+
+
+    def _create(self, path):
+        """Creates a pipeline for the given file and starts it prerolling."""
+        if self._decoder is None:
+            pipe = self._create_playbin(path)
+        else:
+            pipe = self._create_manual(path)
+        if self._on_add is not None:
+            self._on_add(path, pipe)
+        #goes to PAUSED asynchronously; the sink opens as part of prerolling
+        pipe.set_state(Gst.State.PAUSED)
+        return pipe
+
+
+    def _create_playbin(self, path):
+        """Returns a playbin for the given file."""
+        uri = self.uri(path)
+        self.log.debug('prerolling pipeline for %s (from %s)', path, uri)
+
+        pipe = Gst.ElementFactory.make('playbin', None)
+        pipe.set_property('uri', uri)
+        if self._make_sink is not None:
+            sink = self._make_sink()
+            if sink is not None:
+                pipe.set_property('audio-sink', sink)
+        if self._make_filter is not None:
+            audio_filter = self._make_filter()
+            if audio_filter is not None:
+                pipe.set_property('audio-filter', audio_filter)
+        return pipe
+
+
+    def _create_manual(self, path):
+        """Returns a manual pipeline for the given file."""
+        src_path = None
+        if self._resolve is not None:
+            src_path = self._resolve(path)
+        if src_path is None:
+            src_path = path
+            decoder = self._decoder
+        else:
+            decoder = PCM_DECODER
+        self.log.debug('prerolling manual pipeline for %s (from %s)', path,
+            src_path)
+
+        pipe = Gst.parse_launch('filesrc name=src ! %s ! audioconvert ! '
+            'audioresample name=resample' % decoder)
+        pipe.get_by_name('src').set_property('location', src_path)
+        tail = [pipe.get_by_name('resample')]
+        if self._make_filter is not None:
+            tail.append(self._make_filter())
+        sink = None
+        if self._make_sink is not None:
+            sink = self._make_sink()
+        if sink is None:
+            sink = Gst.ElementFactory.make('autoaudiosink', None)
+        tail.append(sink)
+        tail = [element for element in tail if element is not None]
+        for (upstream, element) in zip(tail, tail[1:]):
+            pipe.add(element)
+            upstream.link(element)
+        return pipe
+
+
+    def _evict(self, path):
+        """Shuts down and forgets the pipeline for the given file. Caller must
+        hold the lock."""
+        self.log.debug('evicting pipeline for %s', path)
+        pipe = self._pipes.pop(path)
+        self._pinned.discard(pipe)
+        pipe.set_state(Gst.State.NULL)
+        if self._on_remove is not None:
+            self._on_remove(path, pipe)
+
+
+    def _trim(self):
+        """Evicts least recently used pipelines until the pool is down to size.
+        Caller must hold the lock."""
+        for path in list(self._pipes):
+            if len(self._pipes) <= self.size:
+                break
+            if path != self._active and self._pipes[path] not in self._pinned:
+                self._evict(path)
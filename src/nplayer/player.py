@@ -2,34 +2,84 @@
 
 import time
 import logging
-import sys
 import os
 import threading
-import subprocess
+import functools
+import collections
 
-import RPIO
 import gi
 from gi.repository import GObject, Gst
 gi.require_version('Gst', '1.0')
 
-from nplayer import nhd_lcd
+from nplayer import (backends, backlight, control, events, gestures,
+    inotify, library, logqueue, metrics, nhd_lcd, pcmcache, pipeline,
+    recorder, remote, scheduler, sequence, startup, state, transport, volume,
+    watchdog)
 
 #error handling:
 #-errors trying to cancel a timer which isn't started
 #-errors with Gstreamer state transitions
-#-current method in _rw_held/_ff_held of resetting the timer for another round
-#only if the button is still down is not perfect. It is technically possible
-#somebody could hit the button at exactly the right frequency so that the system
-#would think it was down the whole time, but this is incredibly unlikely.
+
+#hot path timings and event counts
+_INPUT_CB_TIME = metrics.REGISTRY.histogram('nplayer_input_callback_seconds',
+    'Time taken by GPIO input callbacks')
+_EDGE_TIME = metrics.REGISTRY.histogram('nplayer_edge_seconds',
+    'Time taken handling input edges, including any resulting actions')
+_UPDATE_TIME = metrics.REGISTRY.histogram('nplayer_update_seconds',
+    'Time taken by each pass of the display update loop')
+_SCENE_TAPS = metrics.REGISTRY.counter('nplayer_scene_taps',
+    'Scene button releases while scene input was enabled')
+_SCENE_TRIGGERS = metrics.REGISTRY.counter('nplayer_scene_triggers',
+    'Times playing was started from the scene button')
+_BOTCHED_SWITCHES = metrics.REGISTRY.counter('nplayer_botched_switches',
+    'File switch attempts botched by releasing play before ff/rw')
+_EOS = metrics.REGISTRY.counter('nplayer_eos',
+    'Times the current file played to its end')
 
 class NativityPlayer(object):
     """Implementation class of the music player."""
 
-    def __init__(self, cfg):
-        """Initializes the player. cfg is a ConfigParser.ConfigParser instance
-        containing the player configuration."""
+    #interval at which to log internal statistics, in seconds
+    STATS_INTERVAL = 600
+
+    #time over which to ramp to a newly set volume while playing, in seconds
+    VOLUME_RAMP = 0.05
 
-        self.log = logging.getLogger('nplayer')
+    #window over which the watchdog's recoveries count towards giving up, in
+    #seconds
+    RECOVERY_WINDOW = 60
+
+    def __init__(self, cfg, gpio=None, i2c=None, shared=None, name=None,
+        on_ready=None):
+        """Initializes the player. cfg is a ConfigParser.ConfigParser instance
+        containing the player configuration. gpio and i2c are the GPIO and I2C
+        backends to use (see backends.py); they default to the Pi's
+        hardware.
+
+        When running as one of several zones (see zones.py), shared is the
+        zones.Shared scheduler, controller, and event loop to use; these, GPIO
+        interrupt handling, and serving metrics are then started by the
+        zones' owner rather than by start(). name is the zone's name, for
+        logging and metrics. on_ready is called with the player (on the
+        controller thread) once it's ready to play; by default, systemd is
+        told."""
+
+        self.name = name
+        if name is None:
+            self.log = logging.getLogger('nplayer')
+        else:
+            self.log = logqueue.PrefixAdapter(
+                logging.getLogger('nplayer.zone.%s' % name), name)
+        #labels for the player's own metrics, and the name code of its
+        #flight recorder events
+        self._labels = {} if name is None else {'zone': name}
+        self._rec_source = recorder.RECORDER.name(name or '')
+        self._shared = shared
+        self._on_ready = on_ready
+
+        if gpio is None:
+            gpio = backends.RPIOBackend()
+        self.gpio = gpio
 
         ## load up confguration
 
@@ -50,30 +100,85 @@ class NativityPlayer(object):
         self.pin_led_green = cfg.getint('lcd', 'pin_green')
         self.pin_led_blue = cfg.getint('lcd', 'pin_blue')
 
-        #LCD color LED backlight colors
+        #whether there's an LCD
+        self.lcd_enabled = cfg.getboolean('lcd', 'enabled')
+
+        #whether to drive the backlight LEDs with PWM, allowing for levels and
+        #effects
+        self.backlight_pwm = cfg.getboolean('lcd', 'pwm')
+
+        #LCD color LED backlight colors (backlight.Effect instances)
         self.color_scene_tap =\
-            self._color_int2tuple(cfg.getint('lcd', 'color_scene_tap'))
+            backlight.parse_effect(cfg.get('lcd', 'color_scene_tap'))
         self.color_playing =\
-            self._color_int2tuple(cfg.getint('lcd', 'color_playing'))
+            backlight.parse_effect(cfg.get('lcd', 'color_playing'))
         self.color_stop_manu =\
-            self._color_int2tuple(cfg.getint('lcd', 'color_stop_manu'))
+            backlight.parse_effect(cfg.get('lcd', 'color_stop_manu'))
         self.color_stop_auto =\
-            self._color_int2tuple(cfg.getint('lcd', 'color_stop_auto'))
+            backlight.parse_effect(cfg.get('lcd', 'color_stop_auto'))
         self.color_play_err =\
-            self._color_int2tuple(cfg.getint('lcd', 'color_play_err'))
+            backlight.parse_effect(cfg.get('lcd', 'color_play_err'))
         #the actual color to use when stopped will be set in self.color_stopped
         #based on the scene toggle switch
 
         self.db_time = cfg.getint('inputs', 'db_time')
         self.libdir = cfg.get('fs', 'libdir')
         self._lastf = os.path.expanduser(cfg.get('fs', 'lastf_path'))
+        self.state_max_delay = cfg.getfloat('fs', 'state_max_delay')
+        self._index_path = os.path.expanduser(cfg.get('fs', 'index_path'))
+        self.watch_libdir = cfg.getboolean('fs', 'watch')
+        if cfg.has_option('fs', 'def_file'):
+            self.def_file = cfg.get('fs', 'def_file')
+        else:
+            self.def_file = None
+
+        self.cache_enabled = cfg.getboolean('cache', 'enabled')
+        self.cache_dir = os.path.expanduser(cfg.get('cache', 'cache_dir'))
+        self.cache_max = cfg.getint('cache', 'max_mb') * 2**20
+        self.cache_workers = cfg.getint('cache', 'workers')
 
         self.skip_hold_time = cfg.getfloat('prefs', 'skip_hold_time')
         self.skip_len = cfg.getint('prefs', 'skip_len')
+        self.skip_rate = cfg.getfloat('prefs', 'skip_rate')
+        self.skip_rate_max = cfg.getfloat('prefs', 'skip_rate_max')
+        self.skip_rate_step = cfg.getfloat('prefs', 'skip_rate_step')
+        self.timeouts = {
+            transport.PREROLLING: cfg.getfloat('prefs', 'timeout_preroll'),
+            transport.SEEKING: cfg.getfloat('prefs', 'timeout_seek'),
+            transport.STOPPING: cfg.getfloat('prefs', 'timeout_stop'),
+        }
         self.scp_span = cfg.getint('prefs', 'scp_span')
         self.scp_hits = cfg.getint('prefs', 'scp_hits')
         self.volume = cfg.getint('prefs', 'volume')
+        self.pool_size = cfg.getint('prefs', 'pool_size')
+        self.audio_sink = cfg.get('audio', 'sink')
+        self.audio_device = cfg.get('audio', 'device')
+        self.audio_pipeline = cfg.get('audio', 'pipeline')
+        if self.audio_pipeline not in ('playbin', 'manual'):
+            raise ValueError('unknown audio pipeline %r' % self.audio_pipeline)
+        self.audio_decoder = cfg.get('audio', 'decoder')
+        self.buffer_time = cfg.getfloat('audio', 'buffer_time')
+        self.latency_time = cfg.getfloat('audio', 'latency_time')
         self.alsa_chan = cfg.get('prefs', 'alsa_chan')
+        self.mixer_card = cfg.get('audio', 'mixer_card')
+        self.fade_in = cfg.getfloat('audio', 'fade_in')
+        self.fade_out = cfg.getfloat('audio', 'fade_out')
+        self.seq_enabled = cfg.getboolean('sequence', 'enabled')
+        self.seq_pause = cfg.getfloat('sequence', 'pause')
+        self.seq_crossfade = cfg.getfloat('sequence', 'crossfade')
+        self.seq_loop = cfg.getboolean('sequence', 'loop')
+        self.seq_playlist = sequence.parse_playlist(
+            cfg.get('sequence', 'playlist'), self.seq_pause,
+            self.seq_crossfade)
+        self.metrics_addr = cfg.get('metrics', 'http_addr')
+        self.metrics_port = cfg.getint('metrics', 'http_port')
+        self.metrics_socket = cfg.get('metrics', 'socket_path')
+        self.status_interval = cfg.getfloat('logging', 'status_interval')
+        self.wd_enabled = cfg.getboolean('watchdog', 'enabled')
+        self.wd_interval = cfg.getfloat('watchdog', 'interval')
+        self.wd_stall_time = cfg.getfloat('watchdog', 'stall_time')
+        self.wd_recover_time = cfg.getfloat('watchdog', 'recover_time')
+        self.wd_max_attempts = cfg.getint('watchdog', 'max_attempts')
         #convert to nanoseconds to use natively with the duration time that
         #Gstreamer returns to us
         self.scp_err_time = cfg.getint('prefs', 'scp_err_time') * 10**9
@@ -88,35 +193,114 @@ class NativityPlayer(object):
             self.pin_scene: False,
         }
 
-        #map for pin input handlers based on pin and state
-        self._handler_map = {
-            self.pin_play: { True: self._h_play_r, False: self._h_play_f },
-            self.pin_stop: { True: self._h_stop_r, False: self._h_stop_f },
-            self.pin_rw: { True: self._h_rw_r, False: self._h_rw_f },
-            self.pin_ff: { True: self._h_ff_r, False: self._h_ff_f },
-            self.pin_scene: { True: self._h_scene_r, False: self._h_scene_f },
-            self.pin_sctoggle:\
-                { True: self._h_sctoggle_r, False: self._h_sctoggle_f },
+        #names of the buttons, as used in gesture specifications, keyed by
+        #pin number
+        self._button_names = {
+            self.pin_play: 'play',
+            self.pin_stop: 'stop',
+            self.pin_rw: 'rw',
+            self.pin_ff: 'ff',
+            self.pin_scene: 'scene',
         }
 
-        #flag used for MP3 switching to ignore a play button release if we've
-        #just switched MP3s (meaning the play button was pressed down as part
-        #of the switch action, not because the user wants to start playing)
-        self._ign_play = False
-
-        #flag used for ignoring rewind/fast-forward events due to button
-        #releases when we've just had a rewind/fast-forward due to that same
-        #button being held down
-        self._ign_rw = False
-        self._ign_ff = False
-
-        #timers for handling rewing/fast-forward button holds
+        #what to do for each phase of each gesture action
+        self._actions = {
+            'play': {gestures.FIRE: self._a_play},
+            'stop': {gestures.FIRE: self._a_stop},
+            'skip_forward': {gestures.FIRE: self._skip_forward},
+            'skip_backward': {gestures.FIRE: self._skip_backward},
+            'ff_hold': {
+                gestures.FIRE: self._ff_held,
+                gestures.REPEAT: self._ramp_trick,
+                gestures.END: self._end_hold,
+            },
+            'rw_hold': {
+                gestures.FIRE: self._rw_held,
+                gestures.REPEAT: self._ramp_trick,
+                gestures.END: self._end_hold,
+            },
+            'next_file': {
+                gestures.FIRE: self._a_next_file,
+                gestures.BOTCHED: self._a_botched,
+            },
+            'prev_file': {
+                gestures.FIRE: self._a_prev_file,
+                gestures.BOTCHED: self._a_botched,
+            },
+            'scene_play': {gestures.FIRE: self._a_scene_play},
+        }
+        #action timing histograms, keyed by action
+        self._action_time = {}
+
+        #gestures triggering each action; the defaults follow the prefs, and
+        #any given in the gestures section replace them
+        gesture_specs = {
+            'play': 'tap play',
+            'stop': 'tap stop',
+            'skip_forward': 'tap ff',
+            'skip_backward': 'tap rw',
+            'ff_hold': 'hold ff %r %r' % (self.skip_hold_time,
+                self.skip_rate_step),
+            'rw_hold': 'hold rw %r %r' % (self.skip_hold_time,
+                self.skip_rate_step),
+            'next_file': 'chord play ff',
+            'prev_file': 'chord play rw',
+            'scene_play': 'taps scene %d %d' % (self.scp_hits, self.scp_span),
+        }
+        if cfg.has_section('gestures'):
+            gesture_specs.update(cfg.items('gestures'))
+        self._gesture_table = []
+        for (action, spec) in sorted(gesture_specs.items()):
+            if action not in self._actions:
+                raise ValueError('unknown gesture action %s' % action)
+            if spec.strip():
+                self._gesture_table.append(gestures.parse_gesture(action,
+                    spec, self._button_names.values()))
+
+        if shared is None:
+            #scheduler which runs all of our periodic and one-shot timed work
+            self.sched = scheduler.Scheduler()
+
+            #controller which runs everything that acts on the player, in
+            #order, on one thread; input callbacks, timers, and other threads
+            #submit commands to it rather than acting directly
+            self.ctl = control.Controller()
+
+            #loop to dispatch interesting player bus messages as soon as they
+            #arrive (made once GStreamer is loaded)
+            self.events = None
+        else:
+            self.sched = shared.sched
+            self.ctl = shared.ctl
+            self.events = shared.events
+
+        #state machine for playing/stopping/seeking the current player, and
+        #callables to tell about its state changes
+        self.transport = transport.Transport(self.sched, self.ctl.submit,
+            self.timeouts, on_failure=self._transport_failed,
+            on_change=self._transport_changed)
+        self._transport_listeners = []
+
+        #recognizer turning button edges into actions
+        self.gestures = gestures.Recognizer(self._gesture_table, self.sched,
+            self.ctl.submit, self._dispatch)
+
+        #playing volume (integer percentage), applied within the pipelines on
+        #top of the ALSA mixer volume; it can be changed while running
+        self.level = 100
+
+        #fades in progress, as (level faded to, timer for the end, fade
+        #number), keyed by pipeline
+        self._fades = {}
+        self._fade_count = 0
+
+        #timers for stepped rewind/fast-forward
         self._timer_ff = None
         self._timer_rw = None
 
-        #list of times at which the scene button was released, to determine
-        #whether we've receive three presses within the requisite time
-        self._scp_times = []
+        #playback rate while fast-forwarding/rewinding by a button hold
+        #(negative for rewinding), or None when playing normally
+        self._trick_rate = None
 
         #flag to indicate whether the LCD backlight color is locked, and the
         #periodic update loop should not change it
@@ -126,37 +310,191 @@ class NativityPlayer(object):
         #scenes
         self.last_fin = None
 
-        #pre-load list of files
-        self.files =\
-            [os.path.join(self.libdir, x) for x in os.listdir(self.libdir)]
+        #event to provoke an LCD update
+        self._upd_evt = threading.Event()
+
+        #scheduled call to provoke LCD updates for playing progress
+        self._upd_timer = None
+
+        #whether the current file has prerolled for the first time, after
+        #which systemd is told we're ready
+        self._prerolled = False
+
+        #watch for the current file's position no longer advancing while
+        #playing; whether the transport was playing as of its last change
+        #(so that a failure while playing is recovered from); the recovery in
+        #progress, as (monotonic time started, timer for giving up on it,
+        #position to carry on from); and the times recoveries were started,
+        #for giving up on a pipeline which keeps failing
+        self.stalls = watchdog.StallDetector(self.wd_stall_time)
+        self._was_playing = False
+        self._recovery = None
+        self._recoveries = collections.deque()
+
+        #feeding of systemd's watchdog (left to the zones' owner, if shared)
+        self.pinger = None
+        if shared is None:
+            self.pinger = watchdog.Pinger(self.sched, self.ctl.submit)
+
+        #library of files, along with whatever is already known about them
+        #from the library index
+        self.library = library.Library(self.libdir, self._index_path)
+
+        #order in which files follow each other in sequence mode, or None if
+        #each file stops at its end
+        self.sequence = None
+        if self.seq_enabled:
+            self.sequence = sequence.Sequence(self.library, self.seq_playlist,
+                self.seq_pause, self.seq_crossfade, self.seq_loop)
+
+        #in sequence mode, the pipeline and sequence.Step of a file queued
+        #to follow on gaplessly, until it starts; a pipeline no file may be
+        #queued onto until it plays again, having been stopped or switched
+        #away from; the lock guarding the two, since files are queued from
+        #the streaming thread; and the timers for starting the next file
+        #after a pause, and for crossfading into it
+        self._seq_queued = None
+        self._seq_closed = None
+        self._seq_lock = threading.Lock()
+        self._seq_timer = None
+        self._xfade_timer = None
+
+        #files changed or replaced while their pipeline was playing, which is
+        #left playing the old contents, and replaced once it stops
+        self._stale = set()
+
+        #player state saved from last time, and saved for next time
+        self.state = state.StateStore(self._lastf,
+            max_delay=self.state_max_delay)
+
+        #set up handle to LCD, and the thread which will draw on it
+        if self.lcd_enabled:
+            if i2c is None:
+                i2c = backends.smbus_backend(nhd_lcd.NHD_LCD.I2C_BUS)
+            led_pins = (self.pin_led_red, self.pin_led_green,
+                self.pin_led_blue)
+            if self.backlight_pwm:
+                light = backlight.PWMBacklight(gpio, led_pins, self.sched)
+            else:
+                light = backlight.SwitchedBacklight(gpio, led_pins)
+            self.lcd = nhd_lcd.NHD_LCD(self.pin_led_red, self.pin_led_green,
+                self.pin_led_blue, bus=i2c, gpio=gpio, light=light)
+            self.lcd_writer = nhd_lcd.LCDWriter(self.lcd)
+
+            #LCD traffic
+            metrics.REGISTRY.counter_func('nplayer_i2c_transactions',
+                'I2C transactions sent to the LCD',
+                lambda: self.lcd.stat_trans, **self._labels)
+            metrics.REGISTRY.counter_func('nplayer_i2c_bytes',
+                'Bytes sent to the LCD over I2C',
+                lambda: self.lcd.stat_bytes, **self._labels)
+        else:
+            self.lcd = None
+            self.lcd_writer = nhd_lcd.NullWriter()
+
+        #set up serving metrics and remote control, if enabled (and not left
+        #to the zones' owner)
+        self.metrics_server = None
+        self.remote_server = None
+        if shared is None:
+            self.metrics_server = metrics.MetricsServer(
+                http_addr=((self.metrics_addr, self.metrics_port)
+                    if self.metrics_port else None),
+                socket_path=(os.path.expanduser(self.metrics_socket)
+                    if self.metrics_socket else None))
+            self.remote_server = remote.server_from_config(cfg, {None: self})
+
+        #status line logged by the update loop, only as often as it's
+        #interesting
+        if name is None:
+            status_log = logging.getLogger('nplayer.status')
+        else:
+            status_log = logqueue.PrefixAdapter(
+                logging.getLogger('nplayer.zone.%s.status' % name), name)
+        self.status = logqueue.StatusLine(status_log, self.status_interval)
+
+        #do the slow parts of starting up, each as soon as what it needs is
+        #done, so that loading GStreamer, scanning the library, and
+        #initializing the LCD overlap
+        self.startup = startup.Startup()
+        self.startup.add('lcd', self._start_lcd)
+        self.startup.add('gst', self._start_gst)
+        self.startup.add('library', self._start_library)
+        self.startup.add('state', self._start_state)
+        self.startup.add('select', self._start_select,
+            after=('library', 'state'))
+        self.startup.add('mixer', self._start_mixer, after=('select',))
+        self.startup.add('pipeline', self._start_pipeline,
+            after=('gst', 'select'))
+        self.startup.add('watcher', self._start_watcher)
+        self.startup.run()
+        self.log.info('player initialized')
+
+
+    def _start_lcd(self):
+        """Startup step: starts the LCD writer, which initializes the display,
+        and says we're starting.
+
+        Context: startup thread"""
+        self.lcd_writer.start()
+        self.lcd_writer.show(('starting', ''))
+
+
+    def _start_gst(self):
+        """Startup step: loads GStreamer.
+
+        Context: startup thread"""
+        GObject.threads_init()
+        Gst.init(None)
+        self.log.info('gstreamer initialized')
+        if self.events is None:
+            self.events = events.EventLoop()
+
+
+    def _start_library(self):
+        """Startup step: lists the files in the library.
+
+        Context: startup thread"""
+        self.library.scan()
+        self.files = self.library.files
         if not self.files:
             raise Exception('no files in library dir %s' % self.libdir)
-        else:
-            self.files.sort()
+
+
+    def _start_state(self):
+        """Startup step: reads the state saved last time.
+
+        Context: startup thread"""
+        self._saved = self.state.load()
+
+
+    def _start_select(self):
+        """Startup step: decides which file to start on, and where in it.
+
+        Context: startup thread"""
+
+        saved = self._saved
 
         #determine which file we'll start on; order of preference:
-        #-file specified by ~/.nplayer_last
+        #-file saved in the state file (~/.nplayer_last)
         #-fs/def_file setting in config file
         #-the first file in an alphabetical listing of available files
 
         self.cur_file = None
 
-        if os.path.exists(self._lastf):
-            with open(self._lastf) as lastfh:
-                lastmp3 = lastfh.readline()
-
-            lastmp3 = os.path.join(self.libdir, lastmp3)
-            if os.path.isfile(lastmp3):
-                self.cur_file = lastmp3
-                self.cur_fileno = self.files.index(lastmp3)
+        if saved['file'] is not None:
+            lastno = self.library.index_of(saved['file'])
+            if lastno is not None:
+                self.cur_file = self.files[lastno]
+                self.cur_fileno = lastno
 
         if self.cur_file is None:
             #last file didn't work, try conf file setting
-            if cfg.has_option('fs', 'def_file'):
-                def_file = os.path.join(self.libdir, cfg.get('fs', 'def_file'))
-                if os.path.isfile(def_file):
-                    self.cur_file = def_file
-                    self.cur_fileno = self.files.index(def_file)
+            if self.def_file is not None:
+                defno = self.library.index_of(self.def_file)
+                if defno is not None:
+                    self.cur_file = self.files[defno]
+                    self.cur_fileno = defno
                 else:
                     self.cur_file = self.files[0]
                     self.cur_fileno = 0
@@ -166,56 +504,101 @@ class NativityPlayer(object):
             self.cur_file = self.files[0]
             self.cur_fileno = 0
 
-        #length of current file, in nanoseconds; due to how Gstreamer works,
-        #we can't obtain this info until the file has been loaded by Gstreamer
-        self.cur_filelen = 0
+        #length of current file, in nanoseconds, if known from the library
+        #index; otherwise it's learned once Gstreamer has loaded the file
+        self.cur_filelen = self.library.duration(self.cur_file)
 
         self.cur_file_base = os.path.basename(self.cur_file)
 
-        #write back to the last file whichever one we chose
-        with open(self._lastf, 'w') as lastfh:
-            lastfh.write(self.cur_file_base)
+        #if the file was cut off part way through playing, pick up from
+        #there
+        self._resume_pos = 0
+        if saved['file'] == self.cur_file_base and saved['mode'] == 'play':
+            self._resume_pos = saved['position']
+
+        #keep the playing volume last set
+        if saved['volume'] is not None:
+            self.level = saved['volume']
+
+        #write back whichever file we chose
+        self.state.update(file=self.cur_file_base, volume=self.level)
 
         self.log.info('starting with file %s (index %d)', self.cur_file,
             self.cur_fileno)
 
-        #set output channel volume
+
+    def _start_mixer(self):
+        """Startup step: sets the output channel volume.
+
+        Context: startup thread"""
         try:
-            subprocess.check_output(
-                ['amixer', 'set', self.alsa_chan, '%s%%' % self.volume],
-                stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            self.log.error(
-                'failed setting volume; amixer returned %d, output was:\n%s',
-                e.returncode, e.output)
+            volume.set_mixer(self.mixer_card, self.alsa_chan, self.volume)
+        except (OSError, ValueError) as e:
+            #no ALSA mixer, as when running away from the Pi
+            self.log.error('failed setting volume of ALSA channel %s: %s',
+                self.alsa_chan, e)
         else:
             self.log.info('volume for ALSA channel %s set to %d%%',
                 self.alsa_chan, self.volume)
 
-        #set up GStreamer
-        GObject.threads_init()
-        Gst.init(None)
-        self.log.info('gstreamer initialized')
-
-        #set up file player
-        self.player = Gst.ElementFactory.make('playbin', 'player')
-        self.player.set_property('uri', 'file://%s'%self.cur_file)
-        self.pl_bus = self.player.get_bus()
-        self.log.info('player initialized')
 
-        #set up handle to LCD (not actually init'ing LCD yet)
-        self.lcd = nhd_lcd.NHD_LCD(self.pin_led_red, self.pin_led_green,
-            self.pin_led_blue)
+    def _start_pipeline(self):
+        """Startup step: sets up the players, starting the current file
+        prerolling.
 
-        #event to provoke an LCD update
-        self._upd_evt = threading.Event()
+        Context: startup thread"""
 
-        #timer to provoke LCD updates for playing progress
-        self._upd_timer = None
+        #set up cache of decoded files, if enabled, starting with the files
+        #we're about to need
+        if self.cache_enabled:
+            self.pcm_cache = pcmcache.PCMCache(self.cache_dir, self.cache_max,
+                workers=self.cache_workers, max_maps=self.pool_size,
+                on_ready=functools.partial(self.ctl.submit, 'pcm_ready',
+                    self._pcm_ready))
+            self.pcm_cache.warm(self._standby_files() + self.files)
+            resolve = self.pcm_cache.lookup
+        else:
+            self.pcm_cache = None
+            resolve = None
+
+        #set up file players; the current file and its neighbors are kept
+        #prerolled, and self.player is always the one for the current file
+        self.pool = pipeline.PipelinePool(self.pool_size, resolve=resolve,
+            make_sink=functools.partial(backends.make_audio_sink,
+                self.audio_sink, self.audio_device, self.buffer_time,
+                self.latency_time),
+            make_filter=self._make_volume,
+            on_add=self._pipe_added, on_remove=self._pipe_removed,
+            decoder=self.audio_decoder
+                if self.audio_pipeline == 'manual' else None)
+        self._set_player(self.pool.activate(self.cur_file))
+        self.pool.prefetch(self._standby_files())
+        if self._resume_pos:
+            self.ctl.submit('resume', self._resume, self._resume_pos)
+
+        #learn the durations of any new files in the background, once the
+        #files we need first are loading
+        self.library.probe_async(on_probed=self._file_probed)
+
+
+    def _start_watcher(self):
+        """Startup step: sets up watching the library directory for changes.
+
+        Context: startup thread"""
+        self.watcher = None
+        if self.watch_libdir:
+            try:
+                self.watcher = inotify.LibraryWatcher(self.libdir,
+                    functools.partial(self.ctl.submit, 'library',
+                        self._library_changed))
+            except OSError as e:
+                self.log.error('cannot watch library dir for changes: %s', e)
 
 
-    def start(self):
-        """Starts accepting input, then blocks forever."""
+    def start(self, block=True):
+        """Starts accepting input, then blocks forever running the display
+        update loop (or, if block is False, runs the loop on a thread of its
+        own and returns)."""
 
         ## set up pins
 
@@ -230,86 +613,228 @@ class NativityPlayer(object):
 
         #async pins
         for pin in self._pins:
-            RPIO.add_interrupt_callback(pin, self._input_cb, edge='both',
-                pull_up_down=(RPIO.PUD_UP if self.invert_logic else RPIO.PUD_DOWN),
-                debounce_timeout_ms=self.db_time)
-
-        #set up LCD comms
-        self.lcd.init()
+            self.gpio.add_interrupt_callback(pin, self._input_cb,
+                self.invert_logic, self.db_time)
+
+        #start running commands and timed work, and handling player messages
+        #and library changes
+        if self._shared is None:
+            self.ctl.start()
+            self.sched.start()
+            self.events.start()
+            self.metrics_server.start()
+            self.remote_server.start()
+        self.state.start()
+        if self.watcher is not None:
+            self.watcher.start()
+        self.sched.call_later(self.STATS_INTERVAL, self._log_stats)
+        if self.wd_enabled:
+            self.sched.call_later(self.wd_interval, self.ctl.submit, 'health',
+                self._check_health)
+        if self.pinger is not None:
+            self.pinger.start()
 
         #start handling async events
-        RPIO.wait_for_interrupts(threaded=True)
+        if self._shared is None:
+            self.gpio.wait_for_interrupts()
+
+        if block:
+            self._update_loop()
+        else:
+            upd_thread = threading.Thread(target=self._update_loop,
+                name='update' if self.name is None else
+                    'update-%s' % self.name)
+            upd_thread.daemon = True
+            upd_thread.start()
+
+
+    def set_volume(self, percent):
+        """Sets the playing volume, as an integer percentage, ramping to it if
+        playing.
+
+        Context: any thread"""
+        self.ctl.submit('volume', self._set_volume, percent,
+            merge=lambda queued, new: new, droppable=True)
+
+
+    def perform(self, action, stamp=None):
+        """Runs a gesture action (see self._actions) as though its gesture had
+        just been made, as for remote control. Raises ValueError if there's no
+        such action.
+
+        Context: any thread"""
+        if action not in self._actions:
+            raise ValueError('unknown action %s' % action)
+        self.ctl.submit('remote', self._dispatch, action, gestures.FIRE, 0,
+            stamp=stamp)
+
+
+    def skip(self, secs):
+        """Skips the playing file forward (or backward, if negative) by the
+        given float seconds.
+
+        Context: any thread"""
+        self._skip(int(secs * 10**9))
+
+
+    def seek_to(self, secs):
+        """Seeks the playing file to the given float seconds.
+
+        Context: any thread"""
+        self.ctl.submit('seek_to', self._seek_to, int(secs * 10**9),
+            droppable=True)
+
+
+    def snapshot(self):
+        """Returns a dict of what the player is doing: the current file and
+        its position in the library, the transport state, the position and
+        length of the file in float seconds (each None if not known), the
+        playing rate, the volume, and whether scene taps start playing.
+
+        Context: any thread"""
+        pos = None
+        if self.transport.playing:
+            (ok, cur_pos) = self.player.query_position(Gst.Format.TIME)
+            if ok:
+                pos = cur_pos / 1e9
+        return {
+            'file': self.cur_file_base,
+            'index': self.cur_fileno,
+            'state': self.transport.state,
+            'position': pos,
+            'duration': self.cur_filelen / 1e9 if self.cur_filelen else None,
+            'rate': self._trick_rate or 1.0,
+            'volume': self.level,
+            'scene_auto': bool(self._in_states.get(self.pin_sctoggle)),
+        }
+
+
+    def add_transport_listener(self, func):
+        """Registers func(old state, new state) to be called whenever the
+        transport state changes (see transport.py).
+
+        Context: func is called on the controller thread"""
+        self._transport_listeners.append(func)
+
+
+    def _update_loop(self):
+        """Updates the console and LCD whenever something changes, forever."""
 
         #main LCD update loop
         self._upd_evt.set() #initial set to get a first printout
         while self._upd_evt.wait():
 
             self._upd_evt.clear()
-
-            #wait out any Gstreamer state transition that may be happening on
-            #the stream
-            self.player.get_state(timeout=Gst.CLOCK_TIME_NONE)
+            start = scheduler.monotonic()
 
             #default outputs is to say we're not currently playing
             con_msg = 'file %s' % self.cur_file
             lcd_line1 = self.cur_file_base
             lcd_line2 = 'stop'
+            #by default, refresh in a second, since nothing on the display
+            #is counting
+            upd_delay = 1.0
+            shown_pos = 0
             if self.last_fin is not None:
                 etime = time.time() - self.last_fin
+                upd_delay = self._next_sec_delay(etime * 10**9)
+                shown_pos = int(etime * 1000)
                 (emin, esec) = self._s2tuple(etime)
                 con_msg += ' (%d:%.2d since last stop/finish)' % (emin, esec)
                 lcd_line2 += ' (+%d:%.2d)' % (emin, esec)
 
             lcd_leds = self.color_stopped
-
-            if self.player.current_state == Gst.State.PLAYING:
-                #player says that it's currently playing, but this does not
-                #conclusively mean that the MP3 hasn't finished playing; we have
-                #to drain out messages from the player bus to see if the stream
-                #is actually done
-
-                #handle any insteresting messages
-                stream_end = False
-                gmsg = self.pl_bus.pop()
-                while gmsg is not None and not stream_end:
-                    if gmsg.type == Gst.MessageType.EOS:
-                        #finished playing
-                        self.log.debug('got end of stream, resetting')
-                        self.player.set_state(Gst.State.READY)
-                        self.player.get_state(timeout=Gst.CLOCK_TIME_NONE)
-                        stream_end = True
-                        self.last_fin = time.time()
-                    elif gmsg.type == Gst.MessageType.DURATION_CHANGED:
-                        self.log.debug('stream duration changed')
-                        self.cur_filelen =\
-                            self.player.query_duration(Gst.Format.TIME)[1]
-
-                    gmsg = self.pl_bus.pop()
-
-                if not stream_end:
-                    #output current position and playing status
-                    cur_pos = self.player.query_position(Gst.Format.TIME)[1]
-                    (cmins, csecs, cnsecs) = self._ns2tuple(cur_pos)
-                    (dmins, dsecs, dnsecs) = self._ns2tuple(self.cur_filelen)
-                    pct = float(cur_pos) / float(self.cur_filelen)
-
-                    con_msg += ' (playing, %d:%.2d/%d:%.2d (%.2f %%))' %\
-                        (cmins, csecs, dmins, dsecs, pct)
-                    lcd_line2 = '%d:%.2d/%d:%.2d (play)' % (cmins, csecs, dmins,
-                        dsecs)
-                    lcd_leds = self.color_playing
+            mode = 'stop'
+
+            if self.transport.playing:
+                #end of stream is handled as soon as it's posted by the event
+                #loop, so playing here really means playing
+
+                #output current position and playing status
+                cur_pos = self.player.query_position(Gst.Format.TIME)[1]
+                (cmins, csecs, cnsecs) = self._ns2tuple(cur_pos)
+                (dmins, dsecs, dnsecs) = self._ns2tuple(self.cur_filelen)
+                if self.cur_filelen:
+                    pct = 100.0 * cur_pos / self.cur_filelen
+                else:
+                    pct = 0.0
+
+                con_msg += ' (playing, %d:%.2d/%d:%.2d (%.2f %%))' %\
+                    (cmins, csecs, dmins, dsecs, pct)
+                trick_rate = self._trick_rate
+                if trick_rate is None:
+                    mode = 'play'
+                    trick_rate = 1.0
+                else:
+                    mode = '%s%dx' % ('>>' if trick_rate > 0 else '<<',
+                        abs(trick_rate))
+                lcd_line2 = '%d:%.2d/%d:%.2d (%s)' % (cmins, csecs, dmins,
+                    dsecs, mode)
+                lcd_leds = self.color_playing
+                upd_delay = self._next_sec_delay(cur_pos, trick_rate)
+                shown_pos = cur_pos // 10**6
+
+                #get ready to crossfade into the next file in the sequence,
+                #if that's due before the next update
+                if self.sequence is not None and mode == 'play':
+                    self._due_crossfade(cur_pos, upd_delay)
+
+                #keep the resume point up to date (the store holds off
+                #writing it out to every few seconds)
+                self.state.update(position=cur_pos, mode='play')
 
             #output current status
-            print >>sys.stderr, con_msg
-            self.lcd.overwrite(lcd_line1, lcd_line2)
-            if not self._bl_locked:
-                self.lcd.set_backlight(*lcd_leds)
-
-            #reset timer to refresh the display
+            self.status.update((self.cur_file, mode), con_msg)
+            self.lcd_writer.show((lcd_line1, lcd_line2),
+                None if self._bl_locked else lcd_leds)
+            rec = recorder.RECORDER
+            rec.record(recorder.LCD, self._rec_source, rec.name(lcd_line1),
+                rec.name(mode),
+                0 if self._bl_locked else rec.name(repr(lcd_leds)), shown_pos)
+
+            #reschedule the display refresh for when the seconds digit
+            #being shown next changes
             if self._upd_timer is not None:
                 self._upd_timer.cancel()
-            self._upd_timer = threading.Timer(0.5, self._trigger_update)
-            self._upd_timer.start()
+            self._upd_timer = self.sched.call_later(upd_delay,
+                self._trigger_update)
+            _UPDATE_TIME.observe(scheduler.monotonic() - start)
+
+
+    def _due_crossfade(self, cur_pos, within):
+        """Arms the crossfade into the next file in the sequence, if there's
+        to be one, and it's due to start within the given float seconds, the
+        current file being at the given position in nanoseconds.
+
+        Context: update thread"""
+        if not self.cur_filelen:
+            return
+        step = self.sequence.next(self.cur_file)
+        if step is None or step.pause or not step.crossfade:
+            return
+        lead = (self.cur_filelen - cur_pos) / 1e9 - step.crossfade
+        if lead <= within:
+            self.ctl.submit('crossfade', self._arm_crossfade, self.player,
+                max(lead, 0))
+
+
+    def _log_stats(self):
+        """Logs internal statistics, then schedules doing so again.
+
+        Context: scheduler thread"""
+        ctl_stats = self.ctl.stats()
+        self.log.info('command queue: high water %d, %d dropped, %d merged, '
+            '%d overflowed', ctl_stats['high_water'], ctl_stats['dropped'],
+            ctl_stats['merged'], ctl_stats['overflowed'])
+        for (name, (count, mean, peak)) in\
+        sorted(ctl_stats['latency'].items()):
+            self.log.info('%s commands: %d, latency mean %.1f ms, max %.1f ms',
+                name, count, mean * 1000, peak * 1000)
+        for (state, (count, total)) in\
+        sorted(self.transport.trace_summary().items()):
+            self.log.info('transport %s: entered %d times, %.1f s total',
+                state, count, total)
+        self.sched.call_later(self.STATS_INTERVAL, self._log_stats)
 
 
     def _trigger_update(self):
@@ -317,304 +842,1264 @@ class NativityPlayer(object):
         self._upd_evt.set()
 
 
-    def _input_cb(self, pin, istate):
-        """Callback for GPIO event detection.
+    @staticmethod
+    def _next_sec_delay(nsecs, rate=1.0):
+        """Given a running time in nanoseconds, returns the delay in float
+        seconds until that time reaches its next whole second (plus a small
+        margin so that the next reading is past the boundary), if it is
+        advancing at the given rate (negative if running backward)."""
+        if rate > 0:
+            to_go = 10**9 - nsecs % 10**9
+        else:
+            to_go = nsecs % 10**9 or 10**9
+        return to_go / 1e9 / abs(rate) + 0.005
+
+
+    def _make_volume(self):
+        """Returns the volume element for a new pipeline. Pipelines are kept
+        on standby silent if playing fades in, so that the audio prerolled
+        doesn't get out before the fade."""
+        return volume.make_volume(0.0 if self.fade_in else self.level / 100.0)
+
+
+    def _set_volume(self, percent):
+        """Sets the playing volume.
+
+        Context: controller thread"""
+        self.level = max(0, min(int(percent), 100))
+        self.log.info('volume set to %d%%', self.level)
+        self.state.update(volume=self.level)
+        for pipe in self.pool.pipelines():
+            if pipe == self.player and self.transport.playing:
+                if self._fades.get(pipe, (None,))[0] != 0.0:
+                    #a short ramp, so that the change doesn't click (unless
+                    #it's fading out)
+                    self._start_fade(pipe, None, self.level / 100.0,
+                        self.VOLUME_RAMP)
+            elif not self.fade_in:
+                volume.set_level(pipe, self.level / 100.0)
+        self._upd_evt.set()
 
-        Context: callback thread"""
 
-        if self.invert_logic:
-            #inverted logic, button depressed represented by digital 0 (false)
-            newState = not bool(istate)
+    def _start_fade(self, pipe, start, end, duration, then=None):
+        """Fades the volume of the given pipeline from start (or its current
+        level, if None) to end over duration seconds, then calls then(), if
+        given. Any fade in progress on the pipeline is dropped. A pipeline
+        with a follow-up is kept in the pool until it's been done, even once
+        it's no longer the current player (as when fading out in a
+        crossfade).
+
+        Context: controller thread"""
+        self._cancel_fade(pipe)
+        if then is not None:
+            self.pool.pin(pipe)
+        rate = self._trick_rate if pipe == self.player and\
+            self._trick_rate is not None else 1.0
+        volume.fade(pipe, start, end, duration, rate)
+        self._fade_count += 1
+        self._fades[pipe] = (end, self.sched.call_later(duration,
+            self.ctl.submit, 'fade', self._faded, pipe, self._fade_count,
+            then), self._fade_count)
+
+
+    def _faded(self, pipe, number, then):
+        """Handles a fade finishing: the pipeline is left at the level faded
+        to, and the fade's follow-up is done, unless the fade was dropped or
+        the pipeline has since been thrown out.
+
+        Context: controller thread"""
+        fade = self._fades.get(pipe)
+        if fade is None or fade[2] != number:
+            return
+        del self._fades[pipe]
+        if pipe in self.pool.pipelines():
+            volume.set_level(pipe, fade[0])
+            if then is not None:
+                then()
+        if then is not None:
+            #now that it's back on standby (or thrown out), it may make way
+            #for the current file's neighbors
+            self.pool.unpin(pipe)
+            self.pool.prefetch(self._standby_files())
+
+
+    def _cancel_fade(self, pipe):
+        """Drops any fade in progress on the given pipeline, without doing its
+        follow-up. The pipeline is left at whatever level it got to.
+
+        Context: controller thread"""
+        fade = self._fades.pop(pipe, None)
+        if fade is not None:
+            fade[1].cancel()
+            self.pool.unpin(pipe)
+
+
+    def _fade_out(self, pipe, then):
+        """Fades out the given (playing) pipeline, then calls then().
+
+        Context: controller thread"""
+        if self.fade_out:
+            self._start_fade(pipe, None, 0.0, self.fade_out, then)
         else:
-            #straight logic, button depressed represented by digital 1 (true)
-            newState = bool(istate)
+            self._cancel_fade(pipe)
+            then()
+
+
+    def _pipe_added(self, path, pipe):
+        """Starts watching the bus of a newly created pipeline, and in
+        sequence mode, watching for its file being about to finish (which
+        only playbins tell of)."""
+        handlers = {
+            Gst.MessageType.EOS:
+                functools.partial(self.ctl.submit, 'eos', self._on_eos, pipe),
+            Gst.MessageType.ERROR: functools.partial(self.ctl.submit, 'error',
+                self._on_error, path, pipe),
+            Gst.MessageType.WARNING:
+                functools.partial(self._on_warning, path, pipe),
+            Gst.MessageType.STATE_CHANGED:
+                functools.partial(self._on_state_changed, pipe),
+            Gst.MessageType.ASYNC_DONE:
+                functools.partial(self._on_async_done, pipe),
+            Gst.MessageType.DURATION_CHANGED:
+                functools.partial(self._on_duration_changed, pipe),
+        }
+        if self.sequence is not None and pipeline.is_playbin(pipe):
+            handlers[Gst.MessageType.STREAM_START] = functools.partial(
+                self.ctl.submit, 'sequence', self._on_stream_start, pipe)
+            pipe.connect('about-to-finish', self._about_to_finish)
+        self.events.watch(pipe.get_bus(), handlers)
 
-        self._in_states[pin] = newState
-        self._handler_map[pin][newState]()
 
+    def _pipe_removed(self, path, pipe):
+        """Stops watching the bus of an evicted pipeline."""
+        self.events.unwatch(pipe.get_bus())
 
-    def _h_play_r(self):
-        """Play pressed; nothing to do here."""
-        self.log.debug('play button pressed')
 
+    def _file_probed(self, path, duration):
+        """Handles the library learning the duration of a file.
+
+        Context: library probe thread"""
+        self.ctl.submit('probed', self._take_probed, path, duration)
+
+
+    def _take_probed(self, path, duration):
+        """Takes a probed duration as the current file's length, if it's for
+        the current file and the length isn't known yet.
+
+        Context: controller thread"""
+        if path == self.cur_file and not self.cur_filelen:
+            self.cur_filelen = duration
+            self._upd_evt.set()
 
-    def _h_play_f(self):
-        """Play button released"""
-        self.log.debug('play button released')
 
-        if True in (self._in_states[self.pin_rw], self._in_states[self.pin_ff]):
-            #either rw or ff are pressed down, so this was a botched attempt
-            #(on the user's part) to switch MP3 file
-            self.log.warning(
-                'botched switch file attempt (must release ff/rw first)')
-        elif self._ign_play:
-            #play is masked due to an MP3 switch
-            self.log.debug('play masked by mp3 switch operation')
-            self._ign_play = False
+    def _pcm_ready(self, path):
+        """Handles a file finishing decoding into the cache. If the file is on
+        standby, its pipeline is rebuilt to play from the cache.
+
+        Context: controller thread"""
+        if path != self.cur_file:
+            self.pool.discard(path)
+            self.pool.prefetch(self._standby_files())
+        self.log.debug('decode cache stats: %s', self.pcm_cache.stats())
+
+
+    def _standby_files(self):
+        """Returns the files whose pipelines should be kept prerolled, in order
+        of importance: the current file, then the next and previous ones (in
+        sequence mode, the ones in the sequence come first)."""
+        if not self.files:
+            return [self.cur_file]
+        files = [self.cur_file]
+        if self.sequence is not None:
+            for step in (self.sequence.next(self.cur_file),
+                self.sequence.prev(self.cur_file)):
+                if step is not None and step.path not in files:
+                    files.append(step.path)
+        for incr in (1, -1):
+            path = self.files[self._neighbor_index(incr)]
+            if path not in files:
+                files.append(path)
+        return files
+
+
+    def _neighbor_index(self, incr):
+        """Returns the position in self.files of the file incr positions after
+        (or before, if negative) the current file. This works even if the
+        current file has been removed from the library."""
+        pos = self.library.index_of(self.cur_file)
+        if pos is None:
+            #the neighbors are either side of where the file would be
+            pos = self.library.insertion_point(self.cur_file)
+            if incr > 0:
+                pos -= 1
+        return (pos + incr) % len(self.files)
+
+
+    def _library_changed(self, change, path, new_path):
+        """Handles a file in the library directory being added, changed,
+        removed, or renamed. Playing is not interrupted; if the current file
+        goes away while it's playing, a new one is selected once it stops.
+
+        Context: controller thread"""
+
+        self.log.info('library file %s %s%s', path, change,
+            ' to %s' % new_path if new_path else '')
+
+        if change in (inotify.ADDED, inotify.CHANGED):
+            if not os.path.isfile(path):
+                return
+            self.library.update(path)
+            #any pipeline for the file has the old contents
+            if path != self.cur_file:
+                self.pool.discard(path)
+            elif not self.transport.playing:
+                self.pool.discard(path)
+                self._set_player(self.pool.activate(path))
+                self.cur_filelen = 0
+            else:
+                self._stale.add(path)
+            if self.pcm_cache is not None:
+                self.pcm_cache.warm([path])
+
+        elif change == inotify.REMOVED:
+            self.library.remove(path)
+            if path != self.cur_file:
+                self.pool.discard(path)
+
+        elif change == inotify.RENAMED:
+            self.library.remove(path)
+            self.library.update(new_path)
+            replaced = new_path == self.cur_file
+            if replaced and self.transport.playing:
+                #the current file was replaced while playing, which carries
+                #on as it does for a change
+                self.pool.discard(path)
+                self._stale.add(new_path)
+            else:
+                self.pool.rename(path, new_path)
+            if path in self._stale:
+                self._stale.discard(path)
+                self._stale.add(new_path)
+            if path == self.cur_file:
+                #the selection follows the file
+                self.cur_file = new_path
+                self.cur_file_base = os.path.basename(new_path)
+                self.state.update(file=self.cur_file_base)
+            elif replaced and not self.transport.playing:
+                #the current file's pipeline had the old contents, and was
+                #evicted
+                self._set_player(self.pool.activate(new_path))
+                self.cur_filelen = 0
+            if self.pcm_cache is not None:
+                self.pcm_cache.warm([new_path])
+
+        self.library.probe_async(on_probed=self._file_probed)
+        self._sync_selection()
+        self._upd_evt.set()
+
+
+    def _sync_selection(self):
+        """Brings the current file position in line with the library. If the
+        current file has left the library and isn't playing, the file now in
+        its place is selected instead.
+
+        Context: controller thread"""
+        pos = self.library.index_of(self.cur_file)
+        if pos is not None:
+            self.cur_fileno = pos
+            self.pool.prefetch(self._standby_files())
+        elif not self.files:
+            self.log.warning('library is empty, nothing left to select')
+        elif not self.transport.playing:
+            self.log.info('current file left the library')
+            self.pool.discard(self.cur_file)
+            self._select_file(self._neighbor_index(1))
+        else:
+            self.cur_fileno = self.library.insertion_point(self.cur_file)
+            self.pool.prefetch(self._standby_files())
+
+
+    def _save_stopped(self):
+        """Records the current file as the one to start with next time, from
+        its start."""
+        self.state.update(file=self.cur_file_base, position=0, mode='stop')
+
+
+    def _resume(self, pos):
+        """Seeks the (prerolled) current file to the given position, in
+        nanoseconds, where it was cut off last time.
+
+        Context: controller thread"""
+        self.log.info('resuming %s at %.1f s', self.cur_file, pos / 1e9)
+        self.transport.seek(lambda: self._seek_rate(1.0, pos))
+
+
+    def _transport_changed(self, old, new):
+        """Passes transport state changes on to listeners, and notes the
+        current file first finishing prerolling, and a recovery finishing.
+
+        Context: controller thread"""
+        recorder.RECORDER.record(recorder.TRANSPORT, self._rec_source,
+            recorder.RECORDER.name(new), recorder.RECORDER.name(old))
+        if new != transport.ERROR:
+            self._was_playing = self.transport.playing
+        if new == transport.PLAYING:
+            with self._seq_lock:
+                if self._seq_closed == self.player:
+                    self._seq_closed = None
+        if new == transport.IDLE:
+            self.stalls.reset()
+            if self.cur_file in self._stale:
+                #queued, since it replaces the transport's pipeline
+                self.ctl.submit('refresh', self._refresh_stale, self.cur_file)
+        elif new == transport.PLAYING and self._recovery is not None:
+            taken = scheduler.monotonic() - self._recovery[0]
+            self._recovery[1].cancel()
+            self._recovery = None
+            watchdog.RECOVERY_TIME.observe(taken)
+            self.log.info('recovered, playing again after %.0f ms',
+                taken * 1000)
+        if new in (transport.IDLE, transport.PLAYING):
+            self._note_prerolled()
+        for func in self._transport_listeners:
+            func(old, new)
+
+
+    def _note_prerolled(self):
+        """Notes the current file being prerolled, reporting readiness the
+        first time.
+
+        Context: controller thread, or startup thread for the first file"""
+        if not self._prerolled:
+            self._prerolled = True
+            #queued, so that it only goes once the controller is running
+            self.ctl.submit('ready', self._notify_ready)
+
+
+    def _notify_ready(self):
+        """Tells systemd (or whoever asked) we're ready, now that input is
+        being handled and the current file is prerolled, ready to play.
+
+        Context: controller thread"""
+        self.log.info('ready to play, %.0f ms after starting',
+            (scheduler.monotonic() - self.startup.began) * 1000)
+        if self._on_ready is not None:
+            self._on_ready(self)
+        else:
+            startup.sd_notify('READY=1')
+
+
+    def _set_player(self, pipe):
+        """Makes the given pipeline the current player.
+
+        Context: controller thread"""
+        self.player = pipe
+        self.transport.attach(pipe)
+        if self.transport.state == transport.IDLE:
+            #already prerolled (as during startup, if the pool got there
+            #first), in which case attaching changed nothing to be told of
+            self._note_prerolled()
+
+
+    def _on_eos(self, pipe, msg):
+        """Handles the end of the stream being reached.
+
+        Context: controller thread"""
+        if pipe != self.player:
+            #not that this should happen, but put it back on standby
+            pipeline.rewind(pipe)
             return
-        elif self.player.current_state != Gst.State.PLAYING:
-            #a pure play button release, and we're not yet playing, so start
-            self.log.info('playing by button release')
+
+        if self._trick_rate is not None and self._trick_rate < 0:
+            #rewound all the way to the start; carry on playing from there
+            self.log.debug('rewound to start of stream')
+            self._trick_rate = None
+            self.transport.seek(lambda: self._seek_rate(1.0, 0))
+            return
+
+        self.log.debug('got end of stream, resetting')
+        _EOS.inc()
+        self._trick_rate = None
+        with self._seq_lock:
+            self._seq_queued = None
+        if self.fade_in:
+            #silent again for the next fade in
+            volume.set_level(pipe, 0.0)
+        self.last_fin = time.time()
+        self._save_stopped()
+        #back to standby at the start of the file
+        self.transport.stop()
+        self._sync_selection()
+        if self.sequence is not None:
+            self._sequence_after_eos()
+        self._upd_evt.set()
+
+
+    def _about_to_finish(self, pipe):
+        """Handles a pipeline having decoded all of its file: if the next file
+        in the sequence follows on without a pause or crossfade, it's queued
+        onto the pipeline, which starts playing it without a gap.
+
+        Context: streaming thread"""
+        with self._seq_lock:
+            #checked under the lock, so that a stop or switch (which closes
+            #the pipeline first) can't come between the check and queuing
+            if pipe != self.player or pipe == self._seq_closed\
+            or self._trick_rate is not None\
+            or self.transport.state != transport.PLAYING:
+                return
+            step = self.sequence.next(self.cur_file)
+            if step is None or step.pause or step.crossfade:
+                return
+            self.log.debug('queuing %s to follow on', step.path)
+            self._seq_queued = (pipe, step)
+            pipe.set_property('uri', self.pool.uri(step.path))
+
+
+    def _on_stream_start(self, pipe, msg):
+        """Handles a pipeline starting a stream. If it's the file queued to
+        follow on, that becomes the current file, with the pipeline now
+        filed under it.
+
+        Context: controller thread"""
+        with self._seq_lock:
+            if self._seq_queued is None or self._seq_queued[0] != pipe:
+                return
+            step = self._seq_queued[1]
+            self._seq_queued = None
+        if pipe != self.player:
+            return
+
+        self.log.info('following on with %s', step.path)
+        _EOS.inc()
+        self.last_fin = time.time()
+        self.sequence.moved(step)
+        if step.path != self.cur_file:
+            #any pipeline on standby for the new file isn't needed now, and
+            #the current one no longer plays the old file
+            self.pool.discard(step.path)
+            self.pool.rename(self.cur_file, step.path)
+            self._stale.discard(self.cur_file)
+        self.cur_file = step.path
+        self.cur_file_base = os.path.basename(step.path)
+        pos = self.library.index_of(step.path)
+        if pos is not None:
+            self.cur_fileno = pos
+        self.cur_filelen = self.library.duration(step.path)
+        if not self.cur_filelen:
+            (ok, dur) = pipe.query_duration(Gst.Format.TIME)
+            self.cur_filelen = dur if ok else 0
+        self.state.update(file=self.cur_file_base, position=0, mode='play')
+        self.pool.prefetch(self._standby_files())
+        self._upd_evt.set()
+
+
+    def _sequence_after_eos(self):
+        """Selects the next file in the sequence once the current one has
+        played to its end without following on, and starts it after the
+        transition's pause.
+
+        Context: controller thread"""
+        step = self.sequence.next(self.cur_file)
+        if step is None:
+            self.log.info('end of sequence')
+            return
+        pos = self.library.index_of(step.path)
+        if pos is None:
+            return
+        self.sequence.moved(step)
+        self._select_file(pos)
+        self.log.info('next in sequence: %s, after %.1f s', step.path,
+            step.pause)
+        self._seq_timer = self.sched.call_later(step.pause, self.ctl.submit,
+            'sequence', self._sequence_play)
+
+
+    def _sequence_play(self):
+        """Starts playing the next file in the sequence, after its pause.
+
+        Context: controller thread"""
+        self._seq_timer = None
+        if not self.transport.playing:
             self._play()
-        else:
-            self.log.debug('already playing, ignoring play button release')
 
 
-    def _h_stop_r(self):
-        self.log.debug('stop button pressed')
+    def _arm_crossfade(self, pipe, lead):
+        """Schedules crossfading from the given (current) pipeline into the
+        next file in the sequence, in lead float seconds, unless that's
+        already scheduled.
 
+        Context: controller thread"""
+        if pipe != self.player or self._xfade_timer is not None:
+            return
+        self._xfade_timer = self.sched.call_later(lead, self.ctl.submit,
+            'crossfade', self._crossfade, pipe)
 
-    def _h_stop_f(self):
-        """Stop button released, stop playing if currently playing."""
-        self.log.debug('stop button released')
 
-        if self.player.current_state == Gst.State.PLAYING:
-            self.player.set_state(Gst.State.READY)
-            self.player.get_state(timeout=Gst.CLOCK_TIME_NONE)
-            self.last_fin = time.time()
-            self._upd_evt.set()
-            self.log.info('stopping by button release')
+    def _crossfade(self, pipe):
+        """Crossfades from the given pipeline, if it's still the current one
+        and nearly at its end, into the next file in the sequence, which
+        becomes the current file.
 
-        #also cancel any fast-forward/rewind timers
-        if self._timer_rw is not None:
-            try:
-                self._timer_rw.cancel()
-            except Exception as e:
-                log.debug('error canceling rw timer: %s', e)
-        if self._timer_ff is not None:
-            try:
-                self._timer_ff.cancel()
-            except Exception as e:
-                log.debug('error canceling ff timer: %s', e)
+        Context: controller thread"""
+        self._xfade_timer = None
+        if pipe != self.player or self._trick_rate is not None\
+        or self.transport.state != transport.PLAYING:
+            return
+        step = self.sequence.next(self.cur_file)
+        if step is None or step.pause or not step.crossfade\
+        or step.path == self.cur_file:
+            #the file plays to its end instead
+            return
+        (ok, cur_pos) = pipe.query_position(Gst.Format.TIME)
+        if ok and self.cur_filelen - cur_pos > (step.crossfade + 0.5) * 10**9:
+            #sought back since the crossfade was scheduled
+            return
+        pos = self.library.index_of(step.path)
+        if pos is None:
+            return
 
-        #also throw out saved scene play button press times
-        self._scp_times = []
+        self.log.info('crossfading into %s over %.1f s', step.path,
+            step.crossfade)
+        #the old file carries on until it's faded out, then goes back on
+        #standby
+        self._start_fade(pipe, None, 0.0, step.crossfade,
+            functools.partial(self._retire, pipe, self.cur_file))
+        self.last_fin = time.time()
+        self.sequence.moved(step)
+        self._select_file(pos)
+        self._start_fade(self.player, 0.0, self.level / 100.0, step.crossfade)
+        self.transport.play()
+        self._upd_evt.set()
 
 
-    def _h_rw_r(self):
-        """Rewind button pressed; user may either be trying to rewind or
-        cycle the MP3 to be played."""
-        self.log.debug('rewind button pressed')
+    def _cancel_sequence(self):
+        """Cancels any pending start of, or crossfade into, the next file in
+        the sequence, as when the file is stopped or switched by hand.
 
-        if self._in_states[self.pin_play]:
-            #play is currently pressed, so this will be a request to change the
-            #MP3 (on release), so we do nothing yet
-            pass
-        else:
-            #play not pressed, so this is the start of a rewind command
-            self.log.debug('starting rewind hold timer')
-            self._timer_rw = threading.Timer(self.skip_hold_time, self._rw_held)
-            self._timer_rw.start()
+        Context: controller thread"""
+        if self._seq_timer is not None:
+            self._seq_timer.cancel()
+            self._seq_timer = None
+        if self._xfade_timer is not None:
+            self._xfade_timer.cancel()
+            self._xfade_timer = None
 
 
-    def _h_rw_f(self):
-        """Rewind button released."""
-        self.log.debug('rewind button released')
+    def _unqueue(self, pipe):
+        """Forgets the file queued to follow on in the given pipeline, if there
+        is one, returning whether there was. A pipeline can't be made to drop
+        it, so the caller must throw the pipeline out.
 
-        if self._in_states[self.pin_play]:
-            #play is pressed, so this is an MP3 change
-            self.log.info('switching to previous mp3')
-            self.last_fin = time.time()
-            self._switch_file(forward=False)
+        Nothing more is queued onto the pipeline until it plays again.
+
+        Context: controller thread"""
+        with self._seq_lock:
+            self._seq_closed = pipe
+            if self._seq_queued is None or self._seq_queued[0] != pipe:
+                return False
+            self._seq_queued = None
+            return True
+
+
+    def _refresh_stale(self, path):
+        """Throws out the pipeline for the given file if it was left playing
+        the file's old contents, now that it has stopped. If it's the current
+        file, a fresh pipeline for it becomes the current player.
+
+        Context: controller thread"""
+        if path not in self._stale\
+        or (path == self.cur_file and self.transport.playing):
+            #playing again already; left until it next stops
+            return
+        self._stale.discard(path)
+        self.log.info('replacing the pipeline for %s, which had its old '
+            'contents', path)
+        self.pool.discard(path)
+        if path == self.cur_file:
+            self._set_player(self.pool.activate(path))
+            self.cur_filelen = self.library.duration(path)
             self._upd_evt.set()
-            self._ign_play = True
+
+
+    def _retire(self, pipe, path):
+        """Puts the given old player back on standby, once it has finished
+        playing (as after fading out), or throws it out if its file has
+        changed since.
+
+        Context: controller thread"""
+        if path in self._stale and path != self.cur_file:
+            self._refresh_stale(path)
         else:
-            #a rewind request
-            if self._timer_rw is not None:
-                self.log.debug('rewind hold timer canceled')
-                self._timer_rw.cancel()
-            if not self._ign_rw:
-                self.log.info('rewinding by button release')
-                self._skip_backward()
-            else:
-                self.log.debug('rewind release actuation masked by hold')
-                self._ign_rw = False
+            pipeline.rewind(pipe)
+
+
+    def _discard_standby(self, path):
+        """Throws out the pipeline for the given file, unless it has become
+        the current file again.
 
+        Context: controller thread"""
+        if path != self.cur_file:
+            self.pool.discard(path)
 
-    def _h_ff_r(self):
-        """Fast-forward button pressed; may be start of either fast-forward or
-        MP3 cycle."""
-        self.log.debug('fast-forward button pressed')
 
-        if self._in_states[self.pin_play]:
-            #play is pressed, so MP3 cycle is starting
-            pass
+    def _on_error(self, path, pipe, msg):
+        """Handles an error from a player. If it's the current one, playing
+        stops. The failed pipeline is thrown out and rebuilt when next needed.
+
+        Context: controller thread"""
+        (err, debug) = msg.parse_error()
+        self.log.error('player error for %s from %s: %s (%s)', path,
+            msg.src.get_name(), err.message, debug)
+        recorder.RECORDER.record(recorder.ERROR, self._rec_source,
+            recorder.RECORDER.name('%s: %s' % (os.path.basename(path),
+                err.message)))
+        if pipe == self.player:
+            self.transport.fail('error message from pipeline')
         else:
-            #play not pressed, so this is the start of a fast-forward
-            self.log.info('starting fast-forward timer')
-            self._timer_ff = threading.Timer(self.skip_hold_time, self._ff_held)
-            self._timer_ff.start()
+            self.pool.discard(path)
+
+
+    def _on_warning(self, path, pipe, msg):
+        """Handles a warning from a player, such as of audio being dropped.
+        Warnings are only noted; if playing has actually stalled, the health
+        check notices.
+
+        Context: event loop thread"""
+        (err, debug) = msg.parse_warning()
+        self.log.warning('player warning for %s from %s: %s (%s)', path,
+            msg.src.get_name(), err.message, debug)
+        recorder.RECORDER.record(recorder.ERROR, self._rec_source,
+            recorder.RECORDER.name('warning: %s: %s' % (
+                os.path.basename(path), err.message)))
+        if pipe == self.player:
+            watchdog.WARNINGS.inc()
+
+
+    def _transport_failed(self, pipe):
+        """Handles the current player failing a transition (or posting an
+        error). If it was playing, it's recovered if possible; otherwise it's
+        thrown out and a fresh one is built.
+
+        Context: controller thread"""
+        self._trick_rate = None
+        with self._seq_lock:
+            self._seq_queued = None
+        if self.wd_enabled and (self._was_playing or\
+        self._recovery is not None) and self._recover('pipeline failed'):
+            return
+        self._abandon()
 
 
-    def _h_ff_f(self):
-        """Fast-forward button released."""
-        self.log.debug('fast-forward button released')
+    def _abandon(self):
+        """Gives up on the current player: it's thrown out, and a fresh one
+        is built, stopped at the start of the file.
 
-        if self._in_states[self.pin_play]:
-            #play is pressed, so this is an MP3 change
-            self.log.info('switching to next mp3')
-            self.last_fin = time.time()
-            self._switch_file()
+        Context: controller thread"""
+        self._trick_rate = None
+        self.last_fin = time.time()
+        self._save_stopped()
+        self.pool.discard(self.cur_file)
+        self._set_player(self.pool.activate(self.cur_file))
+        self._upd_evt.set()
+
+
+    def _check_health(self):
+        """Checks that the current file's position is advancing while
+        playing, recovering if it has stalled, then schedules checking again.
+
+        Context: controller thread"""
+        self.sched.call_later(self.wd_interval, self.ctl.submit, 'health',
+            self._check_health)
+        if self.transport.state != transport.PLAYING:
+            return
+        (ok, pos) = self.player.query_position(Gst.Format.TIME)
+        if not ok:
+            #no position is as good as one that's stuck
+            pos = self.stalls.last_pos
+        if self.stalls.check(scheduler.monotonic(), pos):
+            watchdog.STALLS.inc()
+            if not self._recover('position stuck at %.1f s' % (
+                (pos or 0) / 1e9)):
+                self._abandon()
+
+
+    def _recover(self, reason):
+        """Rebuilds the current player after it has stalled or failed while
+        playing, and has it carry on playing from the last position it was
+        seen at. Returns False, without doing anything, if recoveries have
+        been failing too often, in which case the caller should give up on
+        playing.
+
+        Context: controller thread"""
+
+        now = scheduler.monotonic()
+        while self._recoveries\
+        and now - self._recoveries[0] > self.RECOVERY_WINDOW:
+            self._recoveries.popleft()
+
+        #a failure during a recovery carries on with the same one
+        (started, pos) = (now, self.stalls.last_pos)
+        if self._recovery is not None:
+            (started, timer, last_pos) = self._recovery
+            timer.cancel()
+            self._recovery = None
+            if pos is None:
+                pos = last_pos
+
+        if len(self._recoveries) >= self.wd_max_attempts:
+            self.log.error('%s, and %d recoveries in the last %d s; giving '
+                'up', reason, len(self._recoveries), self.RECOVERY_WINDOW)
+            watchdog.FAILURES.inc()
+            return False
+        self._recoveries.append(now)
+
+        pos = pos or 0
+        self.log.error('%s, rebuilding player to carry on from %.1f s',
+            reason, pos / 1e9)
+        watchdog.RECOVERIES.inc()
+        recorder.RECORDER.record(recorder.ERROR, self._rec_source,
+            recorder.RECORDER.name('recovering: %s' % reason))
+        recorder.RECORDER.dump_async('recovery')
+
+        self._trick_rate = None
+        self._cancel_fade(self.player)
+        self.pool.discard(self.cur_file)
+        self._set_player(self.pool.activate(self.cur_file))
+        self.stalls.reset()
+        self._recovery = (started, self.sched.call_later(self.wd_recover_time,
+            self.ctl.submit, 'health', self._recovery_timed_out, started),
+            pos)
+        #both are queued until the new player has prerolled
+        if pos:
+            self.transport.seek(lambda: self._seek_rate(1.0, pos))
+        self._play()
+        return True
+
+
+    def _recovery_timed_out(self, started):
+        """Handles a recovery not getting back to playing in time: it's tried
+        again, unless that's been failing too often.
+
+        Context: controller thread"""
+        if self._recovery is None or self._recovery[0] != started:
+            return
+        if not self._recover('recovery timed out'):
+            self._abandon()
+
+
+    def _on_state_changed(self, pipe, msg):
+        """Handles a change in a player's state.
+
+        Context: event loop thread"""
+        if msg.src != pipe or pipe != self.player:
+            #ignore the state changes of the player's internal elements, and
+            #of players on standby
+            return
+        (old, new, pending) = msg.parse_state_changed()
+        recorder.RECORDER.record(recorder.GST_STATE, self._rec_source,
+            recorder.RECORDER.name(self.cur_file_base), int(old), int(new))
+        self.log.debug('player state changed from %s to %s',
+            Gst.Element.state_get_name(old), Gst.Element.state_get_name(new))
+        if not self.cur_filelen:
+            #first chance to learn the length of a freshly prerolled file
+            self.ctl.submit('duration', self._take_duration, pipe, False)
+        self.ctl.submit('gst_state', self.transport.handle_message, pipe, msg)
+        self._upd_evt.set()
+
+
+    def _on_async_done(self, pipe, msg):
+        """Handles a player finishing an asynchronous state change (such as
+        prerolling after a seek).
+
+        Context: event loop thread"""
+        if pipe == self.player:
+            self.ctl.submit('gst_state', self.transport.handle_message, pipe,
+                msg)
+
+
+    def _on_duration_changed(self, pipe, msg):
+        """Handles a change in the stream duration.
+
+        Context: event loop thread"""
+        if pipe != self.player:
+            return
+        self.log.debug('stream duration changed')
+        self.ctl.submit('duration', self._take_duration, pipe, True)
+
+
+    def _take_duration(self, pipe, replace):
+        """Takes the length of the current file from the given pipeline, if
+        it's still the current player (rather than one for a file selected
+        since), and if the length isn't known yet or replace is True.
+
+        Context: controller thread"""
+        if pipe != self.player or (self.cur_filelen and not replace):
+            return
+        (ok, dur) = pipe.query_duration(Gst.Format.TIME)
+        if ok:
+            self.cur_filelen = dur
             self._upd_evt.set()
-            self._ign_play = True
+
+
+    def _input_cb(self, pin, istate):
+        """Callback for GPIO event detection. Only timestamps the edge and
+        queues it for the controller, so it never blocks.
+
+        Context: callback thread"""
+
+        stamp = scheduler.monotonic()
+
+        if self.invert_logic:
+            #inverted logic, button depressed represented by digital 0 (false)
+            newState = not bool(istate)
         else:
-            #a fast-forward request
-            if self._timer_ff is not None:
-                self.log.debug('fast-forward hold timer canceled')
-                self._timer_ff.cancel()
-            if not self._ign_ff:
-                self.log.info('fast-forwarding by button release')
-                self._skip_forward()
-            else:
-                self.log.debug('fast-forward release actuation masked by hold')
-                self._ign_ff = False
+            #straight logic, button depressed represented by digital 1 (true)
+            newState = bool(istate)
+
+        recorder.RECORDER.record(recorder.EDGE, self._rec_source, 0, pin,
+            newState, stamp=stamp)
+        self.ctl.submit('edge', self._handle_edge, pin, newState, stamp,
+            stamp=stamp)
+        _INPUT_CB_TIME.observe(scheduler.monotonic() - stamp)
 
 
-    def _h_scene_r(self):
-        """Scene play button pressed."""
-        self.log.info('scene button pressed')
-        self._bl_locked = True
+    def _handle_edge(self, pin, newState, stamp):
+        """Handles an input edge: notes the new input level, and passes button
+        edges on to the gesture recognizer.
 
-        if self.player.current_state == Gst.State.PLAYING\
-        and self.player.query_position(Gst.Format.TIME)[1] > self.scp_err_time:
-            #still being pressed even after playing should have started and been
-            #noticed at the scene
-            self.log.warning('scene button press exceeds play threshold, scene may not have sound')
-            color = self.color_play_err
+        Context: controller thread"""
+        self._in_states[pin] = newState
+        start = scheduler.monotonic()
+        if pin == self.pin_sctoggle:
+            self._sctoggle_changed(newState)
         else:
-            color = self.color_scene_tap
+            if pin == self.pin_scene:
+                self._scene_changed(newState)
+            self.gestures.edge(self._button_names[pin], newState, stamp)
+        _EDGE_TIME.observe(scheduler.monotonic() - start)
 
-        self.lcd.set_backlight(*color)
 
+    def _dispatch(self, action, phase, count):
+        """Runs the player's part of a recognized gesture.
 
-    def _h_scene_f(self):
-        """Scene play button released."""
-        self.log.info('scene button released')
+        Context: controller thread"""
+        recorder.RECORDER.record(recorder.ACTION, self._rec_source,
+            recorder.RECORDER.name(action), recorder.RECORDER.name(phase),
+            count)
+        func = self._actions[action].get(phase)
+        if func is None:
+            return
+        hist = self._action_time.get(action)
+        if hist is None:
+            hist = self._action_time[action] = metrics.REGISTRY.histogram(
+                'nplayer_action_seconds', 'Time taken by gesture actions',
+                action=action, **self._labels)
+        start = scheduler.monotonic()
+        func()
+        hist.observe(scheduler.monotonic() - start)
+
+
+    def _scene_changed(self, pressed):
+        """Handles the scene button going down or up: while it's down, the
+        backlight shows that it's being pressed (or that it has been pressed
+        for too long since playing started).
+
+        Context: controller thread"""
+
+        if pressed:
+            self.log.info('scene button pressed')
+            self._bl_locked = True
+
+            if self.transport.state == transport.PLAYING\
+            and self.player.query_position(Gst.Format.TIME)[1] > self.scp_err_time:
+                #still being pressed even after playing should have started and been
+                #noticed at the scene
+                self.log.warning('scene button press exceeds play threshold, scene may not have sound')
+                color = self.color_play_err
+            else:
+                color = self.color_scene_tap
 
-        now = time.time()
+            self.lcd_writer.show(backlight=color)
+            recorder.RECORDER.record(recorder.BACKLIGHT, self._rec_source,
+                recorder.RECORDER.name(repr(color)))
+            if color is self.color_play_err:
+                #keep what led up to it
+                recorder.RECORDER.dump_async('play_err')
 
-        #unlock our backlight color setting and let the update loop determine
-        #what the color should be
-        self._bl_locked = False
+        else:
+            self.log.info('scene button released')
+            #unlock our backlight color setting and let the update loop
+            #determine what the color should be
+            self._bl_locked = False
+            self._upd_evt.set()
+            if self._in_states[self.pin_sctoggle]:
+                _SCENE_TAPS.inc()
+
+
+    def _sctoggle_changed(self, enabled):
+        """Handles the scene toggle being switched: enabled is automatic mode
+        (scene button taps start playing), disabled is manual mode.
+
+        Context: controller thread"""
+        if enabled:
+            self.log.info('scene toggle enabled (enter auto mode)')
+            self.color_stopped = self.color_stop_auto
+        else:
+            self.log.info('scene toggle disabled (enter manual mode)')
+            self.color_stopped = self.color_stop_manu
+        #taps made in the other mode don't count
+        self.gestures.reset('scene')
         self._upd_evt.set()
 
-        if self._in_states[self.pin_sctoggle]:
-            #scene play button is enabled
 
-            self._scp_times.append(now)
-            if len(self._scp_times) == self.scp_hits:
-                #we have enough hits now
-                if now - self._scp_times[0] <= float(self.scp_span):
-                    #hits occurred within necessary timespan
-                    if self.player.current_state != Gst.State.PLAYING:
-                        self.log.info('playing by scene button press')
-                        self._play()
+    def _a_play(self):
+        """Play button tapped: start playing if not already (or if stopping,
+        carry on playing)."""
+        if not self.transport.playing:
+            self.log.info('playing by button release')
+            self._play()
+        elif self._fades.get(self.player, (None,))[0] == 0.0:
+            self.log.info('carrying on playing by button release')
+            self._start_fade(self.player, None, self.level / 100.0,
+                self.fade_in)
+        else:
+            self.log.debug('already playing, ignoring play button release')
 
-                    self._scp_times = []
-                else:
-                    #first hit was too old
-                    self.log.debug('expired old scene button hit')
-                    self._scp_times.pop(0)
-                    self.log.debug('%d scene button hits left to actuate',
-                        self.scp_hits - len(self._scp_times))
-            else:
-                self.log.debug('%d scene button hits left to actuate',
-                    self.scp_hits - len(self._scp_times))
 
+    def _a_stop(self):
+        """Stop button tapped: stop playing (after fading out) if currently
+        playing."""
+        if self.transport.playing:
+            self._fade_out(self.player, functools.partial(self._stop_faded,
+                self.player))
+            self.last_fin = time.time()
+            self._save_stopped()
+            self._upd_evt.set()
+            self.log.info('stopping by button release')
+
+        #also cancel any stepped fast-forward/rewind, and the sequence
+        #carrying on
+        self._cancel_stepping()
+        self._cancel_sequence()
+
+        #also throw out scene button taps so far
+        self.gestures.reset('scene')
 
-    def _h_sctoggle_r(self):
-        """Scene toggle enabled (going into automatic mode)."""
-        self.log.info('scene toggle enabled (enter auto mode)')
-        #set the color to be used when playing is stopped
-        self.color_stopped = self.color_stop_auto
+
+    def _a_next_file(self):
+        """Fast-forward tapped while play is held: switch to the next file."""
+        self.log.info('switching to next mp3')
+        self.last_fin = time.time()
+        self._switch_file()
         self._upd_evt.set()
 
 
-    def _h_sctoggle_f(self):
-        """Scene toggle disabled (going into manual mode)."""
-        self.log.info('scene toggle disabled (enter manual mode)')
-        self.color_stopped = self.color_stop_manu
+    def _a_prev_file(self):
+        """Rewind tapped while play is held: switch to the previous file."""
+        self.log.info('switching to previous mp3')
+        self.last_fin = time.time()
+        self._switch_file(forward=False)
+        self._upd_evt.set()
+
+
+    def _a_botched(self):
+        """Play released before fast-forward/rewind in a file switch."""
+        self.log.warning(
+            'botched switch file attempt (must release ff/rw first)')
+        _BOTCHED_SWITCHES.inc()
+
+
+    def _a_scene_play(self):
+        """Scene button tapped enough times quickly enough: start playing, if
+        the scene button is enabled."""
+        if not self._in_states[self.pin_sctoggle]:
+            return
+        if not self.transport.playing:
+            self.log.info('playing by scene button press')
+            _SCENE_TRIGGERS.inc()
+            self._play()
+
+
+    def _stop_faded(self, pipe):
+        """Stops the given player once it has faded out, if it's still the
+        current one.
+
+        Context: controller thread"""
+        if pipe != self.player:
+            return
+        #rewinding also brings the rate back to normal
+        self._trick_rate = None
+        if self._unqueue(pipe):
+            self.pool.discard(self.cur_file)
+            self._set_player(self.pool.activate(self.cur_file))
+        else:
+            self.transport.stop()
+        self._sync_selection()
         self._upd_evt.set()
 
 
+    def _end_hold(self):
+        """Fast-forward/rewind released after being held: back to playing at
+        normal speed.
+
+        Context: controller thread"""
+        self._cancel_stepping()
+        self._end_trick()
+
+
+    def _cancel_stepping(self):
+        """Cancels any stepped fast-forward/rewind timers."""
+        if self._timer_rw is not None:
+            self._timer_rw.cancel()
+        if self._timer_ff is not None:
+            self._timer_ff.cancel()
+
+
     def _play(self):
-        """Begins playing the current file."""
-        self.player.set_state(Gst.State.PLAYING)
-        self.player.get_state(timeout=Gst.CLOCK_TIME_NONE)
-        self.cur_filelen = self.player.query_duration(Gst.Format.TIME)[1]
+        """Begins playing the current file, fading in. The file is normally
+        already prerolled, so this is just a flip from PAUSED to PLAYING."""
+        self._cancel_sequence()
+        self._start_fade(self.player, 0.0, self.level / 100.0, self.fade_in)
+        self.transport.play()
         self._upd_evt.set()
 
 
     def _skip_forward(self):
         """Skips the playing track forward by the configured skip length."""
-        if self.player.current_state == Gst.State.PLAYING:
-            cur_pos = self.player.query_position(Gst.Format.TIME)[1]
-            new_pos = max(0, cur_pos + self.skip_len*10**9)
-            self.player.seek(1.0, Gst.Format.TIME, Gst.SeekFlags.FLUSH,
-                Gst.SeekType.SET, new_pos, Gst.SeekType.NONE, -1)
-            self.player.get_state(timeout=Gst.CLOCK_TIME_NONE)
-            self._upd_evt.set()
+        self._skip(self.skip_len*10**9)
 
 
     def _skip_backward(self):
         """Skips the playing track backward by the configured skip length."""
-        if self.player.current_state == Gst.State.PLAYING:
-            cur_pos = self.player.query_position(Gst.Format.TIME)[1]
-            new_pos = max(0, cur_pos - self.skip_len*10**9)
-            self.player.seek(1.0, Gst.Format.TIME, Gst.SeekFlags.FLUSH,
-                Gst.SeekType.SET, new_pos, Gst.SeekType.NONE, -1)
-            self.player.get_state(timeout=Gst.CLOCK_TIME_NONE)
+        self._skip(-self.skip_len*10**9)
+
+
+    def _skip(self, offset):
+        """Queues a skip by the given (signed) number of nanoseconds. Skips
+        queued back to back are merged into one seek."""
+        self.ctl.submit('seek', self._seek_by, offset,
+            merge=lambda queued, new: (queued[0] + new[0],), droppable=True)
+
+
+    def _seek_by(self, offset):
+        """Seeks the playing track by the given (signed) number of nanoseconds.
+
+        Context: controller thread"""
+        if self.transport.playing:
+            self.transport.seek(lambda: self._seek_rate_here(1.0, offset))
             self._upd_evt.set()
 
 
     def _rw_held(self):
-        """Handles the rewind button being held down."""
+        """Handles the rewind button being held down: plays backward at the
+        trick play rate until it's released.
+
+        Context: controller thread"""
         self.log.info('rewinding by hold')
-        self._ign_rw = True
-        self._skip_backward()
+        self._start_trick(-self.skip_rate)
+
+
+    def _ff_held(self):
+        """Handles the fast-forward button being held down: plays forward at
+        the trick play rate until it's released.
+
+        Context: controller thread"""
+        self.log.info('fast-forwarding by hold')
+        self._start_trick(self.skip_rate)
+
+
+    def _start_trick(self, rate):
+        """Starts playing at the given rate (negative for backward); the
+        hold gesture's repeats speed it up the longer the button is held.
+
+        Context: controller thread"""
+        if self.transport.playing:
+            self.transport.seek(lambda: self._trick_seek(rate))
+
+
+    def _trick_seek(self, rate):
+        """Seeks to play from the current position at the given trick play
+        rate, if the button driving trick play is still held. If the pipeline
+        can't play at that rate, falls back on skipping in steps. Returns
+        whether the seek was sent.
+
+        Context: controller thread"""
+
+        pin = self.pin_ff if rate > 0 else self.pin_rw
+        if not self._in_states[pin]:
+            #released while the seek was queued
+            return False
+
+        if self._seek_rate_here(rate):
+            self._trick_rate = rate
+            self._upd_evt.set()
+            return True
+
+        if self._trick_rate is None:
+            self.log.warning('cannot play at %.1fx, skipping in steps instead',
+                rate)
+            if rate > 0:
+                self._ff_stepped()
+            else:
+                self._rw_stepped()
+        return False
+
+
+    def _ramp_trick(self):
+        """Doubles the trick play rate (up to the maximum) if the button is
+        still being held.
+
+        Context: controller thread"""
+
+        if self._trick_rate is None:
+            return
+        pin = self.pin_ff if self._trick_rate > 0 else self.pin_rw
+        if not self._in_states[pin]:
+            return
 
+        rate = min(abs(self._trick_rate) * 2, self.skip_rate_max)
+        if rate != abs(self._trick_rate):
+            rate = rate if self._trick_rate > 0 else -rate
+            self.log.debug('trick play rate going to %.1fx', rate)
+            self.transport.seek(lambda: self._trick_seek(rate))
+
+
+    def _end_trick(self):
+        """Returns to playing at normal speed, from wherever trick play got to.
+
+        Context: controller thread"""
+        if self._trick_rate is None:
+            return
+        self._trick_rate = None
+        self.transport.seek(lambda: self._seek_rate_here(1.0))
+        self._upd_evt.set()
+
+
+    def _seek_to(self, pos):
+        """Seeks the playing track to the given position, in nanoseconds.
+
+        Context: controller thread"""
+        if self.transport.playing:
+            self.transport.seek(lambda: self._seek_rate(1.0, pos))
+            self._upd_evt.set()
+
+
+    def _seek_rate_here(self, rate, offset=0):
+        """Seeks the player relative to its current position (by the given
+        signed offset in nanoseconds), playing at the given rate. Returns
+        whether the seek was sent.
+
+        Context: controller thread"""
+        (ok, cur_pos) = self.player.query_position(Gst.Format.TIME)
+        if not ok:
+            return False
+        return self._seek_rate(rate, max(0, cur_pos + offset))
+
+
+    def _seek_rate(self, rate, pos):
+        """Seeks the player to the given position, playing at the given rate.
+        Playing at normal speed uses an accurate seek; trick play seeks to the
+        nearest key unit. Returns whether the seek was accepted.
+
+        Context: controller thread"""
+
+        if rate == 1.0:
+            flags = Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE
+        else:
+            flags = Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT |\
+                Gst.SeekFlags.TRICKMODE
+
+        if rate > 0:
+            return self.player.seek(rate, Gst.Format.TIME, flags,
+                Gst.SeekType.SET, pos, Gst.SeekType.NONE, -1)
+        else:
+            #playing backward runs from the stop position back to the start
+            return self.player.seek(rate, Gst.Format.TIME, flags,
+                Gst.SeekType.SET, 0, Gst.SeekType.SET, pos)
+
+
+    def _rw_stepped(self):
+        """Rewinds in skips for as long as the button is held, for pipelines
+        which can't play backward.
+
+        Context: controller thread"""
+        self._skip_backward()
         if self._in_states[self.pin_rw]:
             #continue with another timer if the button is still down
-            self._timer_rw = threading.Timer(self.skip_hold_time, self._rw_held)
-            self._timer_rw.start()
+            self._timer_rw = self.sched.call_later(self.skip_hold_time,
+                self.ctl.submit, 'rw_held', self._rw_stepped)
 
 
-    def _ff_held(self):
-        """Handles the fast-forward button being help down."""
-        self.log.info('fast-forwarding by hold')
-        self._ign_ff = True
-        self._skip_forward()
+    def _ff_stepped(self):
+        """Fast-forwards in skips for as long as the button is held, for
+        pipelines which can't play at a higher rate.
 
+        Context: controller thread"""
+        self._skip_forward()
         if self._in_states[self.pin_ff]:
-            self._timer_ff = threading.Timer(self.skip_hold_time, self._ff_held)
-            self._timer_ff.start()
+            self._timer_ff = self.sched.call_later(self.skip_hold_time,
+                self.ctl.submit, 'ff_held', self._ff_stepped)
 
 
     def _sync_read_pin(self, pin):
         """Synchronously reads the state of the given pin, taking the logic
         inversion setting into account."""
-        RPIO.setup(pin, RPIO.IN,
-            pull_up_down=(RPIO.PUD_UP if self.invert_logic else RPIO.PUD_DOWN))
-        val = bool(RPIO.input(pin))
+        self.gpio.setup_input(pin, self.invert_logic)
+        val = self.gpio.input(pin)
         if self.invert_logic:
             val = not val
         return val
 
 
     def _switch_file(self, forward=True):
-        """Switches to the next MP3 file, either forward or back."""
-        if self.player.current_state == Gst.State.PLAYING:
-            self.player.set_state(Gst.State.READY)
-            self.player.get_state(timeout=Gst.CLOCK_TIME_NONE)
+        """Switches to the next MP3 file, either forward or back. The new file
+        is normally on standby already, so this just swaps players.
+
+        Context: controller thread"""
+        if not self.files:
+            self.log.warning('library is empty, cannot switch files')
+            return
 
-        incr = 1 if forward else -1
-        self.cur_fileno = (self.cur_fileno + incr) % len(self.files)
+        self._cancel_sequence()
+        if self.transport.playing:
+            #put the old file back on standby, once it's faded out (or throw
+            #it out, if another file is queued to follow on in it)
+            self._trick_rate = None
+            if self._unqueue(self.player):
+                then = functools.partial(self._discard_standby, self.cur_file)
+            else:
+                then = functools.partial(self._retire, self.player,
+                    self.cur_file)
+            self._fade_out(self.player, then)
+            if self.library.index_of(self.cur_file) is None:
+                #it has left the library, so don't keep it around
+                self.pool.discard(self.cur_file)
+
+        self._select_file(self._neighbor_index(1 if forward else -1))
+
+
+    def _select_file(self, fileno):
+        """Makes the file at the given position in self.files the current
+        one."""
+        self.cur_fileno = fileno
         self.cur_file = self.files[self.cur_fileno]
         self.cur_file_base = os.path.basename(self.cur_file)
-        self.player.set_property('uri', 'file://%s'%self.cur_file)
+        self._set_player(self.pool.activate(self.cur_file))
+        self.cur_filelen = self.library.duration(self.cur_file)
+        if not self.cur_filelen:
+            (ok, dur) = self.player.query_duration(Gst.Format.TIME)
+            self.cur_filelen = dur if ok else 0
+        self.stalls.reset()
+
+        if self.cur_file in self._stale:
+            #changed since it was last played, and stopped since
+            self._refresh_stale(self.cur_file)
 
-        with open(self._lastf, 'w') as lastfh:
-            lastfh.write(self.cur_file_base)
+        #preroll the new neighbors
+        self.pool.prefetch(self._standby_files())
+
+        self._save_stopped()
 
 
     @staticmethod
@@ -640,16 +2125,3 @@ class NativityPlayer(object):
         mins = int((secs - lsecs) / 60)
 
         return (mins, lsecs)
-
-
-    @staticmethod
-    def _color_int2tuple(bitmask):
-        """Converts an LCD backlight color bitmask (3-bit bitmask indicating
-        whether to enable or disable the red, green, and blue backlight LEDs,
-        respectively [in order from most-significant to least-significant bit])
-        to a tuple used for the LCD control class."""
-        return (
-            (bitmask >> 2) & 1,
-            (bitmask >> 1) & 1,
-            bitmask & 1
-        )
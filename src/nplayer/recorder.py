@@ -0,0 +1,344 @@
+"""Flight recorder: a fixed-size ring of the player's recent events (input
+edges, gesture actions, transport and pipeline state changes, LCD frames, and
+errors), kept in memory all the time, so that when something goes wrong at a
+scene there's a fine-grained account of what led up to it without leaving
+debug logging on. The ring is written to a dump file on SIGUSR1, on an
+unhandled exception, and when the play error color is shown.
+
+Each event is a fixed-size binary record packed straight into a preallocated
+buffer, so recording one takes well under the time of a log call: no objects
+are kept, nothing is locked, and strings (such as action names) are stored as
+codes into a table of names that's written out with the dump.
+
+Usage: python -m nplayer.recorder DUMP [DUMP...]
+decodes dumps into timelines."""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import signal
+import struct
+import sys
+import threading
+import time
+
+from nplayer import metrics
+from nplayer.scheduler import monotonic
+
+_DUMPS = metrics.REGISTRY.counter('nplayer_recorder_dumps',
+    'Flight recorder dumps written')
+
+#record layout: monotonic time (float seconds), kind, source (the zone's name
+#code), name code, and three values whose meaning depends on the kind
+RECORD = struct.Struct('<dHHHiii')
+_RECORD_SIZE = RECORD.size
+
+#wall clock, bound for recording
+_time = time.time
+
+#kinds of record
+EDGE = 1        #input edge: pin, level
+ACTION = 2      #gesture action run: action name, phase name, count
+TRANSPORT = 3   #transport state change: new state name, old state name
+GST_STATE = 4   #pipeline state change: file name, old state, new state
+LCD = 5         #display frame: first line, mode name, backlight name,
+                #position (ms)
+BACKLIGHT = 6   #backlight shown outside the display frames: effect name
+ERROR = 7       #pipeline error: message
+EXCEPTION = 8   #unhandled exception: where and what
+DUMP = 9        #dump made: reason
+
+KIND_NAMES = {
+    EDGE: 'edge',
+    ACTION: 'action',
+    TRANSPORT: 'transport',
+    GST_STATE: 'gst',
+    LCD: 'lcd',
+    BACKLIGHT: 'backlight',
+    ERROR: 'error',
+    EXCEPTION: 'exception',
+    DUMP: 'dump',
+}
+
+#names of Gst.State values, so that dumps can be decoded without GStreamer
+GST_STATES = ('void', 'null', 'ready', 'paused', 'playing')
+
+#most names kept; events naming others are recorded under name code 0
+MAX_NAMES = 4096
+
+#suffix of dump files
+SUFFIX = '.nprec'
+
+#interval at which the recording clock is brought in line with the monotonic
+#clock, in seconds
+CLOCK_SYNC = 1.0
+
+class Recorder(object):
+    """Ring buffer of event records. It records nothing until configured with
+    a size.
+
+    Context: any thread"""
+
+    def __init__(self):
+        self.log = logging.getLogger('nplayer.recorder')
+        self.size = 0
+        self._buf = bytearray()
+        self._count = itertools.count()
+        self._pack = RECORD.pack_into
+
+        #names stored as codes, and the codes keyed by name
+        self._names = ['']
+        self._codes = {'': 0}
+        self._lock = threading.Lock()
+
+        #difference between the monotonic clock and the wall clock, which is
+        #much cheaper to read; kept up to date by the clock thread
+        self._offset = monotonic() - time.time()
+
+        self.dump_dir = None
+        self.dump_interval = 0.0
+        self.keep = 0
+        #monotonic time of the last automatic dump
+        self._last_dump = None
+
+
+    def configure(self, size, dump_dir, dump_interval=60.0, keep=20):
+        """Allocates the ring for the given number of records (0 to record
+        nothing) and sets where and how often to dump it, then starts keeping
+        the recording clock in line. Should be called once, before
+        recording."""
+        self.size = size
+        self._buf = bytearray(RECORD.size * size)
+        self._count = itertools.count()
+        self.dump_dir = dump_dir
+        self.dump_interval = dump_interval
+        self.keep = keep
+        if size:
+            thread = threading.Thread(target=self._sync_clock, name='recorder')
+            thread.daemon = True
+            thread.start()
+            self.log.info('flight recorder keeping %d events (%.1f MiB)', size,
+                len(self._buf) / 2.0**20)
+
+
+    def name(self, text):
+        """Returns the code for the given name, for recording."""
+        code = self._codes.get(text)
+        if code is None:
+            with self._lock:
+                code = self._codes.get(text)
+                if code is None:
+                    if len(self._names) >= MAX_NAMES:
+                        return 0
+                    code = len(self._names)
+                    self._names.append(text)
+                    self._codes[text] = code
+        return code
+
+
+    def record(self, kind, source=0, code=0, a=0, b=0, c=0, stamp=None):
+        """Records an event of the given kind. source and code are name
+        codes; a, b, and c are integers (see the kinds above). stamp is the
+        monotonic time of the event, if not now."""
+        size = self.size
+        if not size:
+            return
+        if stamp is None:
+            stamp = _time() + self._offset
+        try:
+            self._pack(self._buf, next(self._count) % size * _RECORD_SIZE,
+                stamp, kind, source, code, a, b, c)
+        except struct.error:
+            #a value out of range; not worth failing over
+            pass
+
+
+    def exception(self, where):
+        """Records the exception being handled, and dumps the ring."""
+        (exc_type, exc, tb) = sys.exc_info()
+        self.record(EXCEPTION, code=self.name('%s: %s: %s' % (where,
+            exc_type.__name__ if exc_type else None, exc)))
+        self.dump_async('exception')
+
+
+    def snapshot(self, reason):
+        """Returns a dump of the ring as it is now, as a string: a line of
+        JSON describing it, then the records."""
+        self.record(DUMP, code=self.name(reason))
+        with self._lock:
+            names = list(self._names)
+        data = str(self._buf)
+        header = {
+            'version': 1,
+            'format': RECORD.format,
+            'size': self.size,
+            'reason': reason,
+            'time': time.time(),
+            'monotonic': monotonic(),
+            'pid': os.getpid(),
+            'names': names,
+        }
+        return json.dumps(header) + '\n' + data
+
+
+    def dump(self, reason):
+        """Writes a dump of the ring to the dump directory, deleting the
+        oldest dumps beyond the number to keep. Returns its path, or None if
+        nothing is being recorded."""
+        if not self.size or self.dump_dir is None:
+            return None
+        return self._write(reason, self.snapshot(reason))
+
+
+    def dump_async(self, reason, force=False):
+        """Takes a dump of the ring right away, and writes it out on a thread
+        of its own, unless an automatic dump was made too recently (or force
+        is True). Returns whether a dump was taken."""
+        if not self.size or self.dump_dir is None:
+            return False
+        now = monotonic()
+        with self._lock:
+            if not force and self._last_dump is not None\
+            and now - self._last_dump < self.dump_interval:
+                return False
+            if not force:
+                self._last_dump = now
+        data = self.snapshot(reason)
+        thread = threading.Thread(target=self._write, args=(reason, data),
+            name='recorder-dump')
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+    def _write(self, reason, data):
+        """Writes out a dump, returning its path.
+
+        Context: any thread, usually a dump thread"""
+        try:
+            if not os.path.isdir(self.dump_dir):
+                os.makedirs(self.dump_dir)
+            path = os.path.join(self.dump_dir, 'nplayer-%s-%d-%s%s' % (
+                time.strftime('%Y%m%d-%H%M%S'), os.getpid(), reason, SUFFIX))
+            with open(path, 'wb') as dump_file:
+                dump_file.write(data)
+            _DUMPS.inc()
+            self.log.warning('flight recorder dumped to %s (%s)', path,
+                reason)
+            self._prune()
+            return path
+        except (IOError, OSError) as e:
+            self.log.error('failed dumping flight recorder: %s', e)
+            return None
+
+
+    def _prune(self):
+        """Deletes the oldest dumps beyond the number to keep."""
+        dumps = sorted(name for name in os.listdir(self.dump_dir)
+            if name.endswith(SUFFIX))
+        for name in dumps[:max(0, len(dumps) - self.keep)]:
+            os.remove(os.path.join(self.dump_dir, name))
+
+
+    def _sync_clock(self):
+        """Clock thread body: keeps the offset between the clocks up to date,
+        so that recording times follow the monotonic clock even when the wall
+        clock is set.
+
+        Context: recorder thread"""
+        while True:
+            self._offset = monotonic() - time.time()
+            time.sleep(CLOCK_SYNC)
+
+
+#the player's flight recorder
+RECORDER = Recorder()
+
+def setup(cfg):
+    """Configures the flight recorder from the given config, and has it
+    dumped on SIGUSR1 and on unhandled exceptions. Must be called on the main
+    thread."""
+    RECORDER.configure(cfg.getint('recorder', 'records'),
+        os.path.expanduser(cfg.get('recorder', 'dump_dir')),
+        cfg.getfloat('recorder', 'dump_interval'),
+        cfg.getint('recorder', 'keep'))
+    signal.signal(signal.SIGUSR1,
+        lambda signum, frame: RECORDER.dump_async('signal', force=True))
+
+    prev_hook = sys.excepthook
+    def excepthook(exc_type, exc, tb):
+        RECORDER.record(EXCEPTION, code=RECORDER.name('main: %s: %s' % (
+            exc_type.__name__, exc)))
+        try:
+            RECORDER.dump('exception')
+        finally:
+            prev_hook(exc_type, exc, tb)
+    sys.excepthook = excepthook
+
+
+def decode(data):
+    """Decodes a dump (as a string) into its header dict and a list of
+    records, as (time, kind, source, code, a, b, c) tuples in time order."""
+    (header, sep, body) = data.partition('\n')
+    header = json.loads(header)
+    if header.get('version') != 1:
+        raise ValueError('unknown dump version %r' % header.get('version'))
+    record = struct.Struct(str(header['format']))
+    records = [record.unpack_from(body, offset)
+        for offset in range(0, len(body) - record.size + 1, record.size)]
+    return (header, sorted(rec for rec in records if rec[1]))
+
+
+def describe(header, rec):
+    """Returns a line describing the given record of a dump."""
+    names = header['names']
+    def name(code):
+        return names[code] if code < len(names) else '#%d' % code
+    def gst_state(value):
+        return GST_STATES[value] if 0 <= value < len(GST_STATES) else\
+            str(value)
+
+    (stamp, kind, source, code, a, b, c) = rec
+    if kind == EDGE:
+        what = 'pin %d %s' % (a, 'on' if b else 'off')
+    elif kind == ACTION:
+        what = '%s %s (%d)' % (name(code), name(a), b)
+    elif kind == TRANSPORT:
+        what = '%s -> %s' % (name(a), name(code))
+    elif kind == GST_STATE:
+        what = '%s: %s -> %s' % (name(code), gst_state(a), gst_state(b))
+    elif kind == LCD:
+        what = '%s | %s at %d:%06.3f, %s' % (name(code), name(a),
+            c // 60000, c % 60000 / 1000.0, name(b))
+    else:
+        what = name(code)
+    return '%12.6f %+11.6f %-8s %-9s %s' % (stamp,
+        stamp - header['monotonic'], name(source) or '-',
+        KIND_NAMES.get(kind, str(kind)), what)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Decode nativity player flight recorder dumps')
+    parser.add_argument('dumps', nargs='+', metavar='DUMP',
+        help='dump file to decode')
+    args = parser.parse_args()
+
+    for path in args.dumps:
+        with open(path, 'rb') as dump_file:
+            (header, records) = decode(dump_file.read())
+        print '%s: pid %d, dumped %s (%s), %d of %d events' % (path,
+            header['pid'], time.strftime('%Y-%m-%d %H:%M:%S',
+            time.localtime(header['time'])), header['reason'], len(records),
+            header['size'])
+        print '%12s %11s %-8s %-9s %s' % ('time', 'to dump', 'zone', 'kind',
+            'event')
+        for rec in records:
+            print describe(header, rec)
+        print
+
+
+if __name__ == '__main__':
+    main()
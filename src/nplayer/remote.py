@@ -0,0 +1,422 @@
+"""Remote control of the player, alongside its buttons, over a UNIX domain
+socket and local HTTP, for the operator's laptop and for driving the player
+in tests. Commands run the same actions the buttons' gestures do, on the
+controller thread, and state changes are pushed to subscribers as they
+happen.
+
+Commands are JSON objects with a "cmd" member, and a "zone" member naming the
+zone when there are several:
+    play, stop, next, prev, scene: as the play and stop buttons, switching
+        to the next or previous file, and triggering the scene (if the scene
+        toggle allows it); with "wait": true, play and scene reply once
+        playing has started, giving the time taken
+    skip: skips by "offset" seconds (backward if negative)
+    seek: seeks to "position" seconds
+    volume: sets the playing volume to "percent"
+    state: replies with what each zone is doing
+    subscribe: (socket only) streams state changes until the client
+        disconnects
+Replies are JSON objects with "ok", and "error" if it's false.
+
+Over the socket, commands, replies, and state changes are JSON, one per line.
+Over HTTP, POST /command takes a command as its body, GET /state replies with
+the state, and GET /events streams state changes as server-sent events.
+
+The time from each play or scene command to the player playing is measured
+against a latency budget; commands over budget are logged and counted."""
+
+import BaseHTTPServer
+import json
+import logging
+import os
+import Queue
+import SocketServer
+import threading
+import time
+
+from nplayer import metrics, transport
+from nplayer.scheduler import monotonic
+
+_COMMANDS = metrics.REGISTRY.counter('nplayer_remote_commands',
+    'Remote control commands received')
+_ERRORS = metrics.REGISTRY.counter('nplayer_remote_errors',
+    'Remote control commands refused')
+_PLAY_TIME = metrics.REGISTRY.histogram('nplayer_remote_play_seconds',
+    'Time from remote play commands to playing')
+_OVER_BUDGET = metrics.REGISTRY.counter('nplayer_remote_over_budget',
+    'Remote play commands which took longer than the budget to play')
+_EVENTS_DROPPED = metrics.REGISTRY.counter('nplayer_remote_events_dropped',
+    'State changes not sent to subscribers which were too slow to take them')
+
+#gesture actions run by the simple commands
+ACTIONS = {
+    'play': 'play',
+    'stop': 'stop',
+    'next': 'next_file',
+    'prev': 'prev_file',
+    'scene': 'scene_play',
+}
+
+#commands which start playing, and so are timed against the budget
+PLAY_COMMANDS = ('play', 'scene')
+
+#longest to wait for a command to start playing, in seconds
+PLAY_TIMEOUT = 10.0
+
+#most state changes to hold for each subscriber
+SUBSCRIBER_QUEUE = 100
+
+#time between keepalives on idle event streams, in seconds
+KEEPALIVE = 15.0
+
+class CommandError(Exception):
+    """A remote command which can't be carried out."""
+
+
+class _PendingPlay(object):
+    """A play command waiting for the player to play."""
+
+    __slots__ = ('stamp', 'done', 'latency')
+
+    def __init__(self, stamp):
+        self.stamp = stamp
+        self.done = threading.Event()
+        self.latency = None
+
+
+class RemoteServer(object):
+    """Serves remote control of one or more players (zones).
+
+    Context: commands are taken on server threads, and state changes arrive
+    on the controller thread"""
+
+    def __init__(self, players, http_addr=None, socket_path=None,
+        budget=0.1):
+        """Sets up the servers (without serving anything until start() is
+        called).
+
+        Parameters:
+            dict players: NativityPlayer instances keyed by zone name (None
+                for a single player)
+            tuple http_addr: (host, port) to serve HTTP on, or None
+            str socket_path: path of the UNIX socket to serve on, or None
+            float budget: time allowed from a play command to playing, in
+                seconds"""
+
+        self.log = logging.getLogger('nplayer.remote')
+        self.players = players
+        self.budget = budget
+
+        self._lock = threading.Lock()
+        #play commands yet to play, keyed by zone name
+        self._pending = dict((name, []) for name in players)
+        #queues of subscribers' state changes
+        self._subscribers = set()
+
+        for (name, nplayer) in players.items():
+            nplayer.add_transport_listener(
+                lambda old, new, name=name: self._changed(name, old, new))
+
+        self._servers = []
+        if http_addr is not None:
+            server = _HTTPServer(http_addr, _HTTPHandler)
+            server.remote = self
+            self._servers.append(server)
+            self.log.info('serving remote control at http://%s:%d/',
+                *http_addr)
+
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                #left over from a previous run
+                os.unlink(socket_path)
+            server = _UnixServer(socket_path, _SocketHandler)
+            server.remote = self
+            self._servers.append(server)
+            self.log.info('serving remote control on socket %s', socket_path)
+
+
+    def start(self):
+        """Starts the server threads."""
+        for server in self._servers:
+            thread = threading.Thread(target=server.serve_forever,
+                name='remote')
+            thread.daemon = True
+            thread.start()
+
+
+    def handle(self, request):
+        """Carries out a command (a dict, as decoded from JSON), returning the
+        reply as a dict. Commands waiting for playing block until it starts.
+
+        Context: server thread"""
+
+        stamp = monotonic()
+        _COMMANDS.inc()
+        try:
+            if not isinstance(request, dict):
+                raise CommandError('command must be a JSON object')
+            cmd = request.get('cmd')
+            if cmd == 'state':
+                return {'ok': True, 'state': self.state()}
+            (name, nplayer) = self._player(request.get('zone'))
+
+            if cmd in ACTIONS:
+                pending = None
+                if cmd in PLAY_COMMANDS and not nplayer.transport.playing:
+                    pending = self._expect_play(name, stamp)
+                elif cmd == 'stop':
+                    self._drop_pending(name)
+                nplayer.perform(ACTIONS[cmd], stamp=stamp)
+                if pending is not None and request.get('wait'):
+                    return self._wait_play(name, pending)
+            elif cmd == 'skip':
+                nplayer.skip(self._number(request, 'offset'))
+            elif cmd == 'seek':
+                nplayer.seek_to(max(0.0, self._number(request, 'position')))
+            elif cmd == 'volume':
+                nplayer.set_volume(int(self._number(request, 'percent')))
+            else:
+                raise CommandError('unknown command %r' % cmd)
+        except CommandError as e:
+            _ERRORS.inc()
+            return {'ok': False, 'error': str(e)}
+        return {'ok': True}
+
+
+    def state(self):
+        """Returns what each zone is doing, keyed by zone name (or under
+        "player" if there's only the one player)."""
+        return dict((name or 'player', nplayer.snapshot())
+            for (name, nplayer) in self.players.items())
+
+
+    def subscribe(self):
+        """Returns a queue which will be sent every state change, as a dict,
+        until passed to unsubscribe()."""
+        queue = Queue.Queue(SUBSCRIBER_QUEUE)
+        with self._lock:
+            self._subscribers.add(queue)
+        return queue
+
+
+    def unsubscribe(self, queue):
+        with self._lock:
+            self._subscribers.discard(queue)
+
+
+    def _player(self, zone):
+        """Returns the (name, player) a command is for."""
+        if zone is None:
+            if len(self.players) != 1:
+                raise CommandError('zone must be given, one of %s' %
+                    ', '.join(sorted(self.players)))
+            return self.players.items()[0]
+        if zone not in self.players:
+            raise CommandError('unknown zone %r' % zone)
+        return (zone, self.players[zone])
+
+
+    @staticmethod
+    def _number(request, key):
+        value = request.get(key)
+        if isinstance(value, bool) or not isinstance(value, (int, long,
+        float)):
+            raise CommandError('%s must be a number' % key)
+        return value
+
+
+    def _expect_play(self, name, stamp):
+        """Notes a play command, so that the time until playing is
+        measured."""
+        pending = _PendingPlay(stamp)
+        with self._lock:
+            self._pending[name].append(pending)
+        return pending
+
+
+    def _drop_pending(self, name):
+        """Forgets play commands for a zone, which won't be playing now."""
+        with self._lock:
+            for pending in self._pending[name]:
+                pending.done.set()
+            self._pending[name] = []
+
+
+    def _wait_play(self, name, pending):
+        """Waits for a play command to play, returning the reply."""
+        pending.done.wait(PLAY_TIMEOUT)
+        if pending.latency is None:
+            with self._lock:
+                if pending in self._pending[name]:
+                    self._pending[name].remove(pending)
+            _ERRORS.inc()
+            return {'ok': False, 'error': 'did not start playing'}
+        return {'ok': True, 'latency_ms': pending.latency * 1000}
+
+
+    def _changed(self, name, old, new):
+        """Handles a player's transport state changing: times any play
+        commands waiting for it to play, and tells subscribers.
+
+        Context: controller thread"""
+
+        now = monotonic()
+        if new == transport.PLAYING:
+            with self._lock:
+                pendings = self._pending[name]
+                self._pending[name] = []
+            for pending in pendings:
+                latency = now - pending.stamp
+                if latency > PLAY_TIMEOUT:
+                    #never played, and this is something else
+                    pending.done.set()
+                    continue
+                pending.latency = latency
+                _PLAY_TIME.observe(latency)
+                if latency > self.budget:
+                    _OVER_BUDGET.inc()
+                    self.log.warning('remote play took %.1f ms, over the '
+                        '%.1f ms budget', latency * 1000, self.budget * 1000)
+                pending.done.set()
+
+        event = {'zone': name, 'old': old, 'new': new, 'time': time.time(),
+            'file': self.players[name].cur_file_base}
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for queue in subscribers:
+            try:
+                queue.put_nowait(event)
+            except Queue.Full:
+                _EVENTS_DROPPED.inc()
+
+
+def server_from_config(cfg, players):
+    """Returns a RemoteServer for the given players (as for RemoteServer),
+    set up from the [remote] section of the given config."""
+    port = cfg.getint('remote', 'http_port')
+    socket_path = cfg.get('remote', 'socket_path')
+    return RemoteServer(players,
+        http_addr=(cfg.get('remote', 'http_addr'), port) if port else None,
+        socket_path=(os.path.expanduser(socket_path) if socket_path else
+            None),
+        budget=cfg.getfloat('remote', 'play_budget'))
+
+
+class _HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves POST /command, GET /state, and GET /events."""
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/state':
+            self._reply(200, {'ok': True,
+                'state': self.server.remote.state()})
+        elif path == '/events':
+            self._stream_events()
+        else:
+            self.send_error(404)
+
+
+    def do_POST(self):
+        if self.path.split('?')[0] != '/command':
+            self.send_error(404)
+            return
+        try:
+            length = int(self.headers.getheader('Content-Length', 0))
+            request = json.loads(self.rfile.read(length))
+        except ValueError as e:
+            _ERRORS.inc()
+            self._reply(400, {'ok': False, 'error': 'bad request: %s' % e})
+            return
+        reply = self.server.remote.handle(request)
+        self._reply(200 if reply['ok'] else 400, reply)
+
+
+    def _reply(self, code, reply):
+        body = json.dumps(reply)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def _stream_events(self):
+        """Streams state changes as server-sent events until the client goes
+        away."""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        remote = self.server.remote
+        queue = remote.subscribe()
+        try:
+            while True:
+                try:
+                    event = queue.get(timeout=KEEPALIVE)
+                except Queue.Empty:
+                    self.wfile.write(': keepalive\n\n')
+                else:
+                    self.wfile.write('data: %s\n\n' % json.dumps(event))
+                self.wfile.flush()
+        except IOError:
+            pass
+        finally:
+            remote.unsubscribe(queue)
+
+
+    def log_message(self, fmt, *args):
+        logging.getLogger('nplayer.remote').debug('http: ' + fmt, *args)
+
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _SocketHandler(SocketServer.StreamRequestHandler):
+    """Takes commands as JSON lines, replying to each with a JSON line."""
+
+    def handle(self):
+        remote = self.server.remote
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                _ERRORS.inc()
+                self._send({'ok': False, 'error': 'bad request: %s' % e})
+                continue
+            if isinstance(request, dict) and request.get('cmd') ==\
+            'subscribe':
+                self._stream_events(remote)
+                return
+            self._send(remote.handle(request))
+
+
+    def _send(self, reply):
+        self.wfile.write(json.dumps(reply) + '\n')
+        self.wfile.flush()
+
+
+    def _stream_events(self, remote):
+        """Streams state changes until the client goes away."""
+        queue = remote.subscribe()
+        try:
+            self._send({'ok': True, 'state': remote.state()})
+            while True:
+                try:
+                    event = queue.get(timeout=KEEPALIVE)
+                except Queue.Empty:
+                    #an empty line, to find out if the client's gone
+                    self.wfile.write('\n')
+                    self.wfile.flush()
+                else:
+                    self._send(event)
+        except IOError:
+            pass
+        finally:
+            remote.unsubscribe(queue)
+
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
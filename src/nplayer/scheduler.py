@@ -0,0 +1,160 @@
+"""Monotonic-clock timer queue. A single thread runs all of the player's
+periodic and one-shot work, rather than creating a threading.Timer (and thus a
+new thread) for every delayed call."""
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import heapq
+import itertools
+import logging
+import os
+import select
+import threading
+import time
+
+#clock ID for clock_gettime(2), from <time.h>
+CLOCK_MONOTONIC = 1
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('rt') or
+        ctypes.util.find_library('c'), use_errno=True)
+    _clock_gettime = _libc.clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+except (OSError, AttributeError, TypeError):
+    #no usable libc (not Linux?); fall back on the wall clock
+    _clock_gettime = None
+
+
+def monotonic_ns():
+    """Returns the value of the system monotonic clock in (int) nanoseconds.
+    Falls back on the wall clock if the monotonic clock is unavailable."""
+    if _clock_gettime is None:
+        return int(time.time() * 10**9)
+    ts = _timespec()
+    if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+        return int(time.time() * 10**9)
+    return ts.tv_sec * 10**9 + ts.tv_nsec
+
+
+def monotonic():
+    """Returns the value of the system monotonic clock in float seconds."""
+    return monotonic_ns() / 1e9
+
+
+class Timer(object):
+    """Handle for a call queued on a Scheduler."""
+
+    __slots__ = ('when', 'func', 'args', 'cancelled')
+
+    def __init__(self, when, func, args):
+        self.when = when
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+
+    def cancel(self):
+        """Cancels the call. Has no effect if the call already ran."""
+        self.cancelled = True
+
+
+class Scheduler(object):
+    """Heap-based timer queue serviced by one thread. Calls run in the order of
+    their due times (ties in the order they were queued) on the scheduler
+    thread, so they should not block for long.
+
+    Context: calls may be queued and canceled from any thread"""
+
+    def __init__(self):
+        self.log = logging.getLogger('nplayer.scheduler')
+
+        #heap of (due time, sequence number, Timer)
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._thread = None
+
+        #self-pipe used to wake the scheduler thread; waiting in select()
+        #rather than on a threading.Condition avoids Python 2's polling
+        #implementation of timed waits, which would add up to 50ms of jitter
+        (self._wake_r, self._wake_w) = os.pipe()
+        fcntl.fcntl(self._wake_w, fcntl.F_SETFL,
+            fcntl.fcntl(self._wake_w, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+    def start(self):
+        """Starts the scheduler thread."""
+        self._thread = threading.Thread(target=self._run, name='scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def call_at(self, when, func, *args):
+        """Queues func(*args) to run at the given monotonic time (float
+        seconds). Returns a Timer handle which can be used to cancel it."""
+        timer = Timer(when, func, args)
+        with self._lock:
+            heapq.heappush(self._heap, (when, next(self._seq), timer))
+            #only need to wake the thread if this is the new earliest call
+            wake = self._heap[0][2] is timer
+        if wake:
+            try:
+                os.write(self._wake_w, b'x')
+            except OSError as e:
+                #a full pipe already guarantees a wakeup
+                if e.errno != errno.EAGAIN:
+                    raise
+        return timer
+
+
+    def call_later(self, delay, func, *args):
+        """Queues func(*args) to run after delay (float seconds). Returns a
+        Timer handle which can be used to cancel it."""
+        return self.call_at(monotonic() + delay, func, *args)
+
+
+    def _run(self):
+        """Scheduler thread body.
+
+        Context: scheduler thread"""
+
+        while True:
+            timer = None
+            with self._lock:
+                #drop canceled calls from the front of the queue
+                while self._heap and self._heap[0][2].cancelled:
+                    heapq.heappop(self._heap)
+
+                if not self._heap:
+                    delay = None
+                else:
+                    delay = self._heap[0][0] - monotonic()
+                    if delay <= 0:
+                        timer = heapq.heappop(self._heap)[2]
+
+            if timer is None:
+                #sleep until the next call is due or a new call is queued
+                try:
+                    (readable, _, _) = select.select([self._wake_r], [], [],
+                        delay)
+                    if readable:
+                        os.read(self._wake_r, 4096)
+                except select.error as e:
+                    #interrupted by a signal (such as SIGUSR1 asking for a
+                    #recorder dump); just look at the queue again
+                    if e.args[0] != errno.EINTR:
+                        raise
+                except OSError as e:
+                    if e.errno != errno.EINTR:
+                        raise
+                continue
+
+            try:
+                timer.func(*timer.args)
+            except Exception:
+                self.log.exception('error in scheduled call to %r', timer.func)
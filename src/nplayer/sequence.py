@@ -0,0 +1,128 @@
+"""Sequence mode: files play back to back, each following on from the one
+before by itself, either in library order or in the order of a configured
+playlist. Each transition may have a pause before the next file starts, or a
+crossfade into it; with neither, the next file is queued while the current one
+is still playing, so that there's no gap at all.
+
+The playlist is given in the config file with one entry per line:
+    NAME[; pause=SECS][; crossfade=SECS]
+where NAME is a file in the library, and the settings (defaulting to the
+ones for the whole sequence) are for the transition into that entry."""
+
+import collections
+import logging
+import os
+
+Entry = collections.namedtuple('Entry', ('name', 'pause', 'crossfade'))
+
+#a move to the next (or previous) file in the sequence: the file, its position
+#in the playlist (None if following the library), and the pause and crossfade
+#of the transition between the two files, in float seconds
+Step = collections.namedtuple('Step', ('path', 'pos', 'pause', 'crossfade'))
+
+def parse_playlist(spec, pause, crossfade):
+    """Parses a playlist (see the module docstring), with the given default
+    pause and crossfade, returning a list of Entry instances. Raises
+    ValueError if it's malformed."""
+
+    entries = []
+    for line in spec.splitlines():
+        parts = [part.strip() for part in line.split(';')]
+        if not parts[0]:
+            continue
+        settings = {'pause': pause, 'crossfade': crossfade}
+        for part in parts[1:]:
+            (key, sep, value) = part.partition('=')
+            key = key.strip()
+            if not sep or key not in settings:
+                raise ValueError('bad setting %r for playlist entry %s' %
+                    (part, parts[0]))
+            settings[key] = float(value)
+            if settings[key] < 0:
+                raise ValueError('negative %s for playlist entry %s' % (key,
+                    parts[0]))
+        entries.append(Entry(parts[0], settings['pause'],
+            settings['crossfade']))
+    return entries
+
+
+class Sequence(object):
+    """Order in which files follow each other.
+
+    Context: next() and prev() may be called from any thread; moved() only
+    from the controller thread"""
+
+    def __init__(self, library, entries, pause, crossfade, loop):
+        """Parameters:
+            library.Library library: the files to play
+            list entries: Entry instances for the playlist, or an empty list
+                to follow the library's order
+            float pause, crossfade: pause and crossfade between files when
+                following the library's order, in seconds
+            bool loop: whether to go back to the start after the end"""
+        self.log = logging.getLogger('nplayer.sequence')
+        self.library = library
+        self.entries = entries
+        self.pause = pause
+        self.crossfade = crossfade
+        self.loop = loop
+        #playlist position of the current file, to tell apart entries for
+        #the same file
+        self._pos = 0
+
+
+    def next(self, cur_file):
+        """Returns the Step to the file following the given one, or None if
+        the sequence ends with it."""
+        return self._step(cur_file, 1)
+
+
+    def prev(self, cur_file):
+        """Returns the Step to the file coming before the given one, or None
+        if it's at the start."""
+        return self._step(cur_file, -1)
+
+
+    def moved(self, step):
+        """Notes the sequence having moved on to the given Step."""
+        if step.pos is not None:
+            self._pos = step.pos
+
+
+    def _step(self, cur_file, incr):
+        if not self.entries:
+            files = self.library.files
+            pos = self.library.index_of(cur_file)
+            if pos is None or not files:
+                return None
+            pos += incr
+            if not 0 <= pos < len(files):
+                if not self.loop:
+                    return None
+                pos %= len(files)
+            return Step(files[pos], None, self.pause, self.crossfade)
+
+        name = os.path.basename(cur_file)
+        pos = self._pos
+        if pos >= len(self.entries) or self.entries[pos].name != name:
+            names = [entry.name for entry in self.entries]
+            if name not in names:
+                #switched off the playlist by hand
+                return None
+            pos = names.index(name)
+        pos += incr
+        if not 0 <= pos < len(self.entries):
+            if not self.loop:
+                return None
+            pos %= len(self.entries)
+
+        #the transition into whichever file comes later
+        into = self.entries[max(pos, pos - incr) % len(self.entries)]
+        entry = self.entries[pos]
+        index = self.library.index_of(entry.name)
+        if index is None:
+            self.log.warning('playlist entry %s is not in the library',
+                entry.name)
+            return None
+        return Step(self.library.files[index], pos, into.pause,
+            into.crossfade)
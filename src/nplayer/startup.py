@@ -0,0 +1,144 @@
+"""Startup as a graph of steps, each run as soon as the steps it depends on
+are done, so that independent ones (loading GStreamer, scanning the library,
+initializing the LCD) overlap. Also systemd readiness notification."""
+
+import collections
+import logging
+import os
+import socket
+import sys
+import threading
+
+from nplayer.scheduler import monotonic
+
+class Startup(object):
+    """Dependency graph of startup steps.
+
+    Context: steps run on threads of their own"""
+
+    def __init__(self):
+        self.log = logging.getLogger('nplayer.startup')
+        #(func, names of steps it depends on), keyed by step name
+        self._steps = collections.OrderedDict()
+        #(start, end) monotonic times of each step run, keyed by step name
+        self.timings = {}
+        #monotonic time at which run() was called
+        self.began = None
+
+
+    def add(self, name, func, after=()):
+        """Adds a step, which calls func() once the steps named in after are
+        done."""
+        if name in self._steps:
+            raise ValueError('duplicate startup step %s' % name)
+        self._steps[name] = (func, tuple(after))
+
+
+    def run(self):
+        """Runs every step, returning when all are done. If any fails, the
+        steps depending on it are skipped, and the first failure is raised
+        once the others have finished."""
+
+        self._check()
+        self.began = monotonic()
+        done = dict((name, threading.Event()) for name in self._steps)
+        #(name, exc_info) of each step which failed, and the names of the
+        #failed steps and of the ones skipped because of them
+        failures = []
+        failed = set()
+        skipped = set()
+
+        def run_step(name, func, after):
+            for dep in after:
+                done[dep].wait()
+            try:
+                #a dependency is only done once it's been noted as failed or
+                #skipped, so this covers the dependencies' own dependencies
+                broken = [dep for dep in after
+                    if dep in failed or dep in skipped]
+                if broken:
+                    self.log.warning('skipping startup step %s, since %s '
+                        'did not run', name, ', '.join(broken))
+                    skipped.add(name)
+                    return
+                start = monotonic()
+                func()
+                self.timings[name] = (start, monotonic())
+            except Exception:
+                failures.append((name, sys.exc_info()))
+                failed.add(name)
+            finally:
+                done[name].set()
+
+        threads = []
+        for (name, (func, after)) in self._steps.items():
+            thread = threading.Thread(target=run_step, args=(name, func,
+                after), name='startup-%s' % name)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        self.report()
+        if failures:
+            (name, (exc_type, exc, tb)) = failures[0]
+            self.log.error('startup step %s failed', name)
+            raise exc_type, exc, tb
+
+
+    def report(self):
+        """Logs how long each step took, and when it ran relative to the
+        start."""
+        for (name, (start, end)) in sorted(self.timings.items(),
+        key=lambda item: item[1][0]):
+            self.log.info('startup %-10s +%6.0f ms, took %6.0f ms', name,
+                (start - self.began) * 1000, (end - start) * 1000)
+
+
+    def _check(self):
+        """Makes sure every dependency exists and there are no cycles."""
+        visiting = set()
+        visited = set()
+
+        def visit(name, path):
+            if name not in self._steps:
+                raise ValueError('startup step %s depends on unknown step %s'
+                    % (path[-1], name))
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError('startup steps depend on each other: %s' %
+                    ' -> '.join(path + [name]))
+            visiting.add(name)
+            for dep in self._steps[name][1]:
+                visit(dep, path + [name])
+            visiting.discard(name)
+            visited.add(name)
+
+        for name in self._steps:
+            visit(name, [])
+
+
+def sd_notify(state):
+    """Sends the given state (such as 'READY=1') to systemd, if it's
+    listening. Returns whether it was sent."""
+
+    addr = os.environ.get('NOTIFY_SOCKET')
+    if not addr:
+        return False
+    if addr.startswith('@'):
+        #abstract namespace socket
+        addr = '\0' + addr[1:]
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.connect(addr)
+        sock.sendall(state)
+    except socket.error as e:
+        logging.getLogger('nplayer.startup').error(
+            'failed notifying systemd of %r: %s', state, e)
+        return False
+    finally:
+        sock.close()
+    return True
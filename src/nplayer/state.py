@@ -0,0 +1,173 @@
+"""Persistent player state (current file, position within it, volume, and
+play mode), so that the player can pick up where it left off after a restart
+or power cut. Changes are written by a background thread, debounced and
+coalesced, and each write replaces the state file atomically."""
+
+import atexit
+import json
+import logging
+import os
+import threading
+
+from nplayer.scheduler import monotonic
+
+class StateStore(object):
+    """Player state, saved to a file in the background.
+
+    Context: any thread"""
+
+    #version of the state file format
+    VERSION = 1
+
+    #fields kept, with their defaults
+    DEFAULTS = {'file': None, 'position': 0, 'volume': None, 'mode': 'stop'}
+
+    def __init__(self, path, debounce=1.0, max_delay=3.0):
+        """Sets up the store (without reading anything yet).
+
+        Parameters:
+            str path: path of the state file
+            float debounce: time to wait after a change for more changes
+                before writing, in seconds
+            float max_delay: longest time to hold off writing a change while
+                more keep coming, in seconds"""
+
+        self.log = logging.getLogger('nplayer.state')
+        self.path = path
+        self.debounce = debounce
+        self.max_delay = max_delay
+
+        self._state = dict(self.DEFAULTS)
+        self._cond = threading.Condition()
+        #monotonic times of the first and last changes not yet written, or
+        #None if everything is written
+        self._first_change = None
+        self._last_change = None
+        self._thread = None
+        #held while writing, so that a flush and the writer thread don't
+        #write at once
+        self._write_lock = threading.Lock()
+
+        #number of writes done, and changes folded into them
+        self.writes = 0
+        self.updates = 0
+
+
+    def load(self):
+        """Reads the state file, returning the state as a dict. Old state
+        files holding just a file name are understood too."""
+        try:
+            with open(self.path) as fh:
+                data = fh.read()
+        except IOError as e:
+            self.log.info('no saved state at %s (%s)', self.path, e)
+            return dict(self._state)
+
+        try:
+            saved = json.loads(data)
+            if not isinstance(saved, dict) or\
+            saved.get('version') != self.VERSION:
+                raise ValueError('unknown state format')
+        except ValueError:
+            #the old format: the last file's name on the first line
+            lines = data.splitlines()
+            saved = {'file': lines[0].strip() if lines else None}
+
+        with self._cond:
+            for key in self.DEFAULTS:
+                if saved.get(key) is not None:
+                    self._state[key] = saved[key]
+            return dict(self._state)
+
+
+    def start(self):
+        """Starts the writer thread, also arranging for pending changes to be
+        written at exit."""
+        self._thread = threading.Thread(target=self._run, name='state')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.flush)
+
+
+    def update(self, **fields):
+        """Changes the given fields, scheduling a write if anything actually
+        changed."""
+        with self._cond:
+            changed = False
+            for (key, value) in fields.items():
+                if key not in self.DEFAULTS:
+                    raise KeyError('unknown state field %s' % key)
+                if self._state[key] != value:
+                    self._state[key] = value
+                    changed = True
+            if not changed:
+                return
+            self.updates += 1
+            now = monotonic()
+            if self._first_change is None:
+                self._first_change = now
+            self._last_change = now
+            self._cond.notify()
+
+
+    def flush(self):
+        """Writes any pending changes right away."""
+        self._write_pending()
+
+
+    def _write_pending(self):
+        """Writes the state if there are changes pending. Writes are done one
+        at a time, so that an older state never replaces a newer one."""
+        with self._write_lock:
+            with self._cond:
+                if self._first_change is None:
+                    return
+                self._first_change = None
+                self._last_change = None
+                state = dict(self._state)
+            state['version'] = self.VERSION
+            self._write(state)
+
+
+    def _run(self):
+        """Writer thread body.
+
+        Context: state writer thread"""
+
+        while True:
+            with self._cond:
+                while self._first_change is None:
+                    self._cond.wait()
+                #wait for changes to settle, but not forever
+                while self._first_change is not None:
+                    due = min(self._last_change + self.debounce,
+                        self._first_change + self.max_delay)
+                    remaining = due - monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            self._write_pending()
+
+
+    def _write(self, state):
+        """Writes the state file, replacing the old one atomically and making
+        sure it's on disk. Caller must hold the write lock."""
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as fh:
+                json.dump(state, fh)
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.rename(tmp_path, self.path)
+            #make the rename itself durable
+            dir_fd = os.open(os.path.dirname(os.path.abspath(self.path)),
+                os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        except (IOError, OSError) as e:
+            self.log.error('failed saving state to %s: %s', self.path, e)
+            return
+        self.writes += 1
+        self.log.debug('state saved: %s', state)
@@ -0,0 +1,240 @@
+"""State machine for the transport (play/stop/seek) of the current pipeline.
+Transitions are started without waiting on GStreamer and completed when the
+pipeline reports back on its bus, so that nothing ever blocks on a state
+change. Requests made while a transition is in progress are queued until it
+completes."""
+
+import collections
+import logging
+
+import gi
+from gi.repository import Gst
+gi.require_version('Gst', '1.0')
+
+from nplayer import metrics, pipeline
+from nplayer.scheduler import monotonic
+
+#stable states
+IDLE = 'idle'
+PLAYING = 'playing'
+ERROR = 'error'
+#transitional states
+PREROLLING = 'prerolling'
+SEEKING = 'seeking'
+STOPPING = 'stopping'
+
+STATES = (IDLE, PREROLLING, PLAYING, SEEKING, STOPPING, ERROR)
+
+#time spent in each transitional state, i.e. how long GStreamer took to carry
+#out each kind of state change
+_STATE_TIME = dict((state, metrics.REGISTRY.histogram(
+    'nplayer_transport_transition_seconds',
+    'Time taken by transport state transitions', state=state))
+    for state in (PREROLLING, SEEKING, STOPPING))
+
+class Transport(object):
+    """Transport state machine for one pipeline at a time.
+
+    Context: all methods must be called on the controller thread"""
+
+    def __init__(self, sched, submit, timeouts, on_failure=None,
+        on_change=None):
+        """Initializes the state machine, with no pipeline attached.
+
+        Parameters:
+            scheduler.Scheduler sched: scheduler for transition timeouts
+            callable submit: submits a command to the controller, as
+                control.Controller.submit
+            dict timeouts: maximum time (float seconds) to spend in each
+                transitional state, keyed by state
+            callable on_failure: called with the pipeline when a transition
+                fails or times out, after entering the error state
+            callable on_change: called with (old state, new state) on every
+                state change"""
+
+        self.log = logging.getLogger('nplayer.transport')
+        self._sched = sched
+        self._submit = submit
+        self.timeouts = timeouts
+        self._on_failure = on_failure
+        self._on_change = on_change
+
+        self.pipe = None
+        self.state = IDLE
+        #stable state a transition will end in
+        self._target = IDLE
+        self._entered = monotonic()
+        #requests waiting for the current transition to complete, as
+        #(name, func) tuples
+        self._pending = collections.deque()
+
+        #transition timeout timer, and a counter so that timeouts for
+        #transitions which have since completed are ignored
+        self._timer = None
+        self._gen = 0
+
+        #time spent in each state, as [count, total seconds]
+        self.trace = dict((state, [0, 0.0]) for state in STATES)
+
+
+    @property
+    def playing(self):
+        """Whether the pipeline is playing or about to be."""
+        return self.state == PLAYING or self._target == PLAYING
+
+
+    def attach(self, pipe):
+        """Makes the state machine track the given pipeline, which must be
+        paused (or on its way there). Queued requests carry over to it."""
+
+        self.pipe = pipe
+        (ret, cur, pending) = pipe.get_state(0)
+        if ret == Gst.StateChangeReturn.FAILURE:
+            self._fail('pipeline failed to preroll')
+        elif cur == Gst.State.PAUSED and pending == Gst.State.VOID_PENDING:
+            self._enter(IDLE)
+        else:
+            self._enter(PREROLLING, IDLE)
+
+
+    def play(self):
+        """Requests that the pipeline start playing."""
+        self._request('play', self._do_play)
+
+
+    def stop(self):
+        """Requests that the pipeline stop playing and go back to the start of
+        its file."""
+        self._request('stop', self._do_stop)
+
+
+    def seek(self, func):
+        """Requests a seek, done by calling func, which should send the seek to
+        the pipeline and return whether it was accepted."""
+        self._request('seek', lambda: self._do_seek(func))
+
+
+    def handle_message(self, pipe, msg):
+        """Advances the state machine on an ASYNC_DONE or STATE_CHANGED message
+        from the given pipeline."""
+
+        if pipe != self.pipe or self._target == self.state:
+            #not ours, or not in a transition
+            return
+
+        if msg.type == Gst.MessageType.ASYNC_DONE:
+            #the pipeline has prerolled, which completes everything but a
+            #transition to playing
+            if self.state != PREROLLING or self._target != PLAYING:
+                self._enter(self._target)
+        elif msg.type == Gst.MessageType.STATE_CHANGED and msg.src == pipe:
+            (old, new, pending) = msg.parse_state_changed()
+            if self._target == PLAYING and new == Gst.State.PLAYING\
+            and pending == Gst.State.VOID_PENDING and self.state != SEEKING:
+                self._enter(PLAYING)
+
+
+    def fail(self, reason):
+        """Puts the state machine into the error state because of a problem
+        noticed elsewhere (such as an error message on the bus)."""
+        self._fail(reason)
+
+
+    def trace_summary(self):
+        """Returns the time spent in each state so far, as a dict of
+        (count, total seconds) tuples keyed by state."""
+        summary = dict((state, tuple(entry))
+            for (state, entry) in self.trace.items())
+        #include the time in the current state
+        (count, total) = summary[self.state]
+        summary[self.state] = (count, total + monotonic() - self._entered)
+        return summary
+
+
+    def _request(self, name, func):
+        """Runs a request if the state machine is in a stable state, or queues
+        it until it is."""
+        if self.state == self._target:
+            func()
+        else:
+            self.log.debug('%s requested while %s, queued', name, self.state)
+            self._pending.append((name, func))
+
+
+    def _do_play(self):
+        if self.state == IDLE:
+            ret = self.pipe.set_state(Gst.State.PLAYING)
+            if ret == Gst.StateChangeReturn.FAILURE:
+                self._fail('failed to start playing')
+            else:
+                self._enter(PREROLLING, PLAYING)
+
+
+    def _do_stop(self):
+        if self.state == PLAYING:
+            pipeline.rewind(self.pipe)
+            self._enter(STOPPING, IDLE)
+
+
+    def _do_seek(self, func):
+        if self.state in (IDLE, PLAYING):
+            if func():
+                self._enter(SEEKING, self.state)
+            else:
+                self.log.warning('seek refused by pipeline')
+
+
+    def _fail(self, reason):
+        self.log.error('transport failure while %s: %s', self.state, reason)
+        if self._pending:
+            self.log.warning('dropping %d queued requests: %s',
+                len(self._pending), ', '.join(n for (n, f) in self._pending))
+            self._pending.clear()
+        self._enter(ERROR)
+        if self._on_failure is not None:
+            self._on_failure(self.pipe)
+
+
+    def _enter(self, state, target=None):
+        """Enters the given state. For transitional states, target is the
+        stable state the transition ends in."""
+
+        now = monotonic()
+        old = self.state
+        entry = self.trace[old]
+        entry[0] += 1
+        entry[1] += now - self._entered
+        if old in _STATE_TIME:
+            _STATE_TIME[old].observe(now - self._entered)
+        self.log.debug('%s -> %s (after %.1f ms)', old, state,
+            (now - self._entered) * 1000)
+
+        self.state = state
+        self._target = state if target is None else target
+        self._entered = now
+
+        #arm or disarm the transition timeout
+        self._gen += 1
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if state != self._target:
+            self._timer = self._sched.call_later(self.timeouts[state],
+                self._submit, 'timeout', self._timed_out, self._gen)
+
+        if self._on_change is not None and old != state:
+            self._on_change(old, state)
+
+        #run queued requests now that we're stable again, stopping if one of
+        #them starts another transition
+        while self._pending and self.state == self._target\
+        and self.state != ERROR:
+            (name, func) = self._pending.popleft()
+            self.log.debug('running queued %s request', name)
+            func()
+
+
+    def _timed_out(self, gen):
+        if gen == self._gen:
+            self._fail('%s timed out after %.1f s' % (self.state,
+                self.timeouts[self.state]))
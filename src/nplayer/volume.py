@@ -0,0 +1,167 @@
+"""Volume control. The ALSA mixer is set once, natively through libasound,
+to the level the hardware should sit at; from then on, the volume is changed
+within each pipeline by a volume element, whose level can be ramped by a
+GstController control source. The ramps are applied sample by sample as the
+audio passes through the element, so fades have no steps or clicks.
+
+Levels are given as multiples of full volume (so 1.0 leaves the audio as it
+is)."""
+
+import ctypes
+import ctypes.util
+
+import gi
+from gi.repository import Gst, GstController
+gi.require_version('Gst', '1.0')
+gi.require_version('GstController', '1.0')
+
+from nplayer import pipeline
+
+#name of the volume element within manual pipelines
+ELEMENT_NAME = 'nplayer-volume'
+
+try:
+    _asound = ctypes.CDLL(ctypes.util.find_library('asound') or
+        'libasound.so.2')
+except OSError:
+    _asound = None
+else:
+    for (_name, _restype, _argtypes) in (
+        ('snd_mixer_open', ctypes.c_int,
+            [ctypes.POINTER(ctypes.c_void_p), ctypes.c_int]),
+        ('snd_mixer_attach', ctypes.c_int, [ctypes.c_void_p,
+            ctypes.c_char_p]),
+        ('snd_mixer_selem_register', ctypes.c_int, [ctypes.c_void_p,
+            ctypes.c_void_p, ctypes.c_void_p]),
+        ('snd_mixer_load', ctypes.c_int, [ctypes.c_void_p]),
+        ('snd_mixer_close', ctypes.c_int, [ctypes.c_void_p]),
+        ('snd_mixer_selem_id_malloc', ctypes.c_int,
+            [ctypes.POINTER(ctypes.c_void_p)]),
+        ('snd_mixer_selem_id_free', None, [ctypes.c_void_p]),
+        ('snd_mixer_selem_id_set_index', None, [ctypes.c_void_p,
+            ctypes.c_uint]),
+        ('snd_mixer_selem_id_set_name', None, [ctypes.c_void_p,
+            ctypes.c_char_p]),
+        ('snd_mixer_find_selem', ctypes.c_void_p, [ctypes.c_void_p,
+            ctypes.c_void_p]),
+        ('snd_mixer_selem_get_playback_volume_range', ctypes.c_int,
+            [ctypes.c_void_p, ctypes.POINTER(ctypes.c_long),
+            ctypes.POINTER(ctypes.c_long)]),
+        ('snd_mixer_selem_set_playback_volume_all', ctypes.c_int,
+            [ctypes.c_void_p, ctypes.c_long]),
+        ('snd_strerror', ctypes.c_char_p, [ctypes.c_int]),
+    ):
+        _func = getattr(_asound, _name)
+        _func.restype = _restype
+        _func.argtypes = _argtypes
+
+
+def _check(ret, what):
+    """Raises OSError if an ALSA call returned an error."""
+    if ret < 0:
+        raise OSError(-ret, '%s: %s' % (what, _asound.snd_strerror(ret)))
+    return ret
+
+
+def set_mixer(card, channel, percent):
+    """Sets the playback volume of the given ALSA mixer channel (on all of its
+    channels, such as left and right) to the given percentage of its range, as
+    `amixer set CHANNEL N%` does. Raises OSError if libasound isn't available
+    or the mixer can't be opened, and ValueError if there's no such
+    channel."""
+
+    if _asound is None:
+        raise OSError('libasound is not available')
+
+    mixer = ctypes.c_void_p()
+    _check(_asound.snd_mixer_open(ctypes.byref(mixer), 0), 'opening mixer')
+    try:
+        _check(_asound.snd_mixer_attach(mixer, card),
+            'attaching mixer to %s' % card)
+        _check(_asound.snd_mixer_selem_register(mixer, None, None),
+            'registering mixer elements')
+        _check(_asound.snd_mixer_load(mixer), 'loading mixer')
+
+        sid = ctypes.c_void_p()
+        _check(_asound.snd_mixer_selem_id_malloc(ctypes.byref(sid)),
+            'allocating mixer element id')
+        try:
+            _asound.snd_mixer_selem_id_set_index(sid, 0)
+            _asound.snd_mixer_selem_id_set_name(sid, channel)
+            elem = _asound.snd_mixer_find_selem(mixer, sid)
+        finally:
+            _asound.snd_mixer_selem_id_free(sid)
+        if not elem:
+            raise ValueError('no ALSA mixer channel %s on %s' % (channel,
+                card))
+
+        (low, high) = (ctypes.c_long(), ctypes.c_long())
+        _check(_asound.snd_mixer_selem_get_playback_volume_range(elem,
+            ctypes.byref(low), ctypes.byref(high)), 'getting volume range')
+        value = low.value + int(round((high.value - low.value) *
+            max(0, min(percent, 100)) / 100.0))
+        _check(_asound.snd_mixer_selem_set_playback_volume_all(elem, value),
+            'setting volume of %s' % channel)
+    finally:
+        _asound.snd_mixer_close(mixer)
+
+
+def make_volume(level):
+    """Returns a volume element at the given level, ready to be ramped with
+    fade()."""
+    vol = Gst.ElementFactory.make('volume', ELEMENT_NAME)
+    vol.set_property('volume', level)
+    source = GstController.InterpolationControlSource()
+    source.set_property('mode', GstController.InterpolationMode.LINEAR)
+    #absolute, so that control values are volume levels rather than
+    #fractions of the property's range
+    vol.add_control_binding(GstController.DirectControlBinding.new_absolute(
+        vol, 'volume', source))
+    return vol
+
+
+def _element(pipe):
+    """Returns the volume element of the given pipeline, or None if it has
+    none."""
+    if pipeline.is_playbin(pipe):
+        #only found by name once the playbin has set up its audio chain
+        return pipe.get_property('audio-filter')
+    return pipe.get_by_name(ELEMENT_NAME)
+
+
+def set_level(pipe, level):
+    """Sets the volume of the given pipeline right away, dropping any ramp in
+    progress."""
+    vol = _element(pipe)
+    if vol is None:
+        return
+    vol.get_control_binding('volume').get_property('control-source')\
+        .unset_all()
+    vol.set_property('volume', level)
+
+
+def fade(pipe, start, end, duration, rate=1.0):
+    """Ramps the volume of the given pipeline from start (or, if None, the
+    level it's at) to end, over the next duration seconds of playing at the
+    given rate. The ramp is laid out in stream time from the pipeline's
+    current position, so it follows the audio rather than the clock."""
+
+    vol = _element(pipe)
+    if vol is None:
+        return
+    if start is None:
+        start = vol.get_property('volume')
+    if duration <= 0:
+        set_level(pipe, end)
+        return
+
+    (ok, pos) = pipe.query_position(Gst.Format.TIME)
+    if not ok:
+        #not prerolled yet, so it'll start from the beginning
+        pos = 0
+    source = vol.get_control_binding('volume').get_property('control-source')
+    source.unset_all()
+    #before the first point the level is left alone, and after the last it
+    #stays at the last point's
+    source.set(pos, start)
+    source.set(max(0, pos + int(duration * rate * 10**9)), end)
@@ -0,0 +1,105 @@
+"""Health watching: noticing a playing pipeline which has stalled (its
+position no longer advancing, as after an ALSA underrun it doesn't come back
+from), and keeping systemd's watchdog fed from the controller thread, so that
+a hung player gets restarted. The player does the recovering itself (see
+NativityPlayer._recover()).
+
+systemd's watchdog is fed only if it's enabled for the service (WatchdogSec=
+in the unit file), at half the interval it asks for."""
+
+import logging
+import os
+
+from nplayer import metrics, startup
+
+RECOVERIES = metrics.REGISTRY.counter('nplayer_watchdog_recoveries',
+    'Pipeline recoveries started by the watchdog')
+RECOVERY_TIME = metrics.REGISTRY.histogram('nplayer_watchdog_recovery_seconds',
+    'Time from a pipeline stall or failure being noticed to playing again')
+FAILURES = metrics.REGISTRY.counter('nplayer_watchdog_failures',
+    'Times the watchdog gave up recovering a pipeline and stopped')
+STALLS = metrics.REGISTRY.counter('nplayer_watchdog_stalls',
+    'Times a playing pipeline\'s position stopped advancing')
+WARNINGS = metrics.REGISTRY.counter('nplayer_bus_warnings',
+    'Warning messages posted by the current pipeline')
+
+def systemd_interval():
+    """Returns the interval (float seconds) at which systemd's watchdog should
+    be fed, or None if it isn't watching this process."""
+    usec = os.environ.get('WATCHDOG_USEC')
+    pid = os.environ.get('WATCHDOG_PID')
+    if not usec or not os.environ.get('NOTIFY_SOCKET'):
+        return None
+    if pid and pid != str(os.getpid()):
+        return None
+    try:
+        return int(usec) / 2e6
+    except ValueError:
+        return None
+
+
+class Pinger(object):
+    """Feeds systemd's watchdog with a command run on the controller thread,
+    so that it goes hungry if the scheduler or the controller hangs."""
+
+    def __init__(self, sched, submit):
+        """Parameters:
+            scheduler.Scheduler sched: scheduler to time the pings with
+            callable submit: control.Controller.submit"""
+        self.log = logging.getLogger('nplayer.watchdog')
+        self.sched = sched
+        self.submit = submit
+        self.interval = systemd_interval()
+
+
+    def start(self):
+        """Starts feeding the watchdog, if systemd is watching."""
+        if self.interval is None:
+            return
+        self.log.info('feeding the systemd watchdog every %.1f s',
+            self.interval)
+        self._schedule()
+
+
+    def _schedule(self):
+        self.sched.call_later(self.interval, self.submit, 'watchdog',
+            self._ping)
+
+
+    def _ping(self):
+        """Context: controller thread"""
+        startup.sd_notify('WATCHDOG=1')
+        self._schedule()
+
+
+class StallDetector(object):
+    """Follows the position of a playing pipeline, noticing when it has stayed
+    put for too long.
+
+    Context: any one thread at a time"""
+
+    def __init__(self, stall_time):
+        """stall_time is how long (float seconds) the position may stay put
+        before it's taken to have stalled."""
+        self.stall_time = stall_time
+        self.reset()
+
+
+    def reset(self):
+        """Forgets the position, as when playing stops or another file is
+        selected."""
+        #last position seen moving (nanoseconds), or None
+        self.last_pos = None
+        #time the position was last seen moving
+        self._moved = None
+
+
+    def check(self, now, pos):
+        """Takes the position (nanoseconds) at the given monotonic time.
+        Returns whether the position has now stayed put for the stall
+        time."""
+        if pos != self.last_pos or self._moved is None:
+            self.last_pos = pos
+            self._moved = now
+            return False
+        return now - self._moved >= self.stall_time
@@ -0,0 +1,202 @@
+"""Multi-zone mode: several independent players (zones), each with its own
+buttons, library, audio output, and pipelines, run from one process so that
+one Pi can serve several scenes. The zones share one scheduler, controller,
+GStreamer event loop, and GPIO interrupt dispatcher, so adding a zone adds no
+threads beyond its own display update loop and state writer.
+
+Zones are declared in the [zones] section of the config file, and each has a
+[zone:NAME] section holding the settings in which it differs from the rest of
+the file. Settings there are named as in their own sections, or as
+SECTION.NAME where the name alone is found in more than one section."""
+
+import collections
+import ConfigParser
+import logging
+import os
+import signal
+
+import gi
+from gi.repository import GObject, Gst
+gi.require_version('Gst', '1.0')
+
+from nplayer import (backends, control, events, metrics, player, remote,
+    scheduler, startup, watchdog)
+
+ZONES_SECTION = 'zones'
+ZONE_PREFIX = 'zone:'
+
+Shared = collections.namedtuple('Shared', ('sched', 'ctl', 'events'))
+
+def zone_names(cfg):
+    """Returns the names of the zones declared in the given config, or an
+    empty list if it's for a single player."""
+    if not cfg.has_option(ZONES_SECTION, 'names'):
+        return []
+    return cfg.get(ZONES_SECTION, 'names').split()
+
+
+def zone_config(cfg, name):
+    """Returns the config for the given zone: a copy of the given config, with
+    the settings in the zone's section in place of the ones they name. Raises
+    ValueError if the section is missing, or names a setting ambiguously or
+    in a section that doesn't exist."""
+
+    section = ZONE_PREFIX + name
+    if not cfg.has_section(section):
+        raise ValueError('no [%s] section for zone %s' % (section, name))
+
+    zcfg = ConfigParser.ConfigParser()
+    for sec in cfg.sections():
+        if sec == ZONES_SECTION or sec.startswith(ZONE_PREFIX):
+            continue
+        zcfg.add_section(sec)
+        for (opt, value) in cfg.items(sec, raw=True):
+            zcfg.set(sec, opt, value)
+
+    for (opt, value) in cfg.items(section, raw=True):
+        if '.' in opt:
+            (sec, opt) = opt.split('.', 1)
+            if not zcfg.has_section(sec):
+                raise ValueError('unknown section %s in setting %s.%s for '
+                    'zone %s' % (sec, sec, opt, name))
+        else:
+            found = [sec for sec in zcfg.sections() if zcfg.has_option(sec,
+                opt)]
+            if not found:
+                raise ValueError('unknown setting %s for zone %s' % (opt,
+                    name))
+            if len(found) > 1:
+                raise ValueError('setting %s for zone %s is ambiguous, give '
+                    'it as one of %s' % (opt, name, ', '.join('%s.%s' % (sec,
+                    opt) for sec in found)))
+            sec = found[0]
+        zcfg.set(sec, opt, value)
+    return zcfg
+
+
+def check_zones(cfgs):
+    """Makes sure the given zone configs (keyed by zone name) don't clash:
+    no input pin is used twice, each zone has its own state and index files
+    (and cache directory, if caching), and only one has the LCD. Raises
+    ValueError if they do."""
+
+    owners = {}
+
+    def claim(what, key, zone):
+        other = owners.setdefault((what, key), zone)
+        if other != zone:
+            raise ValueError('zones %s and %s both use %s %s' % (other, zone,
+                what, key))
+
+    lcd_zones = []
+    for (name, cfg) in cfgs.items():
+        for (opt, value) in cfg.items('inputs'):
+            if opt.startswith('pin_'):
+                claim('pin', int(value), name)
+        if cfg.getboolean('lcd', 'enabled'):
+            lcd_zones.append(name)
+            for opt in ('pin_red', 'pin_green', 'pin_blue'):
+                claim('pin', cfg.getint('lcd', opt), name)
+        claim('state file', os.path.expanduser(cfg.get('fs', 'lastf_path')),
+            name)
+        claim('index file', os.path.expanduser(cfg.get('fs', 'index_path')),
+            name)
+        if cfg.getboolean('cache', 'enabled'):
+            claim('cache directory',
+                os.path.expanduser(cfg.get('cache', 'cache_dir')), name)
+    if len(lcd_zones) > 1:
+        raise ValueError('only one zone can have the LCD, but %s do' %
+            ', '.join(lcd_zones))
+
+
+class ZoneEngine(object):
+    """Runs several zones, each a NativityPlayer, on shared services.
+
+    Context: zones run on the shared controller thread"""
+
+    def __init__(self, cfg, gpio=None, i2c=None):
+        """Sets up every zone declared in cfg (a ConfigParser.ConfigParser
+        instance), in parallel. gpio and i2c are the GPIO and I2C backends to
+        use, shared by the zones (see backends.py); they default to the Pi's
+        hardware."""
+
+        self.log = logging.getLogger('nplayer.zones')
+
+        names = zone_names(cfg)
+        if not names:
+            raise ValueError('no zones declared')
+        if len(set(names)) != len(names):
+            raise ValueError('zone names must be unique')
+        cfgs = collections.OrderedDict((name, zone_config(cfg, name))
+            for name in names)
+        check_zones(cfgs)
+
+        if gpio is None:
+            gpio = backends.RPIOBackend()
+        self.gpio = gpio
+
+        GObject.threads_init()
+        Gst.init(None)
+        self.shared = Shared(scheduler.Scheduler(), control.Controller(),
+            events.EventLoop())
+
+        #zones which have yet to become ready
+        self._unready = set(names)
+
+        #players keyed by zone name, set up alongside each other
+        self.zones = collections.OrderedDict((name, None) for name in names)
+        self.startup = startup.Startup()
+        for (name, zcfg) in cfgs.items():
+            self.startup.add(name, self._make_zone(name, zcfg, gpio, i2c))
+        self.startup.run()
+
+        port = cfg.getint('metrics', 'http_port')
+        socket_path = cfg.get('metrics', 'socket_path')
+        self.metrics_server = metrics.MetricsServer(
+            http_addr=((cfg.get('metrics', 'http_addr'), port)
+                if port else None),
+            socket_path=(os.path.expanduser(socket_path)
+                if socket_path else None))
+        self.remote_server = remote.server_from_config(cfg, self.zones)
+        self.pinger = watchdog.Pinger(self.shared.sched,
+            self.shared.ctl.submit)
+        self.log.info('%d zones initialized: %s', len(names),
+            ', '.join(names))
+
+
+    def _make_zone(self, name, cfg, gpio, i2c):
+        """Returns a startup step setting up the given zone."""
+        def make():
+            self.zones[name] = player.NativityPlayer(cfg, gpio=gpio,
+                i2c=i2c if cfg.getboolean('lcd', 'enabled') else None,
+                shared=self.shared, name=name, on_ready=self._zone_ready)
+        return make
+
+
+    def start(self, block=True):
+        """Starts every zone, then the shared services. If block is True,
+        then waits forever."""
+
+        for zone in self.zones.values():
+            zone.start(block=False)
+        self.shared.ctl.start()
+        self.shared.sched.start()
+        self.shared.events.start()
+        self.metrics_server.start()
+        self.remote_server.start()
+        self.pinger.start()
+        self.gpio.wait_for_interrupts()
+
+        if block:
+            while True:
+                signal.pause()
+
+
+    def _zone_ready(self, zone):
+        """Notes a zone being ready to play, telling systemd once they all are.
+
+        Context: controller thread"""
+        self._unready.discard(zone.name)
+        if not self._unready:
+            self.log.info('all zones ready to play')
+            startup.sd_notify('READY=1')
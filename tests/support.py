@@ -0,0 +1,63 @@
+"""Test support: puts the package on the path, and stands in for GStreamer's
+Python bindings where they aren't installed, so that the player's logic can
+be tested without them. Tests import this before anything from nplayer."""
+
+import logging
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir, 'src'))
+
+#log messages are only of interest to the tests checking for them
+logging.getLogger('nplayer').addHandler(logging.NullHandler())
+
+class Fake(object):
+    """Stands in for any GStreamer object, enum, or function: attributes are
+    made up (and kept) on first use, and calls return fresh fakes, so that
+    each created element is distinct."""
+
+    def __init__(self, name):
+        self._name = name
+
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        value = Fake('%s.%s' % (self._name, attr))
+        setattr(self, attr, value)
+        return value
+
+
+    def __call__(self, *args, **kwargs):
+        return Fake('%s()' % self._name)
+
+
+    def __or__(self, other):
+        return self
+
+
+    def __int__(self):
+        return 0
+
+
+    def __repr__(self):
+        return '<fake %s>' % self._name
+
+
+def _install_fake_gi():
+    gi = types.ModuleType('gi')
+    gi.require_version = lambda name, version: None
+    repository = types.ModuleType('gi.repository')
+    for name in ('GLib', 'GObject', 'Gst', 'GstController', 'GstPbutils'):
+        setattr(repository, name, Fake(name))
+    gi.repository = repository
+    sys.modules['gi'] = gi
+    sys.modules['gi.repository'] = repository
+
+
+try:
+    import gi
+except ImportError:
+    _install_fake_gi()
@@ -0,0 +1,104 @@
+import threading
+import unittest
+
+import support
+
+from nplayer import control
+
+def noop(*args):
+    pass
+
+
+def other(*args):
+    pass
+
+
+def replace(queued, new):
+    return new
+
+
+def add(queued, new):
+    return (queued[0] + new[0],)
+
+
+class ControllerTest(unittest.TestCase):
+    """Queuing, merging, and dropping of commands, with the controller thread
+    not started, so that the queue is left as submitted."""
+
+    def setUp(self):
+        self.ctl = control.Controller(size=3)
+
+
+    def _queued(self):
+        return [(cmd.name, cmd.args) for cmd in self.ctl._queue]
+
+
+    def test_merge_with_last(self):
+        self.ctl.submit('seek', noop, 1, merge=add)
+        self.ctl.submit('seek', noop, 2, merge=add)
+        self.ctl.submit('volume', noop, 50, merge=replace)
+        self.ctl.submit('volume', noop, 60, merge=replace)
+        self.assertEqual(self._queued(), [('seek', (3,)), ('volume', (60,))])
+        self.assertEqual(self.ctl.merged, 2)
+
+
+    def test_merge_only_with_last(self):
+        self.ctl.submit('seek', noop, 1, merge=add)
+        self.ctl.submit('edge', noop, 'ff')
+        self.ctl.submit('seek', noop, 2, merge=add)
+        self.assertEqual(self._queued(),
+            [('seek', (1,)), ('edge', ('ff',)), ('seek', (2,))])
+
+
+    def test_merge_only_same_function(self):
+        #commands for different players sharing the controller
+        self.ctl.submit('seek', noop, 1, merge=add)
+        self.ctl.submit('seek', other, 2, merge=add)
+        self.assertEqual(len(self._queued()), 2)
+        self.assertEqual(self.ctl.merged, 0)
+
+
+    def test_full_drops_only_droppable(self):
+        for i in range(3):
+            self.assertTrue(self.ctl.submit('edge', noop, i))
+        self.assertFalse(self.ctl.submit('seek_to', noop, 5,
+            droppable=True))
+        self.assertTrue(self.ctl.submit('eos', noop))
+        self.assertEqual([name for (name, args) in self._queued()],
+            ['edge', 'edge', 'edge', 'eos'])
+        stats = self.ctl.stats()
+        self.assertEqual((stats['dropped'], stats['overflowed'],
+            stats['high_water']), (1, 1, 4))
+
+
+    def test_full_still_merges(self):
+        self.ctl.submit('edge', noop, 0)
+        self.ctl.submit('edge', noop, 1)
+        self.ctl.submit('seek', noop, 1, merge=add, droppable=True)
+        self.assertTrue(self.ctl.submit('seek', noop, 2, merge=add,
+            droppable=True))
+        self.assertEqual(self._queued()[-1], ('seek', (3,)))
+
+
+    def test_runs_in_order(self):
+        done = threading.Event()
+        ran = []
+        for i in range(3):
+            self.ctl.submit('edge', ran.append, i)
+        self.ctl.submit('done', done.set)
+        self.ctl.start()
+        self.assertTrue(done.wait(5))
+        self.assertEqual(ran, [0, 1, 2])
+        self.assertEqual(self.ctl.stats()['latency']['edge'][0], 3)
+
+
+    def test_survives_failing_command(self):
+        done = threading.Event()
+        self.ctl.submit('fail', lambda: 1 / 0)
+        self.ctl.submit('done', done.set)
+        self.ctl.start()
+        self.assertTrue(done.wait(5))
+
+
+if __name__ == '__main__':
+    unittest.main()
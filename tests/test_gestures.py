@@ -0,0 +1,146 @@
+import unittest
+
+import support
+
+from nplayer import gestures
+
+BUTTONS = ('play', 'stop', 'rw', 'ff', 'scene')
+
+#the player's default gestures
+GESTURES = [gestures.parse_gesture(action, spec, BUTTONS)
+    for (action, spec) in (
+        ('play', 'tap play'),
+        ('stop', 'tap stop'),
+        ('skip_forward', 'tap ff'),
+        ('ff_hold', 'hold ff 0.5 2'),
+        ('next_file', 'chord play ff'),
+        ('scene_play', 'taps scene 3 5'),
+    )]
+
+#edge sequences and the decisions expected of them; steps are (button,
+#pressed, time) edges, or (None, None, time) to let time pass to then. Each
+#decision is (action, phase, count)
+CASES = [
+    ('tap',
+        [('play', True, 0.0), ('play', False, 0.1)],
+        [('play', 'fire', 0)]),
+    ('repeated edge ignored',
+        [('play', True, 0.0), ('play', True, 0.05), ('play', False, 0.1)],
+        [('play', 'fire', 0)]),
+    ('multi-tap within the window',
+        [('scene', True, 0.0), ('scene', False, 0.1),
+        ('scene', True, 1.0), ('scene', False, 1.1),
+        ('scene', True, 2.0), ('scene', False, 2.1)],
+        [('scene_play', 'fire', 0)]),
+    ('multi-tap slides its window',
+        [('scene', True, 0.0), ('scene', False, 0.0),
+        ('scene', True, 3.0), ('scene', False, 3.0),
+        ('scene', True, 6.0), ('scene', False, 6.0),
+        ('scene', True, 7.0), ('scene', False, 7.0)],
+        [('scene_play', 'fire', 0)]),
+    ('multi-tap starts afresh once completed',
+        [('scene', True, 0.0), ('scene', False, 0.0),
+        ('scene', True, 0.5), ('scene', False, 0.5),
+        ('scene', True, 1.0), ('scene', False, 1.0),
+        ('scene', True, 1.5), ('scene', False, 1.5),
+        ('scene', True, 2.0), ('scene', False, 2.0)],
+        [('scene_play', 'fire', 0)]),
+    ('released before the hold time is a tap',
+        [('ff', True, 0.0), (None, None, 0.4), ('ff', False, 0.45)],
+        [('skip_forward', 'fire', 0)]),
+    ('hold with repeats, then release',
+        [('ff', True, 0.0), (None, None, 0.5), (None, None, 2.5),
+        (None, None, 4.5), ('ff', False, 5.0)],
+        [('ff_hold', 'fire', 0), ('ff_hold', 'repeat', 1),
+        ('ff_hold', 'repeat', 2), ('ff_hold', 'end', 0)]),
+    ('repeats are timed from the press, not from a late hold',
+        [('ff', True, 0.0), (None, None, 1.0), (None, None, 2.4),
+        (None, None, 2.5)],
+        [('ff_hold', 'fire', 0), ('ff_hold', 'repeat', 1)]),
+    ('hold of an earlier press ignored',
+        [('ff', True, 0.0), ('ff', False, 0.1), ('ff', True, 0.3),
+        (None, None, 0.6), (None, None, 0.8)],
+        [('skip_forward', 'fire', 0), ('ff_hold', 'fire', 0)]),
+    ('chord',
+        [('play', True, 0.0), ('ff', True, 0.1), (None, None, 1.0),
+        ('ff', False, 1.1), ('play', False, 1.2)],
+        [('next_file', 'fire', 0)]),
+    ('botched chord',
+        [('play', True, 0.0), ('ff', True, 0.1), ('play', False, 0.2),
+        ('ff', False, 0.3)],
+        [('next_file', 'botched', 0)]),
+]
+
+class FakeTimer(object):
+
+    def __init__(self, when, func, args):
+        self.when = when
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeScheduler(object):
+    """Scheduler whose timers go off only when told that time has passed."""
+
+    def __init__(self):
+        self.timers = []
+
+
+    def call_at(self, when, func, *args):
+        timer = FakeTimer(when, func, args)
+        self.timers.append(timer)
+        return timer
+
+
+    def advance(self, now):
+        while True:
+            due = [timer for timer in self.timers
+                if not timer.cancelled and timer.when <= now]
+            if not due:
+                return
+            timer = min(due, key=lambda timer: timer.when)
+            self.timers.remove(timer)
+            timer.func(*timer.args)
+
+
+def submit(name, func, *args, **kwargs):
+    func(*args)
+    return True
+
+
+class RecognizerTest(unittest.TestCase):
+
+    def test_cases(self):
+        for (name, steps, expected) in CASES:
+            sched = FakeScheduler()
+            decisions = []
+            recognizer = gestures.Recognizer(GESTURES, sched, submit,
+                lambda *decision: decisions.append(decision))
+            for (button, pressed, stamp) in steps:
+                sched.advance(stamp)
+                if button is not None:
+                    recognizer.edge(button, pressed, stamp)
+            self.assertEqual(decisions, expected, name)
+
+
+    def test_parse_errors(self):
+        for spec in ('', 'tap', 'tap nope', 'taps scene 0 5', 'hold ff',
+        'hold ff 1 0', 'chord play play', 'wiggle play'):
+            self.assertRaises(ValueError, gestures.parse_gesture, 'act',
+                spec, BUTTONS)
+
+
+    def test_one_hold_per_button(self):
+        holds = [gestures.parse_gesture('a', 'hold ff 1', BUTTONS),
+            gestures.parse_gesture('b', 'hold ff 2', BUTTONS)]
+        self.assertRaises(ValueError, gestures.Recognizer, holds,
+            FakeScheduler(), submit, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
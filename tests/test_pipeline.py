@@ -0,0 +1,48 @@
+import unittest
+
+import support
+
+from nplayer import pipeline
+
+class PipelinePoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.removed = []
+        self.pool = pipeline.PipelinePool(3,
+            on_remove=lambda path, pipe: self.removed.append(path))
+
+
+    def test_evicts_least_recently_used(self):
+        self.pool.activate('a')
+        self.pool.prefetch(['b', 'c'])
+        self.pool.prefetch(['d'])
+        #earlier files in a prefetch are kept longer
+        self.assertEqual(self.removed, ['c'])
+
+
+    def test_pinned_kept_until_unpinned(self):
+        #a fades out while b becomes the active one, and b's neighbors are
+        #prefetched
+        fading = self.pool.activate('a')
+        self.pool.pin(fading)
+        self.pool.activate('b')
+        self.pool.prefetch(['c', 'd', 'e'])
+        self.assertIn(fading, self.pool.pipelines())
+        self.assertEqual(len(self.pool.pipelines()), 3)
+        #once it's done, the neighbors take its place
+        self.pool.unpin(fading)
+        self.pool.prefetch(['c', 'd', 'e'])
+        self.assertNotIn(fading, self.pool.pipelines())
+        self.assertIn('a', self.removed)
+
+
+    def test_pinned_can_be_discarded(self):
+        pipe = self.pool.activate('a')
+        self.pool.pin(pipe)
+        self.pool.discard('a')
+        self.assertEqual(self.removed, ['a'])
+        self.pool.unpin(pipe)
+
+
+if __name__ == '__main__':
+    unittest.main()
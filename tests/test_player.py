@@ -0,0 +1,214 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import support
+
+from nplayer import (inotify, pipeline, player, sequence, transport,
+    watchdog)
+
+class FakeLibrary(object):
+
+    def __init__(self, files):
+        self.files = files
+
+
+    def update(self, path):
+        if path not in self.files:
+            self.files.append(path)
+            self.files.sort()
+
+
+    def remove(self, path):
+        if path in self.files:
+            self.files.remove(path)
+
+
+    def index_of(self, path):
+        return self.files.index(path) if path in self.files else None
+
+
+    def duration(self, path):
+        return 0
+
+
+    def probe_async(self, on_probed=None):
+        pass
+
+
+class FakeTransport(object):
+    """Transport which only notes the pipeline attached to it; tests move it
+    between states themselves."""
+
+    def __init__(self):
+        self.state = transport.IDLE
+        self.playing = False
+        self.pipe = None
+
+
+    def attach(self, pipe):
+        self.pipe = pipe
+
+
+class FakeController(object):
+    """Runs submitted commands at once."""
+
+    def submit(self, name, func, *args, **kwargs):
+        func(*args)
+        return True
+
+
+class FakeState(object):
+
+    def update(self, **fields):
+        pass
+
+
+class PlayerTestCase(unittest.TestCase):
+    """Sets up a player for one file with fakes for its services, without
+    running any of its startup."""
+
+    def setUp(self):
+        self.libdir = tempfile.mkdtemp()
+        self.path = self._write('a.mp3')
+
+        nplayer = player.NativityPlayer.__new__(player.NativityPlayer)
+        nplayer.log = player.logging.getLogger('test')
+        nplayer.library = FakeLibrary([self.path])
+        nplayer.files = nplayer.library.files
+        nplayer.pool = pipeline.PipelinePool(3)
+        nplayer.transport = FakeTransport()
+        nplayer.ctl = FakeController()
+        nplayer.state = FakeState()
+        nplayer.pcm_cache = None
+        nplayer.stalls = watchdog.StallDetector(3)
+        nplayer.cur_file = self.path
+        nplayer.cur_file_base = os.path.basename(self.path)
+        nplayer.cur_fileno = 0
+        nplayer.cur_filelen = 0
+        nplayer._stale = set()
+        nplayer._seq_queued = None
+        nplayer._seq_closed = None
+        nplayer._seq_lock = threading.Lock()
+        nplayer._trick_rate = None
+        nplayer._rec_source = 0
+        nplayer._recovery = None
+        nplayer._prerolled = True
+        nplayer._transport_listeners = []
+        nplayer._upd_evt = threading.Event()
+        nplayer._standby_files = lambda: []
+        nplayer._set_player(nplayer.pool.activate(self.path))
+        self.nplayer = nplayer
+
+
+    def tearDown(self):
+        shutil.rmtree(self.libdir)
+
+
+    def _write(self, name):
+        path = os.path.join(self.libdir, name)
+        with open(path, 'wb') as out:
+            out.write(name)
+        return path
+
+
+    def _play(self):
+        self.nplayer.transport.playing = True
+        self.nplayer.transport.state = transport.PLAYING
+        self.nplayer._transport_changed(transport.IDLE, transport.PLAYING)
+
+
+    def _stop(self):
+        self.nplayer.transport.playing = False
+        self.nplayer.transport.state = transport.IDLE
+        self.nplayer._transport_changed(transport.PLAYING, transport.IDLE)
+
+
+    def _check_refreshed(self, old):
+        nplayer = self.nplayer
+        self.assertIsNot(nplayer.player, old)
+        self.assertIs(nplayer.transport.pipe, nplayer.player)
+        self.assertIs(nplayer.pool.activate(self.path), nplayer.player)
+        self.assertNotIn(old, nplayer.pool.pipelines())
+
+
+class ReplacedWhilePlayingTest(PlayerTestCase):
+    """A file changed or replaced while it's playing is played from a fresh
+    pipeline once it has stopped."""
+
+    def test_changed(self):
+        old = self.nplayer.player
+        self._play()
+        self.nplayer._library_changed(inotify.CHANGED, self.path, None)
+        #playing isn't interrupted
+        self.assertIs(self.nplayer.player, old)
+        self._stop()
+        self._check_refreshed(old)
+
+
+    def test_replaced_by_rename(self):
+        old = self.nplayer.player
+        self._play()
+        tmp_path = self._write('.a.mp3.tmp')
+        os.rename(tmp_path, self.path)
+        self.nplayer._library_changed(inotify.RENAMED, tmp_path, self.path)
+        self.assertIs(self.nplayer.player, old)
+        self._stop()
+        self._check_refreshed(old)
+
+
+    def test_played_again_before_refresh(self):
+        old = self.nplayer.player
+        self._play()
+        self.nplayer._library_changed(inotify.CHANGED, self.path, None)
+        #the stop's refresh finds it playing again, so waits for the next
+        self.nplayer.transport.playing = True
+        self.nplayer._refresh_stale(self.path)
+        self.assertIs(self.nplayer.player, old)
+        self._stop()
+        self._check_refreshed(old)
+
+
+class FakeSequence(object):
+
+    def __init__(self, path):
+        self.path = path
+
+
+    def next(self, cur_file):
+        return sequence.Step(self.path, None, 0, 0)
+
+
+class FollowOnTest(PlayerTestCase):
+    """A file is only queued to follow on gaplessly while nothing has
+    stopped or switched away from the playing pipeline."""
+
+    def setUp(self):
+        PlayerTestCase.setUp(self)
+        self.next_path = self._write('b.mp3')
+        self.nplayer.sequence = FakeSequence(self.next_path)
+
+
+    def test_queued(self):
+        self._play()
+        self.nplayer._about_to_finish(self.nplayer.player)
+        self.assertEqual(self.nplayer._seq_queued[1].path, self.next_path)
+
+
+    def test_not_queued_once_unqueued(self):
+        self._play()
+        #a stop forgets what's queued before it stops the transport
+        self.assertFalse(self.nplayer._unqueue(self.nplayer.player))
+        self.nplayer._about_to_finish(self.nplayer.player)
+        self.assertIsNone(self.nplayer._seq_queued)
+        #until it plays again
+        self._stop()
+        self._play()
+        self.nplayer._about_to_finish(self.nplayer.player)
+        self.assertIsNotNone(self.nplayer._seq_queued)
+
+
+if __name__ == '__main__':
+    unittest.main()
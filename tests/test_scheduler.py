@@ -0,0 +1,60 @@
+import errno
+import select
+import threading
+import unittest
+
+import support
+
+from nplayer import scheduler
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sched = scheduler.Scheduler()
+        self.sched.start()
+
+
+    def test_order(self):
+        ran = []
+        done = threading.Event()
+        now = scheduler.monotonic()
+        self.sched.call_at(now + 0.03, ran.append, 'b')
+        self.sched.call_at(now + 0.01, ran.append, 'a')
+        self.sched.call_at(now + 0.03, ran.append, 'c')
+        self.sched.call_at(now + 0.05, done.set)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(ran, ['a', 'b', 'c'])
+
+
+    def test_cancel(self):
+        ran = []
+        done = threading.Event()
+        self.sched.call_later(0.01, ran.append, 'a').cancel()
+        self.sched.call_later(0.02, done.set)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(ran, [])
+
+
+    def test_survives_interrupted_wait(self):
+        #as when a signal (such as SIGUSR1) arrives while the scheduler
+        #thread is waiting
+        interrupted = []
+        real_select = select.select
+        def interrupting_select(*args):
+            if not interrupted:
+                interrupted.append(True)
+                raise select.error(errno.EINTR, 'Interrupted system call')
+            return real_select(*args)
+        done = threading.Event()
+        select.select = interrupting_select
+        try:
+            self.sched.call_later(0.01, lambda: None)
+            self.sched.call_later(0.05, done.set)
+            self.assertTrue(done.wait(5))
+        finally:
+            select.select = real_select
+        self.assertEqual(interrupted, [True])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import threading
+import unittest
+
+import support
+
+from nplayer import startup
+
+class StartupTest(unittest.TestCase):
+
+    def test_order(self):
+        ran = []
+        lock = threading.Lock()
+        def step(name):
+            def func():
+                with lock:
+                    ran.append(name)
+            return func
+        steps = startup.Startup()
+        steps.add('select', step('select'), after=('library', 'state'))
+        steps.add('library', step('library'))
+        steps.add('state', step('state'))
+        steps.add('pipeline', step('pipeline'), after=('select',))
+        steps.run()
+        self.assertEqual(sorted(ran[:2]), ['library', 'state'])
+        self.assertEqual(ran[2:], ['select', 'pipeline'])
+
+
+    def test_failure_skips_only_dependents(self):
+        ran = set()
+        release = threading.Event()
+        def fail():
+            raise RuntimeError('no library')
+        def lcd():
+            #starts only after the failure, so independent steps must run
+            #whatever the timing
+            release.wait(5)
+            ran.add('lcd')
+        def record(name):
+            return lambda: ran.add(name)
+
+        steps = startup.Startup()
+        steps.add('library', fail)
+        steps.add('lcd', lcd)
+        steps.add('state', record('state'))
+        steps.add('select', record('select'), after=('library', 'state'))
+        steps.add('pipeline', record('pipeline'), after=('select',))
+        steps.add('mixer', record('mixer'), after=('state',))
+        threading.Timer(0.05, release.set).start()
+        self.assertRaises(RuntimeError, steps.run)
+        self.assertEqual(ran, set(['lcd', 'state', 'mixer']))
+
+
+    def test_cycle(self):
+        steps = startup.Startup()
+        steps.add('a', lambda: None, after=('b',))
+        steps.add('b', lambda: None, after=('a',))
+        self.assertRaises(ValueError, steps.run)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+import unittest
+
+import support
+
+from gi.repository import Gst
+
+from nplayer import transport
+
+TIMEOUTS = {
+    transport.PREROLLING: 10.0,
+    transport.SEEKING: 3.0,
+    transport.STOPPING: 3.0,
+}
+
+class FakeTimer(object):
+
+    def __init__(self, delay, func, args):
+        self.delay = delay
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeScheduler(object):
+
+    def __init__(self):
+        self.timers = []
+
+
+    def call_later(self, delay, func, *args):
+        timer = FakeTimer(delay, func, args)
+        self.timers.append(timer)
+        return timer
+
+
+class FakePipeline(object):
+    """Pipeline which records the states asked of it, and reports itself to
+    be in whichever state it's given."""
+
+    def __init__(self, state=None, pending=None):
+        self.state = Gst.State.READY if state is None else state
+        self.pending = Gst.State.PAUSED if pending is None else pending
+        self.set_states = []
+        self.set_ret = Gst.StateChangeReturn.ASYNC
+        self.seeks = 0
+
+
+    def get_state(self, timeout):
+        return (Gst.StateChangeReturn.ASYNC, self.state, self.pending)
+
+
+    def set_state(self, state):
+        self.set_states.append(state)
+        return self.set_ret
+
+
+    def seek_simple(self, fmt, flags, pos):
+        self.seeks += 1
+        return True
+
+
+class FakeMessage(object):
+
+    def __init__(self, msg_type, src=None, new=None):
+        self.type = msg_type
+        self.src = src
+        self.new = new
+
+
+    def parse_state_changed(self):
+        return (Gst.State.PAUSED, self.new, Gst.State.VOID_PENDING)
+
+
+def submit(name, func, *args, **kwargs):
+    func(*args)
+    return True
+
+
+class TransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sched = FakeScheduler()
+        self.changes = []
+        self.failed = []
+        self.transport = transport.Transport(self.sched, submit, TIMEOUTS,
+            on_failure=self.failed.append,
+            on_change=lambda old, new: self.changes.append(new))
+        self.pipe = FakePipeline()
+        self.transport.attach(self.pipe)
+
+
+    def _async_done(self):
+        self.transport.handle_message(self.pipe,
+            FakeMessage(Gst.MessageType.ASYNC_DONE))
+
+
+    def _now_playing(self):
+        self.transport.handle_message(self.pipe,
+            FakeMessage(Gst.MessageType.STATE_CHANGED, self.pipe,
+            Gst.State.PLAYING))
+
+
+    def _fire_timeout(self):
+        timer = self.sched.timers[-1]
+        timer.func(*timer.args)
+
+
+    def test_preroll(self):
+        self.assertEqual(self.transport.state, transport.PREROLLING)
+        self._async_done()
+        self.assertEqual(self.changes,
+            [transport.PREROLLING, transport.IDLE])
+        self.assertTrue(self.sched.timers[-1].cancelled)
+
+
+    def test_attach_prerolled(self):
+        pipe = FakePipeline(Gst.State.PAUSED, Gst.State.VOID_PENDING)
+        self.transport.attach(pipe)
+        self.assertEqual(self.transport.state, transport.IDLE)
+
+
+    def test_play_queued_while_prerolling(self):
+        self.transport.play()
+        self.assertEqual(self.pipe.set_states, [])
+        self.assertFalse(self.transport.playing)
+        self._async_done()
+        self.assertEqual(self.pipe.set_states, [Gst.State.PLAYING])
+        self.assertTrue(self.transport.playing)
+        #prerolling on the way to playing isn't the end of the transition
+        self._async_done()
+        self.assertEqual(self.transport.state, transport.PREROLLING)
+        self._now_playing()
+        self.assertEqual(self.transport.state, transport.PLAYING)
+
+
+    def test_stop_then_queued_play(self):
+        self._async_done()
+        self.transport.play()
+        self._now_playing()
+        self.transport.stop()
+        self.assertEqual(self.transport.state, transport.STOPPING)
+        self.assertEqual(self.pipe.seeks, 1)
+        self.transport.play()
+        self._async_done()
+        self.assertEqual(self.changes[-3:], [transport.STOPPING,
+            transport.IDLE, transport.PREROLLING])
+        self.assertTrue(self.transport.playing)
+
+
+    def test_seek_refused(self):
+        self._async_done()
+        self.transport.seek(lambda: False)
+        self.assertEqual(self.transport.state, transport.IDLE)
+        self.transport.seek(lambda: True)
+        self.assertEqual(self.transport.state, transport.SEEKING)
+        self._async_done()
+        self.assertEqual(self.transport.state, transport.IDLE)
+
+
+    def test_timeout_fails_and_drops_queued(self):
+        ran = []
+        self.transport.seek(lambda: ran.append(True) or True)
+        self.transport.play()
+        self._fire_timeout()
+        self.assertEqual(self.transport.state, transport.ERROR)
+        self.assertEqual(self.failed, [self.pipe])
+        #the queued requests aren't run on a late ASYNC_DONE either
+        self._async_done()
+        self.assertEqual(ran, [])
+        self.assertEqual(self.pipe.set_states, [])
+
+
+    def test_stale_timeout_ignored(self):
+        timer = self.sched.timers[-1]
+        self._async_done()
+        timer.func(*timer.args)
+        self.assertEqual(self.transport.state, transport.IDLE)
+        self.assertEqual(self.failed, [])
+
+
+    def test_play_failure(self):
+        self._async_done()
+        self.pipe.set_ret = Gst.StateChangeReturn.FAILURE
+        self.transport.play()
+        self.assertEqual(self.transport.state, transport.ERROR)
+        self.assertEqual(self.failed, [self.pipe])
+
+
+    def test_other_pipeline_ignored(self):
+        self.transport.handle_message(FakePipeline(),
+            FakeMessage(Gst.MessageType.ASYNC_DONE))
+        self.assertEqual(self.transport.state, transport.PREROLLING)
+
+
+if __name__ == '__main__':
+    unittest.main()